@@ -0,0 +1,302 @@
+import struct
+import zlib
+import base64
+import socket
+import hashlib
+import logging
+import ipaddress
+import re
+import asyncio
+import threading
+import json
+import os
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+import dns_cache
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ENCODE_CACHE_SIZE = 256
+
+def qCompress(data, level=-1):
+    compressed = zlib.compress(data, level)
+    header = struct.pack('>I', len(data))
+    return header + compressed
+
+def qUncompress(data):
+    if len(data) < 4:
+        return b''
+    uncompressed_size = struct.unpack('>I', data[:4])[0]
+    compressed_data = data[4:]
+    try:
+        uncompressed_data = zlib.decompress(compressed_data)
+    except zlib.error:
+        return b''
+    if len(uncompressed_data) != uncompressed_size:
+        return b''
+    return uncompressed_data
+
+def base64url_encode(data):
+    encoded = base64.urlsafe_b64encode(data)
+    return encoded.rstrip(b'=')
+
+def base64url_decode(data):
+    padding_needed = (4 - len(data) % 4) % 4
+    data += b'=' * padding_needed
+    return base64.urlsafe_b64decode(data)
+
+def is_ip_address(address):
+    try:
+        ipaddress.ip_address(address)
+        return True
+    except ValueError:
+        return False
+
+def resolve_dns_to_ip(dns_name):
+    try:
+        ip_address = socket.gethostbyname(dns_name)
+        return ip_address
+    except socket.gaierror:
+        return None
+
+ENDPOINT_PATTERN = re.compile(r'^(.*Endpoint\s*=\s*)([^\s:]+)(?::(\d+))(.*)$', re.MULTILINE)
+
+def endpoint_hosts(data):
+    """Доменные имена (не IP) из строк Endpoint конфигурации."""
+    return {match.group(2) for match in ENDPOINT_PATTERN.finditer(data) if not is_ip_address(match.group(2))}
+
+def process_conf_data(data, resolver=resolve_dns_to_ip, strict=True):
+    """
+    Заменяет доменное имя в Endpoint на IP-адрес. Если имя не разрешается,
+    при strict выбрасывает ValueError, иначе оставляет имя как есть.
+    """
+    def replace_endpoint(match):
+        full_line = match.group(0)
+        prefix = match.group(1)
+        address = match.group(2)
+        port = match.group(3)
+        suffix = match.group(4)
+        if not is_ip_address(address):
+            resolved_ip = resolver(address)
+            if resolved_ip:
+                logger.debug(f"Resolved DNS '{address}' to IP '{resolved_ip}'")
+                return f"{prefix}{resolved_ip}:{port}{suffix}"
+            elif strict:
+                raise ValueError(f"Could not resolve DNS name '{address}'")
+            else:
+                logger.warning(f"Не удалось разрешить {address}, Endpoint оставлен без изменений")
+                return full_line
+        else:
+            return full_line
+    return ENDPOINT_PATTERN.sub(replace_endpoint, data)
+
+async def process_conf_data_async(data, resolver, strict=False):
+    """process_conf_data с асинхронным кэширующим резолвером (dns_cache.CachedResolver)."""
+    hosts = sorted(endpoint_hosts(data))
+    addresses = await asyncio.gather(*(resolver.resolve_async(host) for host in hosts))
+    resolved = dict(zip(hosts, addresses))
+    return process_conf_data(data, resolved.get, strict)
+
+def encode(data):
+    data_bytes = data.encode('utf-8')
+    compressed = qCompress(data_bytes, level=8)
+    base64_encoded = base64url_encode(compressed)
+    s = 'vpn://' + base64_encoded.decode('ascii')
+    return s
+
+def decode(s):
+    data = s.replace('vpn://', '')
+    data_bytes = data.encode('ascii')
+    compressed = base64url_decode(data_bytes)
+    uncompressed = qUncompress(compressed)
+    if uncompressed:
+        result = uncompressed
+    else:
+        result = compressed
+    return result.decode('utf-8')
+
+def encode_config(data, resolver=resolve_dns_to_ip):
+    """Текст .conf -> строка vpn:// (с заменой доменного Endpoint на IP)."""
+    return encode(process_conf_data(data, resolver))
+
+def config_hash(data):
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class LRUCache:
+    def __init__(self, maxsize=ENCODE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+_encode_cache = LRUCache()
+
+def get_cached_vpn_key(processed_data):
+    return _encode_cache.get(config_hash(processed_data))
+
+def encode_cached(processed_data):
+    """encode с LRU-кэшем по хэшу уже обработанной конфигурации (Endpoint с IP)."""
+    key = config_hash(processed_data)
+    vpn_key = _encode_cache.get(key)
+    if vpn_key is None:
+        vpn_key = encode(processed_data)
+        _encode_cache.put(key, vpn_key)
+    return vpn_key
+
+def encode_config_cached(data, resolver=resolve_dns_to_ip):
+    return encode_cached(process_conf_data(data, resolver))
+
+def encode_cache_stats():
+    return _encode_cache.stats()
+
+BATCH_CHUNK_SIZE = 64
+
+_batch_resolver = None
+
+def _init_batch_worker():
+    # В каждом воркере свой кэширующий резолвер: одно имя разрешается один раз на весь пакет
+    global _batch_resolver
+    _batch_resolver = dns_cache.CachedResolver(default_ttl=dns_cache.STALE_TTL).resolve
+
+def _read_input(item):
+    if item.startswith('vpn://') or not os.path.isfile(item):
+        return item
+    with open(item, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+def process_batch_item(task):
+    """task = (режим 'encode'/'decode', путь к файлу или строка vpn://) -> словарь для JSON Lines."""
+    mode, item = task
+    try:
+        if mode == 'encode':
+            with open(item, 'r', encoding='utf-8') as f:
+                data = f.read()
+            result = encode_config(data, _batch_resolver or resolve_dns_to_ip)
+        else:
+            result = decode(_read_input(item))
+        return {'input': item, 'ok': True, 'result': result}
+    except Exception as e:
+        return {'input': item, 'ok': False, 'error': str(e)}
+
+def iter_batch_inputs(source=None, directory=None, mode='encode'):
+    """Строки из source (например, stdin) или файлы каталога: *.conf для encode, остальные - для decode."""
+    if directory:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            if (mode == 'encode') == name.endswith('.conf'):
+                yield path
+    if source is not None:
+        for line in source:
+            line = line.strip()
+            if line:
+                yield line
+
+def run_batch(items, mode='encode', workers=None, chunksize=BATCH_CHUNK_SIZE):
+    """
+    Обрабатывает поток входов в пуле процессов и отдаёт результаты по мере
+    готовности в исходном порядке. workers=1 - без пула, в текущем процессе.
+    """
+    tasks = ((mode, item) for item in items)
+    if workers == 1:
+        _init_batch_worker()
+        for task in tasks:
+            yield process_batch_item(task)
+        return
+    with Pool(processes=workers, initializer=_init_batch_worker) as pool:
+        for result in pool.imap(process_batch_item, tasks, chunksize):
+            yield result
+
+def write_jsonl(results, output):
+    count = 0
+    failed = 0
+    for result in results:
+        output.write(json.dumps(result, ensure_ascii=False) + '\n')
+        output.flush()
+        count += 1
+        if not result['ok']:
+            failed += 1
+    return count, failed
+
+SAMPLE_CONFIG = """[Interface]
+Address = 10.8.1.2/32
+DNS = 1.1.1.1, 1.0.0.1
+PrivateKey = yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk=
+Jc = 4
+Jmin = 10
+Jmax = 50
+S1 = 20
+S2 = 30
+H1 = 1
+H2 = 2
+H3 = 3
+H4 = 4
+
+[Peer]
+PublicKey = HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw=
+PresharedKey = FpCyhws9cxwWoV4xELtfJvjJN+zQVRPISllRWgeopVE=
+AllowedIPs = 0.0.0.0/0, ::/0
+Endpoint = 127.0.0.1:51820
+PersistentKeepalive = 25
+"""
+
+def benchmark(count=10000, workers=None, baseline_runs=20):
+    """Сравнение пакетного кодирования count конфигураций с запуском отдельного процесса на каждую."""
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(count):
+            path = os.path.join(directory, f"client{i}.conf")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(SAMPLE_CONFIG.replace('10.8.1.2', f"10.8.{i // 250 % 256}.{i % 250 + 2}"))
+            paths.append(path)
+
+        cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'awg-decode.py')
+        started = time.perf_counter()
+        for path in paths[:baseline_runs]:
+            subprocess.run([sys.executable, cli, '--encode', path], check=True, capture_output=True)
+        per_process = (time.perf_counter() - started) / baseline_runs
+
+        started = time.perf_counter()
+        results = list(run_batch(paths, 'encode', workers=1))
+        in_process = time.perf_counter() - started
+
+        started = time.perf_counter()
+        pooled = list(run_batch(paths, 'encode', workers=workers))
+        pool_time = time.perf_counter() - started
+
+    assert all(result['ok'] for result in results + pooled)
+    print(f"Конфигураций: {count}")
+    print(f"Отдельный процесс на каждую: {per_process * 1000:.1f} мс на файл, "
+          f"≈{per_process * count:.1f} с всего (по {baseline_runs} запускам)")
+    print(f"--batch --workers 1: {in_process:.2f} с ({in_process / count * 1e6:.0f} мкс на файл)")
+    print(f"--batch --workers {workers or os.cpu_count()}: {pool_time:.2f} с ({pool_time / count * 1e6:.0f} мкс на файл)")
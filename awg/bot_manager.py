@@ -1,19 +1,26 @@
 import db
+import traffic_store
+import expirations
+import awg_decode
+import dns_cache
+import qr_render
+import file_id_cache
 import aiohttp
 import logging
 import asyncio
 import aiofiles
 import os
 import re
+import hashlib
 import tempfile
 import json
-import subprocess
 import sys
+import time
 import pytz
+import io
 import zipfile
 import ipaddress
 import humanize
-import shutil
 from aiogram import Bot, types
 from aiogram.dispatcher import Dispatcher
 from aiogram.utils import exceptions as aiogram_exceptions
@@ -22,7 +29,6 @@ from aiogram.utils import executor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from zoneinfo import ZoneInfo
 
@@ -39,6 +45,8 @@ if not all([bot_token, admin_id]):
     logger.error("Отсутствуют обязательные настройки бота (bot_token или admin_id).")
     sys.exit(1)
 
+db.configure_snapshot_cache(config.get('snapshot_cache_ttl'), config.get('snapshot_cache_stale_ttl'))
+
 servers = db.load_servers()
 if not servers:
     logger.warning("Не найдено ни одного сервера в конфигурации")
@@ -46,11 +54,6 @@ if not servers:
 bot = Bot(bot_token)
 admin = int(admin_id)
 
-current_server = None
-WG_CONFIG_FILE = None
-DOCKER_CONTAINER = None
-ENDPOINT = None
-
 def escape_markdown_v2(text: str) -> str:
     """
     Экранирует все спецсимволы для Telegram MarkDownV2.
@@ -60,28 +63,6 @@ def escape_markdown_v2(text: str) -> str:
     escape_chars = r"_*[]()~`>#+-=|{}.!"
     return "".join("\\" + c if c in escape_chars else c for c in text)
 
-def update_server_settings(server_id=None):
-    global current_server, WG_CONFIG_FILE, DOCKER_CONTAINER, ENDPOINT
-    if server_id:
-        servers = db.load_servers()
-        if server_id in servers:
-            server_config = servers[server_id]
-            WG_CONFIG_FILE = server_config.get('wg_config_file')
-            DOCKER_CONTAINER = server_config.get('docker_container')
-            ENDPOINT = server_config.get('endpoint')
-            current_server = server_id
-            logger.info(f"Настройки сервера {server_id} обновлены")
-            return True
-        else:
-            logger.error(f"Сервер {server_id} не найден")
-            return False
-    else:
-        WG_CONFIG_FILE = None
-        DOCKER_CONTAINER = None
-        ENDPOINT = None
-        current_server = None
-        return True
-
 class AdminMessageDeletionMiddleware(BaseMiddleware):
     async def on_process_message(self, message: types.Message, data: dict):
         if message.from_user.id == admin:
@@ -90,27 +71,103 @@ class AdminMessageDeletionMiddleware(BaseMiddleware):
 dp = Dispatcher(bot)
 scheduler = AsyncIOScheduler(timezone=pytz.UTC)
 scheduler.start()
+expiration_engine = None
+dns_resolver = dns_cache.CachedResolver()
+file_ids = file_id_cache.FileIdCache()
 
 dp.middleware.setup(AdminMessageDeletionMiddleware())
 
 main_menu_markup = InlineKeyboardMarkup(row_width=1).add(
     InlineKeyboardButton("➕ Добавить пользователя", callback_data="add_user"),
+    InlineKeyboardButton("👥 Добавить списком", callback_data="bulk_add"),
     InlineKeyboardButton("📋 Список клиентов", callback_data="list_users"),
     InlineKeyboardButton("🔑 Создать бекап", callback_data="create_backup"),
     InlineKeyboardButton("⚙ Управление серверами", callback_data="manage_servers")
 )
 
-current_server = None
-
 user_main_messages = {}
+selected_servers = {}
 isp_cache = {}
 ISP_CACHE_FILE = 'files/isp_cache.json'
 CACHE_TTL = timedelta(hours=24)
 
+TRAFFIC_POLL_INTERVAL = 1
+TRAFFIC_POLL_CONCURRENCY = 8
+TRAFFIC_POLL_TIMEOUT = 20
+
 TRAFFIC_LIMITS = ["5 GB", "10 GB", "30 GB", "100 GB", "Неограниченно"]
 
-def get_interface_name():
-    return os.path.basename(WG_CONFIG_FILE).split('.')[0]
+def get_selected_server():
+    server_id = selected_servers.get(admin)
+    if server_id and server_id not in db.load_servers():
+        selected_servers.pop(admin, None)
+        return None
+    return server_id
+
+def select_server(server_id):
+    if server_id in db.load_servers():
+        selected_servers[admin] = server_id
+        logger.info(f"Выбран сервер {server_id}")
+        return True
+    logger.error(f"Сервер {server_id} не найден")
+    return False
+
+CALLBACK_DATA_LIMIT = 64
+CALLBACK_TOKEN_LENGTH = 10
+
+def make_callback(prefix, *parts):
+    data = prefix + ':'.join(str(part) for part in parts)
+    assert len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT, f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data}"
+    return data
+
+def callback_token(value):
+    """
+    Короткий токен сервера или клиента для callback_data: имена из clientsTable и
+    идентификаторы серверов бывают произвольной длины, а Telegram ограничивает
+    callback_data 64 байтами и отклоняет всю клавиатуру из-за одной длинной кнопки.
+    """
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:CALLBACK_TOKEN_LENGTH]
+
+def find_server_by_token(token):
+    return next((server_id for server_id in db.get_server_list() if callback_token(server_id) == token), None)
+
+async def resolve_server_callback(callback_query, token):
+    """Сервер по токену из callback_data; None, если его уже нет (пользователю отправлен ответ)."""
+    server_id = find_server_by_token(token)
+    if server_id is None:
+        await callback_query.answer("Сервер не найден.", show_alert=True)
+    return server_id
+
+async def parse_client_callback(callback_query, prefix):
+    """Разбирает callback <префикс><токен сервера>:<токен клиента> в (сервер, имя клиента) или None."""
+    parts = parse_callback(callback_query.data, prefix, 2)
+    if not parts:
+        await callback_query.answer("Некорректные данные.", show_alert=True)
+        return None
+    server_id = await resolve_server_callback(callback_query, parts[0])
+    if server_id is None:
+        return None
+    snapshot = await db.get_server_snapshot(server_id=server_id)
+    username = next((client[0] for client in (snapshot.clients if snapshot else []) if callback_token(client[0]) == parts[1]), None)
+    if username is None:
+        await callback_query.answer("Ошибка: пользователь не найден.", show_alert=True)
+        return None
+    return server_id, username
+
+def parse_callback(data, prefix, parts=2):
+    values = data[len(prefix):].split(':', parts - 1)
+    if len(values) != parts:
+        return None
+    return values
+
+async def check_server(callback_query, server_id):
+    if not server_id:
+        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+        return False
+    if server_id not in db.load_servers():
+        await callback_query.answer(f"Сервер {server_id} не найден.", show_alert=True)
+        return False
+    return True
 
 async def load_isp_cache():
     global isp_cache
@@ -178,12 +235,16 @@ async def load_isp_cache_task():
     await load_isp_cache()
     scheduler.add_job(cleanup_isp_cache, 'interval', hours=1)
 
-def create_zip(backup_filepath):
-    with zipfile.ZipFile(backup_filepath, 'w') as zipf:
-        for main_file in ['awg-decode.py', 'newclient.sh', 'removeclient.sh']:
+def create_zip(backup_file):
+    with zipfile.ZipFile(backup_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for main_file in ['awg-decode.py', 'awg_decode.py', 'dns_cache.py', 'newclient.sh', 'removeclient.sh']:
             if os.path.exists(main_file):
                 zipf.write(main_file, main_file)
         for root, dirs, files in os.walk('files'):
+            if os.path.abspath(root) == os.path.abspath(qr_render.QR_CACHE_DIR):
+                # Кэш QR-кодов пересоздаётся из конфигураций
+                dirs[:] = []
+                continue
             for file in files:
                 filepath = os.path.join(root, file)
                 arcname = os.path.relpath(filepath, os.getcwd())
@@ -201,36 +262,15 @@ async def delete_message_after_delay(chat_id: int, message_id: int, delay: int):
     except:
         pass
 
-def parse_relative_time(relative_str: str) -> datetime:
-    try:
-        parts = relative_str.lower().replace(' ago', '').split(', ')
-        delta = timedelta()
-        for part in parts:
-            number, unit = part.split(' ')
-            number = int(number)
-            if 'minute' in unit:
-                delta += timedelta(minutes=number)
-            elif 'second' in unit:
-                delta += timedelta(seconds=number)
-            elif 'hour' in unit:
-                delta += timedelta(hours=number)
-            elif 'day' in unit:
-                delta += timedelta(days=number)
-            elif 'week' in unit:
-                delta += timedelta(weeks=number)
-            elif 'month' in unit:
-                delta += timedelta(days=30 * number)
-            elif 'year' in unit:
-                delta += timedelta(days=365 * number)
-        return datetime.now(pytz.UTC) - delta
-    except Exception as e:
-        logger.error(f"Ошибка при парсинге относительного времени '{relative_str}': {e}")
+def handshake_to_datetime(latest_handshake: int) -> datetime:
+    if not latest_handshake:
         return None
+    return datetime.fromtimestamp(latest_handshake, pytz.UTC)
 
 @dp.message_handler(commands=['start', 'help'])
 async def help_command_handler(message: types.Message):
     if message.chat.id == admin:
-        sent_message = await message.answer(f"Выберите действие\nТекущий сервер: *{current_server}*", reply_markup=main_menu_markup, parse_mode='MarkDown')
+        sent_message = await message.answer(f"Выберите действие\nТекущий сервер: *{get_selected_server()}*", reply_markup=main_menu_markup, parse_mode='MarkDown')
         user_main_messages[admin] = {'chat_id': sent_message.chat.id, 'message_id': sent_message.message_id}
         try:
             await bot.pin_chat_message(chat_id=message.chat.id, message_id=sent_message.message_id, disable_notification=True)
@@ -249,14 +289,14 @@ async def handle_messages(message: types.Message):
     
     if user_state == 'waiting_for_server_id':
         server_id = message.text.strip()
-        if not all(c.isalnum() or c in "-_" for c in server_id):
+        if not db.SERVER_ID_PATTERN.match(server_id):
             main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
             main_message_id = user_main_messages.get(admin, {}).get('message_id')
             if main_chat_id and main_message_id:
                 await bot.edit_message_text(
                     chat_id=main_chat_id,
                     message_id=main_message_id,
-                    text="Идентификатор сервера может содержать только буквы, цифры, дефисы и подчёркивания.\nВведите идентификатор нового сервера:",
+                    text=f"Идентификатор сервера может содержать только латинские буквы, цифры, дефисы и подчёркивания, не длиннее {db.MAX_SERVER_ID_LENGTH} символов.\nВведите идентификатор нового сервера:",
                     reply_markup=InlineKeyboardMarkup().add(
                         InlineKeyboardButton("Отмена", callback_data="manage_servers")
                     )
@@ -356,13 +396,17 @@ async def handle_messages(message: types.Message):
         password = message.text.strip()
         server_data = user_main_messages[admin]
         
-        success = db.add_server(
-            server_data['server_id'],
-            server_data['host'],
-            server_data['port'],
-            server_data['username'],
-            'password',
-            password=password
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(
+            None,
+            lambda: db.add_server(
+                server_data['server_id'],
+                server_data['host'],
+                server_data['port'],
+                server_data['username'],
+                'password',
+                password=password
+            )
         )
         
         main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
@@ -383,8 +427,8 @@ async def handle_messages(message: types.Message):
                 text="Управление серверами:",
                 reply_markup=InlineKeyboardMarkup(row_width=2).add(
                     *[InlineKeyboardButton(
-                        f"{'✅ ' if server == current_server else ''}{server}",
-                        callback_data=f"select_server_{server}"
+                        f"{'✅ ' if server == get_selected_server() else ''}{server}",
+                        callback_data=make_callback("select_server_", callback_token(server))
                     ) for server in db.get_server_list()],
                     InlineKeyboardButton("Добавить сервер", callback_data="add_server"),
                     InlineKeyboardButton("Удалить сервер", callback_data="delete_server"),
@@ -408,13 +452,17 @@ async def handle_messages(message: types.Message):
         key_path = message.text.strip()
         server_data = user_main_messages[admin]
         
-        success = db.add_server(
-            server_data['server_id'],
-            server_data['host'],
-            server_data['port'],
-            server_data['username'],
-            'key',
-            key_path=key_path
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(
+            None,
+            lambda: db.add_server(
+                server_data['server_id'],
+                server_data['host'],
+                server_data['port'],
+                server_data['username'],
+                'key',
+                key_path=key_path
+            )
         )
         
         main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
@@ -435,8 +483,8 @@ async def handle_messages(message: types.Message):
                 text="Управление серверами:",
                 reply_markup=InlineKeyboardMarkup(row_width=2).add(
                     *[InlineKeyboardButton(
-                        f"{'✅ ' if server == current_server else ''}{server}",
-                        callback_data=f"select_server_{server}"
+                        f"{'✅ ' if server == get_selected_server() else ''}{server}",
+                        callback_data=make_callback("select_server_", callback_token(server))
                     ) for server in db.get_server_list()],
                     InlineKeyboardButton("Добавить сервер", callback_data="add_server"),
                     InlineKeyboardButton("Удалить сервер", callback_data="delete_server"),
@@ -458,18 +506,19 @@ async def handle_messages(message: types.Message):
             
     elif user_state == 'waiting_for_user_name':
         user_name = message.text.strip()
-        if not all(c.isalnum() or c in "-" for c in user_name):
-            await message.reply("Имя пользователя может содержать только буквы, цифры и дефисы.")
+        if not db.CLIENT_NAME_PATTERN.match(user_name):
+            sent_message = await message.reply(f"Имя пользователя может содержать только латинские буквы, цифры, дефисы и подчёркивания, не длиннее {db.MAX_CLIENT_NAME_LENGTH} символов.")
             asyncio.create_task(delete_message_after_delay(sent_message.chat.id, sent_message.message_id, delay=5))
             return
+        server_id = user_main_messages[admin].get('client_server')
         user_main_messages[admin]['client_name'] = user_name
         user_main_messages[admin]['state'] = 'waiting_for_duration'
         duration_buttons = [
-            InlineKeyboardButton("1 час", callback_data=f"duration_1h_{user_name}_noipv6"),
-            InlineKeyboardButton("1 день", callback_data=f"duration_1d_{user_name}_noipv6"),
-            InlineKeyboardButton("1 неделя", callback_data=f"duration_1w_{user_name}_noipv6"),
-            InlineKeyboardButton("1 месяц", callback_data=f"duration_1m_{user_name}_noipv6"),
-            InlineKeyboardButton("Без ограничений", callback_data=f"duration_unlimited_{user_name}_noipv6"),
+            InlineKeyboardButton("1 час", callback_data=make_callback("duration_", "1h", callback_token(server_id), user_name)),
+            InlineKeyboardButton("1 день", callback_data=make_callback("duration_", "1d", callback_token(server_id), user_name)),
+            InlineKeyboardButton("1 неделя", callback_data=make_callback("duration_", "1w", callback_token(server_id), user_name)),
+            InlineKeyboardButton("1 месяц", callback_data=make_callback("duration_", "1m", callback_token(server_id), user_name)),
+            InlineKeyboardButton("Без ограничений", callback_data=make_callback("duration_", "unlimited", callback_token(server_id), user_name)),
             InlineKeyboardButton("Домой", callback_data="home")
         ]
         duration_markup = InlineKeyboardMarkup(row_width=1).add(*duration_buttons)
@@ -485,6 +534,42 @@ async def handle_messages(message: types.Message):
             )
         else:
             await message.answer("Ошибка: главное сообщение не найдено.")
+    elif user_state == 'waiting_for_bulk_names':
+        server_id = user_main_messages[admin].get('bulk_server')
+        names = []
+        for name in re.split(r'[\s,;]+', message.text.strip()):
+            if name and name not in names:
+                names.append(name)
+        invalid = [name for name in names if not db.CLIENT_NAME_PATTERN.match(name)]
+        main_chat_id = user_main_messages[admin].get('chat_id')
+        main_message_id = user_main_messages[admin].get('message_id')
+        if not names or invalid:
+            text = f"Имена пользователей могут содержать только латинские буквы, цифры, дефисы и подчёркивания, не длиннее {db.MAX_CLIENT_NAME_LENGTH} символов."
+            if invalid:
+                text += f"\nНекорректные имена: {', '.join(invalid)}"
+            sent_message = await message.reply(text)
+            asyncio.create_task(delete_message_after_delay(sent_message.chat.id, sent_message.message_id, delay=5))
+            return
+        user_main_messages[admin]['bulk_names'] = names
+        user_main_messages[admin]['state'] = 'waiting_for_bulk_duration'
+        duration_buttons = [
+            InlineKeyboardButton("1 час", callback_data=make_callback("bulk_duration_", "1h", callback_token(server_id))),
+            InlineKeyboardButton("1 день", callback_data=make_callback("bulk_duration_", "1d", callback_token(server_id))),
+            InlineKeyboardButton("1 неделя", callback_data=make_callback("bulk_duration_", "1w", callback_token(server_id))),
+            InlineKeyboardButton("1 месяц", callback_data=make_callback("bulk_duration_", "1m", callback_token(server_id))),
+            InlineKeyboardButton("Без ограничений", callback_data=make_callback("bulk_duration_", "unlimited", callback_token(server_id))),
+            InlineKeyboardButton("Домой", callback_data="home")
+        ]
+        if main_chat_id and main_message_id:
+            await bot.edit_message_text(
+                chat_id=main_chat_id,
+                message_id=main_message_id,
+                text=f"Пользователей к добавлению: *{len(names)}*\nВыберите время действия конфигураций:",
+                parse_mode="MarkDown",
+                reply_markup=InlineKeyboardMarkup(row_width=1).add(*duration_buttons)
+            )
+        else:
+            await message.answer("Ошибка: главное сообщение не найдено.")
     else:
         await message.reply("Неизвестная команда или действие.")
         asyncio.create_task(delete_message_after_delay(sent_message.chat.id, sent_message.message_id, delay=5))
@@ -495,16 +580,17 @@ async def prompt_for_user_name(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+    server_id = get_selected_server()
+    if not await check_server(callback_query, server_id):
         return
     main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
     main_message_id = user_main_messages.get(admin, {}).get('message_id')
     if main_chat_id and main_message_id:
+        user_main_messages[admin]['client_server'] = server_id
         await bot.edit_message_text(
             chat_id=main_chat_id,
             message_id=main_message_id,
-            text=f"Введите имя пользователя для добавления\nТекущий сервер: *{current_server}*",
+            text=f"Введите имя пользователя для добавления\nТекущий сервер: *{server_id}*",
             reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("Домой", callback_data="home")
                                                    ),
@@ -530,18 +616,19 @@ async def set_config_duration(callback: types.CallbackQuery):
     if callback.from_user.id != admin:
         await callback.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
-    parts = callback.data.split('_')
-    if len(parts) < 4:
+    parts = parse_callback(callback.data, 'duration_', 3)
+    if not parts:
         await callback.answer("Некорректные данные.", show_alert=True)
         return
-    duration_choice = parts[1]
-    client_name = parts[2]
-    ipv6_flag = parts[3]
+    duration_choice, token, client_name = parts
+    server_id = await resolve_server_callback(callback, token)
+    if server_id is None:
+        return
     user_main_messages[admin]['duration_choice'] = duration_choice
     user_main_messages[admin]['state'] = 'waiting_for_traffic_limit'
     traffic_buttons = [
-        InlineKeyboardButton(limit, callback_data=f"traffic_limit_{limit}_{client_name}")
-        for limit in TRAFFIC_LIMITS
+        InlineKeyboardButton(limit, callback_data=make_callback("traffic_limit_", index, callback_token(server_id), client_name))
+        for index, limit in enumerate(TRAFFIC_LIMITS)
     ]
     traffic_markup = InlineKeyboardMarkup(row_width=1).add(*traffic_buttons)
     await bot.edit_message_text(
@@ -553,6 +640,17 @@ async def set_config_duration(callback: types.CallbackQuery):
     )
     await callback.answer()
 
+def get_duration(duration_choice):
+    if duration_choice == '1h':
+        return timedelta(hours=1)
+    elif duration_choice == '1d':
+        return timedelta(days=1)
+    elif duration_choice == '1w':
+        return timedelta(weeks=1)
+    elif duration_choice == '1m':
+        return timedelta(days=30)
+    return None
+
 def format_vpn_key(vpn_key, num_lines=8):
     line_length = len(vpn_key) // num_lines
     if len(vpn_key) % num_lines != 0:
@@ -566,12 +664,15 @@ async def set_traffic_limit(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
-    parts = callback_query.data.split('_', 3)
-    if len(parts) < 4:
+    parts = parse_callback(callback_query.data, 'traffic_limit_', 3)
+    if not parts or not parts[0].isdigit() or int(parts[0]) >= len(TRAFFIC_LIMITS):
         await callback_query.answer("Некорректные данные.", show_alert=True)
         return
-    traffic_limit = parts[2]
-    client_name = parts[3]
+    traffic_limit = TRAFFIC_LIMITS[int(parts[0])]
+    client_name = parts[2]
+    server_id = await resolve_server_callback(callback_query, parts[1])
+    if server_id is None:
+        return
     traffic_bytes = parse_traffic_limit(traffic_limit)
     if traffic_limit != "Неограниченно" and traffic_bytes is None:
         await callback_query.answer("Некорректный формат лимита трафика.", show_alert=True)
@@ -579,36 +680,20 @@ async def set_traffic_limit(callback_query: types.CallbackQuery):
     user_main_messages[admin]['traffic_limit'] = traffic_limit
     user_main_messages[admin]['state'] = None
     duration_choice = user_main_messages.get(admin, {}).get('duration_choice')
-    if duration_choice == '1h':
-        duration = timedelta(hours=1)
-    elif duration_choice == '1d':
-        duration = timedelta(days=1)
-    elif duration_choice == '1w':
-        duration = timedelta(weeks=1)
-    elif duration_choice == '1m':
-        duration = timedelta(days=30)
-    elif duration_choice == 'unlimited':
-        duration = None
-    else:
-        duration = None
+    duration = get_duration(duration_choice)
+    expiration_time = None
     if duration:
         expiration_time = datetime.now(pytz.UTC) + duration
-        db.set_user_expiration(client_name, expiration_time, traffic_limit, server_id=current_server)
-        scheduler.add_job(
-            deactivate_user,
-            trigger=DateTrigger(run_date=expiration_time),
-            args=[client_name],
-            id=client_name
-        )
         confirmation_text = f"Пользователь **{client_name}** добавлен. \nКонфигурация истечет через **{duration_choice}**."
     else:
-        db.set_user_expiration(client_name, None, traffic_limit, server_id=current_server)
         confirmation_text = f"Пользователь **{client_name}** добавлен с неограниченным временем действия."
     if traffic_limit != "Неограниченно":
         confirmation_text += f"\nЛимит трафика: **{traffic_limit}**."
     else:
         confirmation_text += f"\nЛимит трафика: **♾️ Неограниченно**."
-    success = db.root_add(client_name, server_id=current_server, ipv6=False)
+    # Срок действия записывается вместе с созданием клиента, только если он действительно создан
+    configs = await db.bulk_add_clients([client_name], server_id=server_id, expiration=expiration_time, traffic_limit=traffic_limit)
+    success = client_name in configs
     if success:
         try:
             conf_path = os.path.join('users', client_name, f'{client_name}.conf')
@@ -626,15 +711,10 @@ async def set_traffic_limit(callback_query: types.CallbackQuery):
             else:
                 caption = "VPN ключ не был сгенерирован."
             if os.path.exists(conf_path):
-                with open(conf_path, 'rb') as config:
-                    sent_doc = await bot.send_document(
-                        admin,
-                        config,
-                        caption=caption,
-                        parse_mode="Markdown",
-                        disable_notification=True
-                    )
-                    asyncio.create_task(delete_message_after_delay(admin, sent_doc.message_id, delay=15))
+                sent_doc = await send_client_config(client_name, conf_path, caption)
+                asyncio.create_task(delete_message_after_delay(admin, sent_doc.message_id, delay=15))
+                for message_id in await send_config_qr_codes(client_name, conf_path, vpn_key):
+                    asyncio.create_task(delete_message_after_delay(admin, message_id, delay=15))
         except FileNotFoundError:
             confirmation_text = "Не удалось найти файлы конфигурации для указанного пользователя."
             sent_message = await bot.send_message(admin, confirmation_text, parse_mode="MarkDown", disable_notification=True)
@@ -670,7 +750,7 @@ async def set_traffic_limit(callback_query: types.CallbackQuery):
         await bot.edit_message_text(
             chat_id=main_chat_id,
             message_id=main_message_id,
-            text=f"Выберите действие\nТекущий сервер: *{current_server}*",
+            text=f"Выберите действие\nТекущий сервер: *{get_selected_server()}*",
             reply_markup=main_menu_markup,
             parse_mode='MarkDown'
         )
@@ -678,26 +758,173 @@ async def set_traffic_limit(callback_query: types.CallbackQuery):
         await callback_query.answer("Выберите действие:", show_alert=True)
     await callback_query.answer()
 
+@dp.callback_query_handler(lambda c: c.data == 'bulk_add')
+async def prompt_for_bulk_names(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    server_id = get_selected_server()
+    if not await check_server(callback_query, server_id):
+        return
+    main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
+    main_message_id = user_main_messages.get(admin, {}).get('message_id')
+    if main_chat_id and main_message_id:
+        user_main_messages[admin]['bulk_server'] = server_id
+        await bot.edit_message_text(
+            chat_id=main_chat_id,
+            message_id=main_message_id,
+            text=f"Вставьте список имён пользователей (по одному в строке или через запятую)\nТекущий сервер: *{server_id}*",
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("Домой", callback_data="home")
+            ),
+            parse_mode='MarkDown'
+        )
+        user_main_messages[admin]['state'] = 'waiting_for_bulk_names'
+    else:
+        await callback_query.answer("Ошибка: главное сообщение не найдено.", show_alert=True)
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_duration_'))
+async def set_bulk_duration(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    if not user_main_messages.get(admin, {}).get('bulk_names'):
+        await callback_query.answer("Список пользователей не найден.", show_alert=True)
+        return
+    parts = parse_callback(callback_query.data, 'bulk_duration_', 2)
+    if not parts:
+        await callback_query.answer("Некорректные данные.", show_alert=True)
+        return
+    duration_choice, token = parts
+    server_id = await resolve_server_callback(callback_query, token)
+    if server_id is None:
+        return
+    user_main_messages[admin]['duration_choice'] = duration_choice
+    user_main_messages[admin]['state'] = 'waiting_for_bulk_traffic_limit'
+    traffic_buttons = [
+        InlineKeyboardButton(limit, callback_data=make_callback("bulk_traffic_", index, callback_token(server_id)))
+        for index, limit in enumerate(TRAFFIC_LIMITS)
+    ]
+    await bot.edit_message_text(
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        text=f"Выберите лимит трафика для *{len(user_main_messages[admin]['bulk_names'])}* пользователей:",
+        parse_mode="MarkDown",
+        reply_markup=InlineKeyboardMarkup(row_width=1).add(*traffic_buttons)
+    )
+    await callback_query.answer()
+
+def build_configs_zip(configs):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for client_name, client_config in configs.items():
+            zipf.writestr(f"{client_name}.conf", client_config)
+    buffer.seek(0)
+    return buffer
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_traffic_'))
+async def set_bulk_traffic_limit(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    names = user_main_messages.get(admin, {}).get('bulk_names')
+    if not names:
+        await callback_query.answer("Список пользователей не найден.", show_alert=True)
+        return
+    parts = parse_callback(callback_query.data, 'bulk_traffic_', 2)
+    if not parts or not parts[0].isdigit() or int(parts[0]) >= len(TRAFFIC_LIMITS):
+        await callback_query.answer("Некорректные данные.", show_alert=True)
+        return
+    traffic_limit = TRAFFIC_LIMITS[int(parts[0])]
+    server_id = await resolve_server_callback(callback_query, parts[1])
+    if server_id is None:
+        return
+    await callback_query.answer("Создаю конфигурации...")
+    user_main_messages[admin]['state'] = None
+    user_main_messages[admin].pop('bulk_names', None)
+    duration_choice = user_main_messages[admin].get('duration_choice')
+    duration = get_duration(duration_choice)
+    expiration_time = datetime.now(pytz.UTC) + duration if duration else None
+
+    configs = await db.bulk_add_clients(names, server_id=server_id, expiration=expiration_time, traffic_limit=traffic_limit)
+
+    skipped = [name for name in names if name not in configs]
+    if configs:
+        confirmation_text = f"Добавлено пользователей: **{len(configs)}**."
+        if duration:
+            confirmation_text += f"\nКонфигурации истекут через **{duration_choice}**."
+        else:
+            confirmation_text += "\nВремя действия не ограничено."
+        if traffic_limit != "Неограниченно":
+            confirmation_text += f"\nЛимит трафика: **{traffic_limit}**."
+        else:
+            confirmation_text += f"\nЛимит трафика: **♾️ Неограниченно**."
+        try:
+            archive = types.InputFile(build_configs_zip(configs), filename=f"{server_id}_configs.zip")
+            sent_doc = await bot.send_document(admin, archive, disable_notification=True)
+            asyncio.create_task(delete_message_after_delay(admin, sent_doc.message_id, delay=60))
+        except Exception as e:
+            logger.error(f"Ошибка при отправке архива конфигураций: {e}")
+            confirmation_text += "\nНе удалось отправить архив конфигураций."
+    else:
+        confirmation_text = "Не удалось добавить пользователей."
+    if skipped:
+        confirmation_text += f"\nПропущены: {', '.join(skipped)}"
+    sent_confirmation = await bot.send_message(
+        chat_id=admin,
+        text=confirmation_text,
+        parse_mode="MarkDown",
+        disable_notification=True
+    )
+    asyncio.create_task(delete_message_after_delay(admin, sent_confirmation.message_id, delay=15))
+    main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
+    main_message_id = user_main_messages.get(admin, {}).get('message_id')
+    if main_chat_id and main_message_id:
+        await bot.edit_message_text(
+            chat_id=main_chat_id,
+            message_id=main_message_id,
+            text=f"Выберите действие\nТекущий сервер: *{get_selected_server()}*",
+            reply_markup=main_menu_markup,
+            parse_mode='MarkDown'
+        )
+
+def client_card_keyboard(server_id, username):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("🔎 IP info", callback_data=make_callback("ip_info_", callback_token(server_id), callback_token(username))),
+        InlineKeyboardButton("Подключения", callback_data=make_callback("connections_", callback_token(server_id), callback_token(username))),
+        InlineKeyboardButton("🔐 Получить конфигурацию", callback_data=make_callback("send_config_", callback_token(server_id), callback_token(username))),
+        InlineKeyboardButton("📈 История трафика", callback_data=make_callback("traffic_history_", callback_token(server_id), callback_token(username)))
+    )
+    keyboard.add(
+        InlineKeyboardButton("Удалить", callback_data=make_callback("confirm_delete_user_", callback_token(server_id), callback_token(username)))
+    )
+    keyboard.add(
+        InlineKeyboardButton("⬅️ Назад", callback_data=make_callback("list_users_", callback_token(server_id))),
+        InlineKeyboardButton("Домой", callback_data="home")
+    )
+    return keyboard
+
 @dp.callback_query_handler(lambda c: c.data.startswith('client_'))
 async def client_selected_callback(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+    target = await parse_client_callback(callback_query, 'client_')
+    if target is None:
         return
-        
-    _, username = callback_query.data.split('client_', 1)
-    username = username.strip()
-    clients = db.get_client_list(server_id=current_server)
+    server_id, username = target
+    snapshot = await db.get_server_snapshot(server_id=server_id)
+    clients = snapshot.clients if snapshot else []
     client_info = next((c for c in clients if c[0] == username), None)
     if not client_info:
         await callback_query.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
 
-    expiration_time = db.get_user_expiration(username, server_id=current_server)
-    traffic_limit = db.get_user_traffic_limit(username, server_id=current_server)
+    expiration_time = db.get_user_expiration(username, server_id=server_id)
+    traffic_limit = db.get_user_traffic_limit(username, server_id=server_id)
     status = "🔴 Offline"
     incoming_traffic = "↓—"
     outgoing_traffic = "↑—"
@@ -705,56 +932,40 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
     total_bytes = 0
     formatted_total = "0.00B"
 
-    active_clients = db.get_active_list(server_id=current_server)
-    active_info = None
-    for ac in active_clients:
-        if isinstance(ac, dict) and ac.get('name') == username:
-            active_info = ac
-            break
-        elif isinstance(ac, (list, tuple)) and ac[0] == username:
-            active_info = {'name': ac[0], 'last_handshake': ac.get(1, 'never'), 'transfer': ac.get(2, '0/0')}
-            break
+    active_info = next((ac for ac in snapshot.active_clients if ac.get('name') == username), None)
+    last_handshake_dt = None
 
     if active_info:
-        last_handshake_str = active_info.get('last_handshake', 'never')
-        if last_handshake_str.lower() not in ['never', 'нет данных', '-']:
-            try:
-                last_handshake_dt = parse_relative_time(last_handshake_str)
-                if last_handshake_dt:
-                    delta = datetime.now(pytz.UTC) - last_handshake_dt
-                    if delta <= timedelta(minutes=3):
-                        status = "🟢 Online"
-                    else:
-                        status = "🔴 Offline"
-
-                transfer = active_info.get('transfer', '0/0')
-                incoming_bytes, outgoing_bytes = parse_transfer(transfer)
-                incoming_traffic = f"↓{humanize_bytes(incoming_bytes)}"
-                outgoing_traffic = f"↑{humanize_bytes(outgoing_bytes)}"
-                traffic_data = await update_traffic(username, incoming_bytes, outgoing_bytes)
-                total_bytes = traffic_data.get('total_incoming', 0) + traffic_data.get('total_outgoing', 0)
-                formatted_total = humanize_bytes(total_bytes)
-
-                if traffic_limit != "Неограниченно":
-                    limit_bytes = parse_traffic_limit(traffic_limit)
-                    if total_bytes >= limit_bytes:
-                        await deactivate_user(username)
-                        await callback_query.answer(
-                            f"Пользователь {username} превысил лимит трафика и был удален.",
-                            show_alert=True
-                        )
-                        return
-            except ValueError:
-                logger.error(f"Некорректный формат даты для пользователя {username}: {last_handshake_str}")
-                status = "🔴 Offline"
+        last_handshake_dt = handshake_to_datetime(active_info.get('latest_handshake', 0))
+        if last_handshake_dt and datetime.now(pytz.UTC) - last_handshake_dt <= timedelta(minutes=3):
+            status = "🟢 Online"
+
+        incoming_bytes = active_info.get('rx_bytes', 0)
+        outgoing_bytes = active_info.get('tx_bytes', 0)
+        incoming_traffic = f"↓{humanize_bytes(incoming_bytes)}"
+        outgoing_traffic = f"↑{humanize_bytes(outgoing_bytes)}"
+        traffic_data = read_traffic(server_id, active_info['public_key'])
+        total_bytes = traffic_data.get('total_incoming', 0) + traffic_data.get('total_outgoing', 0)
+        formatted_total = humanize_bytes(total_bytes)
+
+        if traffic_limit != "Неограниченно":
+            limit_bytes = parse_traffic_limit(traffic_limit)
+            if total_bytes >= limit_bytes:
+                await deactivate_user(username, server_id)
+                await callback_query.answer(
+                    f"Пользователь {username} превысил лимит трафика и был удален.",
+                    show_alert=True
+                )
+                return
     else:
-        traffic_data = await read_traffic(username)
+        traffic_data = read_traffic(server_id, client_info[1])
         total_bytes = traffic_data.get('total_incoming', 0) + traffic_data.get('total_outgoing', 0)
         formatted_total = humanize_bytes(total_bytes)
 
     allowed_ips = client_info[2]
     ipv4_match = re.search(r'(\d{1,3}\.){3}\d{1,3}/\d+', allowed_ips)
     ipv4_address = ipv4_match.group(0) if ipv4_match else "—"
+    daily_usage = humanize_bytes(read_recent_usage(server_id, client_info[1]))
 
     if expiration_time:
         now = datetime.now(pytz.UTC)
@@ -778,7 +989,7 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
 
     traffic_limit_display = "♾️ Неограниченно" if traffic_limit == "Неограниченно" else traffic_limit
 
-    if last_handshake_str and last_handshake_str.lower() not in ['never', 'нет данных', '-']:
+    if last_handshake_dt:
         show_last_handshake = f"{last_handshake_dt.astimezone(CURRENT_TIMEZONE).strftime('%d/%m/%Y %H:%M:%S')}"
     else:
         show_last_handshake = "❗Нет данных❗"
@@ -794,21 +1005,10 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
         f"🔽 _Входящий трафик:_ {outgoing_traffic}\n"
         f"📊 _Всего:_ ↑↓{formatted_total}\n"
         f"             из **{traffic_limit_display}**\n"
+        f"📈 _За 24 ч:_ ↑↓{daily_usage}\n"
     )
 
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        InlineKeyboardButton("🔎 IP info", callback_data=f"ip_info_{username}"),
-        InlineKeyboardButton("Подключения", callback_data=f"connections_{username}"),
-        InlineKeyboardButton("🔐 Получить конфигурацию", callback_data=f"send_config_{username}")
-    )
-    keyboard.add(
-        InlineKeyboardButton("Удалить", callback_data=f"confirm_delete_user_{username}")
-    )
-    keyboard.add(
-        InlineKeyboardButton("⬅️ Назад", callback_data="list_users"),
-        InlineKeyboardButton("Домой", callback_data="home")
-    )
+    keyboard = client_card_keyboard(server_id, username)
 
     main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
     main_message_id = user_main_messages.get(admin, {}).get('message_id')
@@ -837,56 +1037,44 @@ async def list_users_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
-        return
+    if callback_query.data.startswith('list_users_'):
+        server_id = await resolve_server_callback(callback_query, callback_query.data[len('list_users_'):])
+        if server_id is None:
+            return
+    else:
+        server_id = get_selected_server()
+        if not await check_server(callback_query, server_id):
+            return
 
-    clients = db.get_client_list(server_id=current_server)
+    snapshot = await db.get_server_snapshot(server_id=server_id)
+    clients = snapshot.clients if snapshot else []
     if not clients:
         await callback_query.answer("Список пользователей пуст.", show_alert=True)
         return
 
-    active_clients = db.get_active_list(server_id=current_server)
-    active_clients_dict = {}
-    for client in active_clients:
-        if isinstance(client, dict):
-            username = client.get('name')
-            last_handshake = client.get('last_handshake', 'never')
-        else:
-            username = client[0] if isinstance(client, (list, tuple)) else str(client)
-            last_handshake = 'never'
-        if username:
-            active_clients_dict[username] = last_handshake
+    active_clients_dict = {client.get('name'): client.get('latest_handshake', 0) for client in snapshot.active_clients}
 
     keyboard = InlineKeyboardMarkup(row_width=2)
     now = datetime.now(pytz.UTC)
 
     for client in clients:
         username = client[0]  
-        last_handshake_str = active_clients_dict.get(username)
-        if last_handshake_str and last_handshake_str.lower() not in ['never', 'нет данных', '-']:
-            try:
-                last_handshake_dt = parse_relative_time(last_handshake_str)
-                if last_handshake_dt:
-                    delta = now - last_handshake_dt
-                    delta_days = delta.days
-                    if delta_days <= 5:
-                        status_display = f"💻({delta_days}d) {username}"
-                    else:
-                        status_display = f"❌({delta_days}d) {username}"
-                else:
-                    status_display = f"🚫(?d) {username}"
-            except ValueError:
-                logger.error(f"Некорректный формат даты для пользователя {username}: {last_handshake_str}")
-                status_display = f"🚫(?d) {username}"
+        last_handshake_dt = handshake_to_datetime(active_clients_dict.get(username, 0))
+        if last_handshake_dt:
+            delta_days = (now - last_handshake_dt).days
+            if delta_days <= 5:
+                status_display = f"💻({delta_days}d) {username}"
+            else:
+                status_display = f"❌({delta_days}d) {username}"
         else:
             status_display = f"🚫(?d) {username}"
 
         keyboard.insert(InlineKeyboardButton(
             status_display,
-            callback_data=f"client_{username}"
+            callback_data=make_callback("client_", callback_token(server_id), callback_token(username))
         ))
 
+    keyboard.add(InlineKeyboardButton("🗑 Удалить несколько", callback_data=make_callback("bulk_delete_", callback_token(server_id))))
     keyboard.add(InlineKeyboardButton("Домой", callback_data="home"))
 
     main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
@@ -897,7 +1085,7 @@ async def list_users_callback(callback_query: types.CallbackQuery):
             await bot.edit_message_text(
                 chat_id=main_chat_id,
                 message_id=main_message_id,
-                text=f"Выберите пользователя\nТекущий сервер: *{current_server}*",
+                text=f"Выберите пользователя\nТекущий сервер: *{server_id}*",
                 reply_markup=keyboard,
                 parse_mode='MarkDown'
             )
@@ -906,7 +1094,7 @@ async def list_users_callback(callback_query: types.CallbackQuery):
             await callback_query.answer("Ошибка при обновлении сообщения.", show_alert=True)
     else:
         sent_message = await callback_query.message.reply(
-            f"Выберите пользователя\nТекущий сервер: *{current_server}*",
+            f"Выберите пользователя\nТекущий сервер: *{server_id}*",
             reply_markup=keyboard,
             parse_mode='MarkDown'
         )
@@ -925,50 +1113,167 @@ async def list_users_callback(callback_query: types.CallbackQuery):
 
     await callback_query.answer()
 
+def get_bulk_delete_selection(server_id):
+    session = user_main_messages.setdefault(admin, {})
+    if session.get('bulk_delete_server') != server_id:
+        session['bulk_delete_server'] = server_id
+        session['bulk_delete'] = set()
+    return session.setdefault('bulk_delete', set())
+
+async def show_bulk_delete_menu(callback_query: types.CallbackQuery, server_id):
+    clients = await db.get_client_list(server_id=server_id)
+    selected = get_bulk_delete_selection(server_id)
+    selected.intersection_update(client[0] for client in clients)
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    for client in clients:
+        username = client[0]
+        keyboard.insert(InlineKeyboardButton(
+            f"{'☑️' if username in selected else '⬜'} {username}",
+            callback_data=make_callback("bulk_toggle_", callback_token(server_id), callback_token(username))
+        ))
+    if selected:
+        keyboard.add(InlineKeyboardButton(f"🗑 Удалить выбранных ({len(selected)})", callback_data=make_callback("bulk_confirm_", callback_token(server_id))))
+    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data=make_callback("list_users_", callback_token(server_id))))
+    await bot.edit_message_text(
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        text=f"Отметьте пользователей для удаления\nТекущий сервер: *{server_id}*",
+        reply_markup=keyboard,
+        parse_mode='MarkDown'
+    )
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_delete_'))
+async def bulk_delete_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('bulk_delete_'):])
+    if server_id is None:
+        return
+    get_bulk_delete_selection(server_id).clear()
+    await show_bulk_delete_menu(callback_query, server_id)
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_toggle_'))
+async def bulk_toggle_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    target = await parse_client_callback(callback_query, 'bulk_toggle_')
+    if target is None:
+        return
+    server_id, username = target
+    selected = get_bulk_delete_selection(server_id)
+    if username in selected:
+        selected.discard(username)
+    else:
+        selected.add(username)
+    await show_bulk_delete_menu(callback_query, server_id)
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_confirm_'))
+async def bulk_delete_confirm_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('bulk_confirm_'):])
+    if server_id is None:
+        return
+    selected = get_bulk_delete_selection(server_id)
+    if not selected:
+        await callback_query.answer("Не выбрано ни одного пользователя.", show_alert=True)
+        return
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("✅ Да, удалить", callback_data=make_callback("bulk_execute_", callback_token(server_id))),
+        InlineKeyboardButton("❌ Отмена", callback_data=make_callback("bulk_back_", callback_token(server_id)))
+    )
+    await bot.edit_message_text(
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        text=f"⚠️ Вы уверены, что хотите удалить пользователей сервера *{server_id}* ({len(selected)}):\n*{', '.join(sorted(selected))}*?\n\nЭто действие нельзя отменить!",
+        parse_mode="MarkDown",
+        reply_markup=keyboard
+    )
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_back_'))
+async def bulk_delete_back_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('bulk_back_'):])
+    if server_id is None:
+        return
+    await show_bulk_delete_menu(callback_query, server_id)
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_execute_'))
+async def bulk_delete_execute_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('bulk_execute_'):])
+    if server_id is None:
+        return
+    selected = set(get_bulk_delete_selection(server_id))
+    user_main_messages[admin].pop('bulk_delete', None)
+    user_main_messages[admin].pop('bulk_delete_server', None)
+    if not selected:
+        await callback_query.answer("Не выбрано ни одного пользователя.", show_alert=True)
+        return
+    await callback_query.answer("Удаляю пользователей...")
+    removed = await db.bulk_remove_clients(sorted(selected), server_id=server_id)
+    if removed:
+        confirmation_text = f"Удалено пользователей: **{len(removed)}**."
+    else:
+        confirmation_text = "Не удалось удалить пользователей."
+    failed = sorted(selected - set(removed))
+    if failed:
+        confirmation_text += f"\nНе удалены: {', '.join(failed)}"
+    await bot.edit_message_text(
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        text=confirmation_text,
+        parse_mode="MarkDown",
+        reply_markup=main_menu_markup
+    )
+
 @dp.callback_query_handler(lambda c: c.data.startswith('connections_'))
 async def client_connections_callback(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+    target = await parse_client_callback(callback_query, 'connections_')
+    if target is None:
         return
-        
-    _, username = callback_query.data.split('connections_', 1)
-    username = username.strip()
+    server_id, username = target
     file_path = os.path.join('files', 'connections', f'{username}_ip.json')
     
     os.makedirs(os.path.join('files', 'connections'), exist_ok=True)
     
     try:
-        active_clients = db.get_active_list(server_id=current_server)
+        active_clients = await db.get_active_list(server_id=server_id)
         active_info = next((client for client in active_clients if isinstance(client, dict) and client.get('name') == username), None)
         
         if active_info and active_info.get('endpoint'):
-            last_handshake_str = active_info.get('last_handshake', 'never')
-            if last_handshake_str.lower() not in ['never', 'нет данных', '-']:
-                try:
-                    last_handshake_dt = parse_relative_time(last_handshake_str)
-                    if last_handshake_dt:
-                        delta = datetime.now(pytz.UTC) - last_handshake_dt
-                        if delta <= timedelta(minutes=1):
-                            endpoint = active_info['endpoint'].split(':')[0]
-                            current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
-                            
-                            if os.path.exists(file_path):
-                                async with aiofiles.open(file_path, 'r') as f:
-                                    data = json.loads(await f.read())
-                            else:
-                                data = {}
-
-                            if endpoint not in data:
-                                data[endpoint] = current_time
-                            
-                            async with aiofiles.open(file_path, 'w') as f:
-                                await f.write(json.dumps(data))
-                except ValueError:
-                    logger.error(f"Некорректный формат времени последнего подключения: {last_handshake_str}")
+            last_handshake_dt = handshake_to_datetime(active_info.get('latest_handshake', 0))
+            if last_handshake_dt and datetime.now(pytz.UTC) - last_handshake_dt <= timedelta(minutes=1):
+                endpoint = active_info['endpoint'].split(':')[0]
+                current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
+                
+                if os.path.exists(file_path):
+                    async with aiofiles.open(file_path, 'r') as f:
+                        data = json.loads(await f.read())
+                else:
+                    data = {}
+
+                if endpoint not in data:
+                    data[endpoint] = current_time
+                
+                async with aiofiles.open(file_path, 'w') as f:
+                    await f.write(json.dumps(data))
 
         if os.path.exists(file_path):
             async with aiofiles.open(file_path, 'r') as f:
@@ -977,8 +1282,8 @@ async def client_connections_callback(callback_query: types.CallbackQuery):
             sorted_connections = sorted(data.items(), key=lambda x: datetime.strptime(x[1], '%d.%m.%Y %H:%M'), reverse=True)
             
             text = f"Подключения пользователя {username} за последние 24 часа:\n\n"
-            for i, (ip, time) in enumerate(sorted_connections, 1):
-                connection_time = datetime.strptime(time, '%d.%m.%Y %H:%M')
+            for i, (ip, connected_at) in enumerate(sorted_connections, 1):
+                connection_time = datetime.strptime(connected_at, '%d.%m.%Y %H:%M')
                 isp_info = await get_isp_info(ip)
                 if datetime.now() - connection_time <= timedelta(days=1):
                     text += f"{i}. {ip} ({isp_info}) - {connection_time}\n"
@@ -987,7 +1292,7 @@ async def client_connections_callback(callback_query: types.CallbackQuery):
                 
         keyboard = InlineKeyboardMarkup(row_width=2)
         keyboard.add(
-            InlineKeyboardButton("⬅️ Назад", callback_data=f"client_{username}"),
+            InlineKeyboardButton("⬅️ Назад", callback_data=make_callback("client_", callback_token(server_id), callback_token(username))),
             InlineKeyboardButton("Домой", callback_data="home"))
 
         await callback_query.message.edit_text(text, reply_markup=keyboard)
@@ -996,19 +1301,53 @@ async def client_connections_callback(callback_query: types.CallbackQuery):
         logger.error(f"Ошибка при обработке подключений: {e}")
         await callback_query.answer("Произошла ошибка при получении данных о подключениях.", show_alert=True) 
         
+@dp.callback_query_handler(lambda c: c.data.startswith('traffic_history_'))
+async def traffic_history_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+
+    target = await parse_client_callback(callback_query, 'traffic_history_')
+    if target is None:
+        return
+    server_id, username = target
+    snapshot = await db.get_server_snapshot(server_id=server_id)
+    client_info = next((c for c in (snapshot.clients if snapshot else []) if c[0] == username), None)
+    if not client_info:
+        await callback_query.answer("Ошибка: пользователь не найден.", show_alert=True)
+        return
+
+    try:
+        hourly = format_usage_series(server_id, client_info[1], 24, 24, '%H:%M')
+        daily = format_usage_series(server_id, client_info[1], 7 * 24, 7, '%d.%m')
+    except Exception as e:
+        logger.error(f"Ошибка при получении истории трафика {username} на сервере {server_id}: {e}")
+        await callback_query.answer("Произошла ошибка при получении истории трафика.", show_alert=True)
+        return
+
+    text = f"Трафик пользователя {username}\n\nЗа 24 часа по часам:\n"
+    text += "\n".join(hourly) if hourly else "нет данных"
+    text += "\n\nЗа 7 дней по дням:\n"
+    text += "\n".join(daily) if daily else "нет данных"
+
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("⬅️ Назад", callback_data=make_callback("client_", callback_token(server_id), callback_token(username))),
+        InlineKeyboardButton("Домой", callback_data="home"))
+    await callback_query.message.edit_text(text, reply_markup=keyboard)
+    await callback_query.answer()
+
 @dp.callback_query_handler(lambda c: c.data.startswith('ip_info_'))
 async def ip_info_callback(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+    target = await parse_client_callback(callback_query, 'ip_info_')
+    if target is None:
         return
-        
-    _, username = callback_query.data.split('ip_info_', 1)
-    username = username.strip()
-    active_clients = db.get_active_list(server_id=current_server)
+    server_id, username = target
+    active_clients = await db.get_active_list(server_id=server_id)
     active_info = next((ac for ac in active_clients if ac.get('name') == username), None)
     if active_info:
         endpoint = active_info.get('endpoint', '')
@@ -1037,7 +1376,7 @@ async def ip_info_callback(callback_query: types.CallbackQuery):
         info_text += f"{key.capitalize()}: {value}\n"
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("⬅️ Назад", callback_data=f"client_{username}"),
+        InlineKeyboardButton("⬅️ Назад", callback_data=make_callback("client_", callback_token(server_id), callback_token(username))),
         InlineKeyboardButton("Домой", callback_data="home")
     )
     main_chat_id = user_main_messages.get(admin, {}).get('chat_id')
@@ -1066,17 +1405,20 @@ async def confirm_delete_user_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
     
-    username = callback_query.data.split('confirm_delete_user_')[1]
+    target = await parse_client_callback(callback_query, 'confirm_delete_user_')
+    if target is None:
+        return
+    server_id, username = target
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("✅ Да, удалить", callback_data=f"delete_user_{username}"),
-        InlineKeyboardButton("❌ Отмена", callback_data=f"list_users")
+        InlineKeyboardButton("✅ Да, удалить", callback_data=make_callback("delete_user_", callback_token(server_id), callback_token(username))),
+        InlineKeyboardButton("❌ Отмена", callback_data=make_callback("list_users_", callback_token(server_id)))
     )
     
     await bot.edit_message_text(
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
-        text=f"⚠️ Вы уверены, что хотите удалить пользователя *{username}*?\n\nЭто действие нельзя отменить!",
+        text=f"⚠️ Вы уверены, что хотите удалить пользователя *{username}* с сервера *{server_id}*?\n\nЭто действие нельзя отменить!",
         parse_mode="MarkDown",
         reply_markup=keyboard
     )
@@ -1088,31 +1430,12 @@ async def client_delete_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+    target = await parse_client_callback(callback_query, 'delete_user_')
+    if target is None:
         return
-        
-    username = callback_query.data.split('delete_user_')[1]
-    success = db.deactive_user_db(username, server_id=current_server)
+    server_id, username = target
+    success = await db.deactive_user_db(username, server_id=server_id)
     if success:
-        db.remove_user_expiration(username, server_id=current_server)
-        try:
-            scheduler.remove_job(job_id=username)
-        except:
-            pass
-        user_dir = os.path.join('users', username)
-        try:
-            if os.path.exists(user_dir):
-                shutil.rmtree(user_dir)
-        except Exception as e:
-            logger.error(f"Ошибка при удалении директории для пользователя {username}: {e}")
-            
-        connections_file = os.path.join('files', 'connections', f'{username}_ip.json')
-        try:
-            if os.path.exists(connections_file):
-                os.remove(connections_file)
-        except Exception as e:
-            logger.error(f"Ошибка при удалении файла подключений для пользователя {username}: {e}")
         confirmation_text = f"Пользователь **{username}** успешно удален."
     else:
         confirmation_text = f"Не удалось удалить пользователя **{username}**."
@@ -1142,8 +1465,8 @@ async def manage_servers_callback(callback_query: types.CallbackQuery):
     
     for server in servers:
         keyboard.insert(InlineKeyboardButton(
-            f"{'✅ ' if server == current_server else ''}{server}",
-            callback_data=f"select_server_{server}"
+            f"{'✅ ' if server == get_selected_server() else ''}{server}",
+            callback_data=make_callback("select_server_", callback_token(server))
         ))
     
     keyboard.add(InlineKeyboardButton("Добавить сервер", callback_data="add_server"))
@@ -1165,9 +1488,11 @@ async def select_server_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
     
-    server_id = callback_query.data.split('select_server_')[1]
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('select_server_'):])
+    if server_id is None:
+        return
     
-    if update_server_settings(server_id):
+    if select_server(server_id):
         await callback_query.answer(f"Выбран сервер: {server_id}")
         await manage_servers_callback(callback_query)
     else:
@@ -1218,7 +1543,7 @@ async def delete_server_callback(callback_query: types.CallbackQuery):
     for server in servers:
         keyboard.insert(InlineKeyboardButton(
             f"🗑 {server}",
-            callback_data=f"confirm_delete_server_{server}"
+            callback_data=make_callback("confirm_delete_server_", callback_token(server))
         ))
     
     keyboard.add(InlineKeyboardButton("Отмена", callback_data="manage_servers"))
@@ -1238,10 +1563,12 @@ async def confirm_delete_server_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
     
-    server_id = callback_query.data.split('confirm_delete_server_')[1]
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('confirm_delete_server_'):])
+    if server_id is None:
+        return
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("✅ Да, удалить", callback_data=f"delete_server_confirmed_{server_id}"),
+        InlineKeyboardButton("✅ Да, удалить", callback_data=make_callback("delete_server_confirmed_", callback_token(server_id))),
         InlineKeyboardButton("❌ Отмена", callback_data="manage_servers")
     )
     
@@ -1260,11 +1587,13 @@ async def delete_server_confirmed_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
     
-    server_id = callback_query.data.split('delete_server_confirmed_')[1]
-    
-    if server_id == current_server:
-        update_server_settings(None)
+    server_id = await resolve_server_callback(callback_query, callback_query.data[len('delete_server_confirmed_'):])
+    if server_id is None:
+        return
     
+    if server_id == get_selected_server():
+        selected_servers.pop(admin, None)
+
     success = db.remove_server(server_id)
     
     if success:
@@ -1315,19 +1644,19 @@ async def return_home(callback_query: types.CallbackQuery):
             await bot.edit_message_text(
                 chat_id=main_chat_id,
                 message_id=main_message_id,
-                text=f"Выберите действие\nТекущий сервер: *{current_server}*",
+                text=f"Выберите действие\nТекущий сервер: *{get_selected_server()}*",
                 reply_markup=main_menu_markup,
                 parse_mode='MarkDown'
             )
         except:
-            sent_message = await callback_query.message.reply(f"Выберите действие\nТекущий сервер: *{current_server}*", reply_markup=main_menu_markup)
+            sent_message = await callback_query.message.reply(f"Выберите действие\nТекущий сервер: *{get_selected_server()}*", reply_markup=main_menu_markup)
             user_main_messages[admin] = {'chat_id': sent_message.chat.id, 'message_id': sent_message.message_id}
             try:
                 await bot.pin_chat_message(chat_id=sent_message.chat.id, message_id=sent_message.message_id, disable_notification=True)
             except:
                 pass
     else:
-        sent_message = await callback_query.message.reply(f"Выберите действие\nТекущий сервер: *{current_server}*", reply_markup=main_menu_markup)
+        sent_message = await callback_query.message.reply(f"Выберите действие\nТекущий сервер: *{get_selected_server()}*", reply_markup=main_menu_markup)
         user_main_messages[admin] = {'chat_id': sent_message.chat.id, 'message_id': sent_message.message_id}
         try:
             await bot.pin_chat_message(chat_id=sent_message.chat.id, message_id=sent_message.message_id, disable_notification=True)
@@ -1341,11 +1670,10 @@ async def send_user_config(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
+    target = await parse_client_callback(callback_query, 'send_config_')
+    if target is None:
         return
-    _, username = callback_query.data.split('send_config_', 1)
-    username = username.strip()
+    server_id, username = target
     sent_messages = []
     try:
         user_dir = os.path.join('users', username)
@@ -1365,15 +1693,9 @@ async def send_user_config(callback_query: types.CallbackQuery):
                 caption = f"{instruction_text}\n{key_message}"
             else:
                 caption = "VPN ключ не был сгенерирован."
-            with open(conf_path, 'rb') as config:
-                sent_doc = await bot.send_document(
-                    admin,
-                    config,
-                    caption=caption,
-                    parse_mode="MarkDown",
-                    disable_notification=True
-                )
-                sent_messages.append(sent_doc.message_id)
+            sent_doc = await send_client_config(username, conf_path, caption)
+            sent_messages.append(sent_doc.message_id)
+            sent_messages.extend(await send_config_qr_codes(username, conf_path, vpn_key))
         else:
             confirmation_text = f"Не удалось создать конфигурацию для пользователя **{username}**."
             sent_message = await bot.send_message(admin, confirmation_text, parse_mode="MarkDown", disable_notification=True)
@@ -1404,12 +1726,13 @@ async def send_user_config(callback_query: types.CallbackQuery):
     for message_id in sent_messages:
         asyncio.create_task(delete_message_after_delay(admin, message_id, delay=15))
         
-    clients = db.get_client_list(server_id=current_server)
+    snapshot = await db.get_server_snapshot(server_id=server_id)
+    clients = snapshot.clients if snapshot else []
     client_info = next((c for c in clients if c[0] == username), None)
     
     if client_info:
-        expiration_time = db.get_user_expiration(username, server_id=current_server)
-        traffic_limit = db.get_user_traffic_limit(username, server_id=current_server)
+        expiration_time = db.get_user_expiration(username, server_id=server_id)
+        traffic_limit = db.get_user_traffic_limit(username, server_id=server_id)
         status = "🔴 Offline"
         incoming_traffic = "↓—"
         outgoing_traffic = "↑—"
@@ -1417,37 +1740,21 @@ async def send_user_config(callback_query: types.CallbackQuery):
         total_bytes = 0
         formatted_total = "0.00B"
 
-        active_clients = db.get_active_list(server_id=current_server)
-        active_info = None
-        for ac in active_clients:
-            if isinstance(ac, dict) and ac.get('name') == username:
-                active_info = ac
-                break
-            elif isinstance(ac, (list, tuple)) and ac[0] == username:
-                active_info = {'name': ac[0], 'last_handshake': ac.get(1, 'never'), 'transfer': ac.get(2, '0/0')}
-                break
+        active_info = next((ac for ac in snapshot.active_clients if ac.get('name') == username), None)
+        last_handshake_dt = None
 
         if active_info:
-            last_handshake_str = active_info.get('last_handshake', 'never')
-            if last_handshake_str.lower() not in ['never', 'нет данных', '-']:
-                try:
-                    last_handshake_dt = parse_relative_time(last_handshake_str)
-                    if last_handshake_dt:
-                        delta = datetime.now(pytz.UTC) - last_handshake_dt
-                        if delta <= timedelta(minutes=3):
-                            status = "🟢 Online"
-                        else:
-                            status = "🔴 Offline"
-
-                    transfer = active_info.get('transfer', '0/0')
-                    incoming_bytes, outgoing_bytes = parse_transfer(transfer)
-                    incoming_traffic = f"↓{humanize_bytes(incoming_bytes)}"
-                    outgoing_traffic = f"↑{humanize_bytes(outgoing_bytes)}"
-                    traffic_data = await update_traffic(username, incoming_bytes, outgoing_bytes)
-                    total_bytes = traffic_data.get('total_incoming', 0) + traffic_data.get('total_outgoing', 0)
-                    formatted_total = humanize_bytes(total_bytes)
-                except ValueError:
-                    logger.error(f"Некорректный формат даты для пользователя {username}: {last_handshake_str}")
+            last_handshake_dt = handshake_to_datetime(active_info.get('latest_handshake', 0))
+            if last_handshake_dt and datetime.now(pytz.UTC) - last_handshake_dt <= timedelta(minutes=3):
+                status = "🟢 Online"
+
+            incoming_bytes = active_info.get('rx_bytes', 0)
+            outgoing_bytes = active_info.get('tx_bytes', 0)
+            incoming_traffic = f"↓{humanize_bytes(incoming_bytes)}"
+            outgoing_traffic = f"↑{humanize_bytes(outgoing_bytes)}"
+            traffic_data = read_traffic(server_id, active_info['public_key'])
+            total_bytes = traffic_data.get('total_incoming', 0) + traffic_data.get('total_outgoing', 0)
+            formatted_total = humanize_bytes(total_bytes)
 
         allowed_ips = client_info[2]
         ipv4_match = re.search(r'(\d{1,3}\.){3}\d{1,3}/\d+', allowed_ips)
@@ -1475,7 +1782,7 @@ async def send_user_config(callback_query: types.CallbackQuery):
 
         traffic_limit_display = "♾️ Неограниченно" if traffic_limit == "Неограниченно" else traffic_limit
 
-        if last_handshake_str and last_handshake_str.lower() not in ['never', 'нет данных', '-']:
+        if last_handshake_dt:
             show_last_handshake = f"{last_handshake_dt.astimezone(CURRENT_TIMEZONE).strftime('%d/%m/%Y %H:%M:%S')}"
         else:
             show_last_handshake = "❗Нет данных❗"
@@ -1493,20 +1800,8 @@ async def send_user_config(callback_query: types.CallbackQuery):
         )
 
     if client_info:
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            InlineKeyboardButton("🔎 IP info", callback_data=f"ip_info_{username}"),
-            InlineKeyboardButton("Подключения", callback_data=f"connections_{username}"),
-            InlineKeyboardButton("🔐 Получить конфигурацию", callback_data=f"send_config_{username}")
-        )
-        keyboard.add(
-            InlineKeyboardButton("Удалить", callback_data=f"confirm_delete_user_{username}")
-        )
-        keyboard.add(
-            InlineKeyboardButton("⬅️ Назад", callback_data="list_users"),
-            InlineKeyboardButton("Домой", callback_data="home")
-        )
-        
+        keyboard = client_card_keyboard(server_id, username)
+
         try:
             await bot.edit_message_text(
                 chat_id=callback_query.message.chat.id,
@@ -1525,307 +1820,397 @@ async def create_backup_callback(callback_query: types.CallbackQuery):
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
         
-    if not current_server:
-        await callback_query.answer("Сначала выберите сервер в разделе 'Управление серверами'", show_alert=True)
-        return
     date_str = datetime.now().strftime('%Y-%m-%d')
     backup_filename = f"backup_{date_str}.zip"
-    backup_filepath = os.path.join(os.getcwd(), backup_filename)
     try:
+        buffer = io.BytesIO()
         loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, create_zip, backup_filepath)
-        if os.path.exists(backup_filepath):
-            with open(backup_filepath, 'rb') as f:
-                await bot.send_document(admin, f, caption=backup_filename, disable_notification=True)
-            os.remove(backup_filepath)
-        else:
-            logger.error(f"Бекап файл не создан: {backup_filepath}")
-            await bot.send_message(admin, "Не удалось создать бекап.", disable_notification=True)
+        await loop.run_in_executor(None, create_zip, buffer)
+        buffer.seek(0)
+        await bot.send_document(admin, types.InputFile(buffer, filename=backup_filename), caption=backup_filename, disable_notification=True)
     except Exception as e:
         logger.error(f"Ошибка при создании бекапа: {e}")
         await bot.send_message(admin, "Не удалось создать бекап.", disable_notification=True)
     await callback_query.answer()
 
-def parse_transfer(transfer_str):
-    try:
-        if '/' in transfer_str:
-            incoming, outgoing = transfer_str.split('/')
-            incoming = incoming.strip()
-            outgoing = outgoing.strip()
-            incoming_match = re.match(r'([\d.]+)\s*(\w+)', incoming)
-            outgoing_match = re.match(r'([\d.]+)\s*(\w+)', outgoing)
-            def convert_to_bytes(value, unit):
-                size_map = {
-                    'B': 1,
-                    'KB': 10**3,
-                    'KiB': 1024,
-                    'MB': 10**6,
-                    'MiB': 1024**2,
-                    'GB': 10**9,
-                    'GiB': 1024**3,
-                }
-                return float(value) * size_map.get(unit, 1)
-            incoming_bytes = convert_to_bytes(*incoming_match.groups()) if incoming_match else 0
-            outgoing_bytes = convert_to_bytes(*outgoing_match.groups()) if outgoing_match else 0
-            return incoming_bytes, outgoing_bytes
-        else:
-            parts = re.split(r'[/,]', transfer_str)
-            if len(parts) >= 2:
-                incoming = parts[0].strip()
-                outgoing = parts[1].strip()
-                incoming_match = re.match(r'([\d.]+)\s*(\w+)', incoming)
-                outgoing_match = re.match(r'([\d.]+)\s*(\w+)', outgoing)
-                def convert_to_bytes(value, unit):
-                    size_map = {
-                        'B': 1,
-                        'KB': 10**3,
-                        'KiB': 1024,
-                        'MB': 10**6,
-                        'MiB': 1024**2,
-                        'GB': 10**9,
-                        'GiB': 1024**3,
-                    }
-                    return float(value) * size_map.get(unit, 1)
-                incoming_bytes = convert_to_bytes(*incoming_match.groups()) if incoming_match else 0
-                outgoing_bytes = convert_to_bytes(*outgoing_match.groups()) if outgoing_match else 0
-                return incoming_bytes, outgoing_bytes
-            else:
-                return 0, 0
-    except Exception as e:
-        logger.error(f"Ошибка при парсинге трафика: {e}")
-        return 0, 0
-
 def humanize_bytes(bytes_value):
     return humanize.naturalsize(bytes_value, binary=False)
 
-async def read_traffic(username, server_id='default'):
-    traffic_file = os.path.join('users', username, f'traffic_{server_id}.json')
-    os.makedirs(os.path.dirname(traffic_file), exist_ok=True)
-    if not os.path.exists(traffic_file):
-        traffic_data = {
-            "total_incoming": 0,
-            "total_outgoing": 0,
-            "last_incoming": 0,
-            "last_outgoing": 0
-        }
-        async with aiofiles.open(traffic_file, 'w') as f:
-            await f.write(json.dumps(traffic_data))
-        return traffic_data
-    else:
-        async with aiofiles.open(traffic_file, 'r') as f:
-            content = await f.read()
-            try:
-                traffic_data = json.loads(content)
-                return traffic_data
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка при чтении traffic.json для пользователя {username}. Инициализация заново.")
-                traffic_data = {
-                    "total_incoming": 0,
-                    "total_outgoing": 0,
-                    "last_incoming": 0,
-                    "last_outgoing": 0
-                }
-                async with aiofiles.open(traffic_file, 'w') as f_write:
-                    await f_write.write(json.dumps(traffic_data))
-                return traffic_data
-
-async def update_traffic(username, incoming_bytes, outgoing_bytes, server_id='default'):
-    traffic_data = await read_traffic(username, server_id)
-    delta_incoming = incoming_bytes - traffic_data.get('last_incoming', 0)
-    delta_outgoing = outgoing_bytes - traffic_data.get('last_outgoing', 0)
-    if delta_incoming < 0:
-        delta_incoming = 0
-    if delta_outgoing < 0:
-        delta_outgoing = 0
-    traffic_data['total_incoming'] += delta_incoming
-    traffic_data['total_outgoing'] += delta_outgoing
-    traffic_data['last_incoming'] = incoming_bytes
-    traffic_data['last_outgoing'] = outgoing_bytes
-    traffic_file = os.path.join('users', username, f'traffic_{server_id}.json')
-    async with aiofiles.open(traffic_file, 'w') as f:
-        await f.write(json.dumps(traffic_data))
-    return traffic_data
+def read_traffic(server_id, public_key):
+    return traffic_store.get_store().get_traffic(server_id, public_key)
+
+def read_recent_usage(server_id, public_key, hours=24):
+    now = time.time()
+    usage = traffic_store.get_store().get_usage(server_id, now - hours * 3600, now, public_key=public_key).get(public_key)
+    return usage['incoming'] + usage['outgoing'] if usage else 0
+
+def format_usage_series(server_id, public_key, hours, points, time_format):
+    """Строки «время ↓входящий ↑исходящий» по корзинам за последние hours часов."""
+    now = time.time()
+    resolution, series = traffic_store.get_store().get_series(server_id, public_key, now - hours * 3600, now, max_points=points)
+    lines = []
+    for bucket, incoming, outgoing in series:
+        started = datetime.fromtimestamp(bucket, CURRENT_TIMEZONE).strftime(time_format)
+        lines.append(f"{started}  ↓{humanize_bytes(incoming)} ↑{humanize_bytes(outgoing)}")
+    return lines
+
+def update_traffic(server_id, active_clients, sampled_at=None):
+    """
+    Записывает счётчики из дампа wg одной транзакцией, возвращает {публичный ключ: счётчики}.
+    sampled_at - время снятия дампа; выборки старше уже записанных пропускаются.
+    """
+    samples = [
+        (client['public_key'], client.get('name'), client.get('rx_bytes', 0), client.get('tx_bytes', 0))
+        for client in active_clients
+    ]
+    return traffic_store.get_store().record_samples(server_id, samples, sampled_at=sampled_at)
 
-async def update_all_clients_traffic():
-    if not current_server:
-        logger.info("Сервер не выбран, пропуск обновления трафика")
-        return
-        
-    logger.info(f"Начало обновления трафика для всех клиентов на сервере {current_server}")
-    active_clients = db.get_active_list(server_id=current_server)
-    for client in active_clients:
+def migrate_traffic_files(snapshots, all_servers=True):
+    """
+    Переносит JSON-счётчики трафика в базу. Старый общий users/<имя>/traffic.json
+    не привязан к серверу, поэтому отдаётся только если клиент с таким именем есть
+    ровно на одном сервере и состояние получено со всех серверов.
+    """
+    name_counts = {}
+    for snapshot in snapshots.values():
+        for client in snapshot.clients:
+            name_counts[client[0]] = name_counts.get(client[0], 0) + 1
+    for server_id, snapshot in snapshots.items():
+        clients = {client[0]: client[1] for client in snapshot.clients}
+        legacy_names = {name for name in clients if name_counts[name] == 1} if all_servers else set()
+        try:
+            traffic_store.get_store().import_json_files(server_id, clients, users_dir='users', legacy_names=legacy_names)
+        except Exception as e:
+            logger.error(f"Ошибка переноса счётчиков трафика сервера {server_id}: {e}")
+
+async def fetch_traffic_snapshot(server_id, semaphore):
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            snapshot = await asyncio.wait_for(
+                db.get_server_snapshot(server_id=server_id, max_age=0),
+                TRAFFIC_POLL_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            snapshot = None
+            logger.error(f"Сервер {server_id} не ответил за {TRAFFIC_POLL_TIMEOUT} с, пропуск обновления трафика")
+        except Exception as e:
+            snapshot = None
+            logger.error(f"Ошибка получения состояния сервера {server_id}: {e}")
+        latency = time.monotonic() - started
+        logger.info(f"Опрос сервера {server_id}: {latency * 1000:.0f} мс")
+        return server_id, snapshot, latency
+
+async def account_server_traffic(server_id, snapshot):
+    counters = update_traffic(server_id, snapshot.active_clients, sampled_at=snapshot.fetched_at)
+    over_limit = []
+    for client in snapshot.active_clients:
         username = client.get('name')
-        transfer = client.get('transfer', '0/0')
-        incoming_bytes, outgoing_bytes = parse_transfer(transfer)
-        traffic_data = await update_traffic(username, incoming_bytes, outgoing_bytes, current_server)
-        logger.info(f"Обновлён трафик для пользователя {username}: Входящий {traffic_data['total_incoming']} B, Исходящий {traffic_data['total_outgoing']} B")
-        traffic_limit = db.get_user_traffic_limit(username, server_id=current_server)
+        traffic_data = counters[client['public_key']]
+        logger.debug(f"Обновлён трафик для пользователя {username} на сервере {server_id}: Входящий {traffic_data['total_incoming']} B, Исходящий {traffic_data['total_outgoing']} B")
+        traffic_limit = db.get_user_traffic_limit(username, server_id=server_id)
         if traffic_limit != "Неограниченно":
             limit_bytes = parse_traffic_limit(traffic_limit)
             total_bytes = traffic_data.get('total_incoming', 0) + traffic_data.get('total_outgoing', 0)
             if total_bytes >= limit_bytes:
-                await deactivate_user(username)
-    logger.info("Завершено обновление трафика для всех клиентов.")
+                over_limit.append(username)
+    if over_limit:
+        await deactivate_over_limit_users(server_id, over_limit)
+
+async def update_all_clients_traffic():
+    servers = db.get_server_list()
+    if not servers:
+        logger.info("Нет серверов, пропуск обновления трафика")
+        return
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(TRAFFIC_POLL_CONCURRENCY)
+    results = await asyncio.gather(*(fetch_traffic_snapshot(server_id, semaphore) for server_id in servers))
+    poll_time = time.monotonic() - started
+
+    for server_id, snapshot, _ in results:
+        if snapshot is None:
+            continue
+        try:
+            await account_server_traffic(server_id, snapshot)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении трафика на сервере {server_id}: {e}")
+
+    cycle_time = time.monotonic() - started
+    failed = [server_id for server_id, snapshot, _ in results if snapshot is None]
+    slowest = max(results, key=lambda result: result[2])
+    logger.info(
+        f"Цикл обновления трафика: серверов {len(servers)}, недоступно {len(failed)}, "
+        f"опрос {poll_time:.2f} с, всего {cycle_time:.2f} с, "
+        f"самый медленный {slowest[0]} ({slowest[2]:.2f} с)"
+    )
+    if cycle_time > TRAFFIC_POLL_INTERVAL * 60:
+        logger.warning(f"Цикл обновления трафика ({cycle_time:.1f} с) длиннее интервала опроса ({TRAFFIC_POLL_INTERVAL} мин)")
+    logger.info(f"Кэш состояния серверов: {db.get_snapshot_cache_stats()}")
+
+async def send_client_config(client_name, conf_path, caption):
+    """
+    Отправляет .conf клиента. Если этот же файл уже загружался, передаётся
+    сохранённый file_id; иначе файл загружается из памяти и file_id запоминается.
+    """
+    async with aiofiles.open(conf_path, 'rb') as f:
+        data = await f.read()
+    digest = file_id_cache.content_hash(data)
+    file_id = file_ids.get(client_name, 'conf', digest)
+    if file_id:
+        try:
+            return await bot.send_document(admin, file_id, caption=caption, parse_mode="Markdown", disable_notification=True)
+        except aiogram_exceptions.BadRequest as e:
+            logger.warning(f"Сохранённый file_id конфигурации {client_name} недействителен: {e}")
+            file_ids.invalidate(client_name, 'conf')
+    document = types.InputFile(io.BytesIO(data), filename=os.path.basename(conf_path))
+    sent_doc = await bot.send_document(admin, document, caption=caption, parse_mode="Markdown", disable_notification=True)
+    file_ids.put(client_name, 'conf', digest, sent_doc.document.file_id)
+    return sent_doc
+
+async def send_config_qr_codes(client_name, conf_path, vpn_key):
+    """Отправляет QR-коды конфигурации и ключа vpn:// одним альбомом, возвращает id сообщений."""
+    try:
+        async with aiofiles.open(conf_path, 'r', encoding='utf-8') as f:
+            config_text = await f.read()
+        images = [('qr_conf', await qr_render.get_qr_png(client_name, 'conf', config_text), "QR-код конфигурации")]
+        if vpn_key:
+            images.append(('qr_key', await qr_render.get_qr_png(client_name, 'key', vpn_key), "QR-код ключа AmneziaVPN"))
+
+        async def send(use_cache):
+            media = types.MediaGroup()
+            for kind, path, caption in images:
+                file_id = file_ids.get(client_name, kind, os.path.basename(path)) if use_cache else None
+                media.attach_photo(file_id or types.InputFile(path), caption=caption)
+            return await bot.send_media_group(admin, media, disable_notification=True)
+
+        try:
+            messages = await send(use_cache=True)
+        except aiogram_exceptions.BadRequest as e:
+            logger.warning(f"Сохранённые file_id QR-кодов {client_name} недействительны: {e}")
+            messages = await send(use_cache=False)
+        for (kind, path, _), message in zip(images, messages):
+            if message.photo:
+                file_ids.put(client_name, kind, os.path.basename(path), message.photo[-1].file_id)
+        return [message.message_id for message in messages]
+    except Exception as e:
+        logger.error(f"Ошибка при отправке QR-кодов для {conf_path}: {e}")
+        return []
 
 async def generate_vpn_key(conf_path: str) -> str:
     try:
-        process = await asyncio.create_subprocess_exec(
-            'python3.11',
-            'awg-decode.py',
-            '--encode',
-            conf_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            logger.error(f"awg-decode.py ошибка: {stderr.decode().strip()}")
-            return ""
-        vpn_key = stdout.decode().strip()
-        if vpn_key.startswith('vpn://'):
-            return vpn_key
-        else:
-            logger.error(f"awg-decode.py вернул некорректный формат: {vpn_key}")
-            return ""
+        async with aiofiles.open(conf_path, 'r', encoding='utf-8') as f:
+            data = await f.read()
+        processed = await awg_decode.process_conf_data_async(data, dns_resolver, strict=False)
+        vpn_key = awg_decode.get_cached_vpn_key(processed)
+        if vpn_key is None:
+            loop = asyncio.get_running_loop()
+            vpn_key = await loop.run_in_executor(None, awg_decode.encode_cached, processed)
+        return vpn_key
+    except ValueError as e:
+        logger.error(f"Не удалось сформировать ключ vpn:// для {conf_path}: {e}")
+        return ""
     except Exception as e:
-        logger.error(f"Ошибка при вызове awg-decode.py: {e}")
+        logger.error(f"Ошибка при формировании ключа vpn:// для {conf_path}: {e}")
         return ""
 
-async def deactivate_user(client_name: str):
-    success = db.deactive_user_db(client_name, server_id=current_server)
+async def deactivate_user(client_name: str, server_id: str):
+    success = await db.deactive_user_db(client_name, server_id=server_id)
     if success:
-        db.remove_user_expiration(client_name)
-        try:
-            scheduler.remove_job(job_id=client_name)
-        except:
-            pass
-        user_dir = os.path.join('users', client_name)
-        try:
-            if os.path.exists(user_dir):
-                shutil.rmtree(user_dir)
-        except Exception as e:
-            logger.error(f"Ошибка при удалении директории для пользователя {client_name}: {e}")
-            
-        connections_file = os.path.join('files', 'connections', f'{client_name}_ip.json')
-        try:
-            if os.path.exists(connections_file):
-                os.remove(connections_file)
-        except Exception as e:
-            logger.error(f"Ошибка при удалении файла подключений для пользователя {client_name}: {e}")
-        confirmation_text = f"Конфигурация пользователя **{client_name}** была деактивирована из-за превышения лимита трафика."
+        confirmation_text = f"Конфигурация пользователя **{client_name}** на сервере **{server_id}** была деактивирована."
         sent_message = await bot.send_message(admin, confirmation_text, parse_mode="MarkDown", disable_notification=True)
         asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
     else:
-        sent_message = await bot.send_message(admin, f"Не удалось деактивировать пользователя **{client_name}**.", parse_mode="MarkDown", disable_notification=True)
+        sent_message = await bot.send_message(admin, f"Не удалось деактивировать пользователя **{client_name}** на сервере **{server_id}**.", parse_mode="MarkDown", disable_notification=True)
         asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
 
-async def check_environment():
-    if not current_server:
-        logger.error("Сервер не выбран")
-        return False
-        
+async def check_environment(server_id):
     servers = db.load_servers()
-    if current_server not in servers:
-        logger.error(f"Сервер {current_server} не найден в конфигурации")
+    if server_id not in servers:
+        logger.error(f"Сервер {server_id} не найден в конфигурации")
         return False
-        
-    server_config = servers[current_server]
+    docker_container = servers[server_id].get('docker_container')
+    wg_config_file = servers[server_id].get('wg_config_file')
+
     try:
-        if server_config.get('is_remote') == 'true':
-            ssh = db.SSHManager(current_server)
-            if not ssh.connect():
-                logger.error("Не удалось установить SSH соединение")
-                return False
-                
-            cmd = f"docker ps --filter 'name={DOCKER_CONTAINER}' --format '{{{{.Names}}}}'"
-            output, error = ssh.execute_command(cmd)
-            if not output or DOCKER_CONTAINER not in output:
-                logger.error(f"Контейнер Docker '{DOCKER_CONTAINER}' не найден. Необходима инициализация AmneziaVPN.")
-                return False
-
-            cmd = f"docker exec {DOCKER_CONTAINER} test -f {WG_CONFIG_FILE}"
-            output, error = ssh.execute_command(cmd)
-            if error and 'No such file' in error:
-                logger.error(f"Конфигурационный файл WireGuard '{WG_CONFIG_FILE}' не найден в контейнере '{DOCKER_CONTAINER}'.")
-                return False
-        else:
-            cmd = f"docker ps --filter 'name={DOCKER_CONTAINER}' --format '{{{{.Names}}}}'"
-            container_names = subprocess.check_output(cmd, shell=True).decode().strip().split('\n')
-            if DOCKER_CONTAINER not in container_names:
-                logger.error(f"Контейнер Docker '{DOCKER_CONTAINER}' не найден. Необходима инициализация AmneziaVPN.")
-                return False
+        cmd = f"docker ps --filter 'name={docker_container}' --format '{{{{.Names}}}}'"
+        output, error = await db.run_server_command(cmd, server_id=server_id)
+        if output is None:
+            logger.error(f"Не удалось подключиться к серверу {server_id}: {error}")
+            return False
+        if docker_container not in output.strip().split('\n'):
+            logger.error(f"Контейнер Docker '{docker_container}' на сервере {server_id} не найден. Необходима инициализация AmneziaVPN.")
+            return False
 
-            cmd = f"docker exec {DOCKER_CONTAINER} test -f {WG_CONFIG_FILE}"
-            try:
-                subprocess.check_call(cmd, shell=True)
-            except subprocess.CalledProcessError:
-                logger.error(f"Конфигурационный файл WireGuard '{WG_CONFIG_FILE}' не найден в контейнере '{DOCKER_CONTAINER}'.")
-                return False
+        cmd = f"docker exec {docker_container} test -f {wg_config_file} || echo 'No such file' >&2"
+        output, error = await db.run_server_command(cmd, server_id=server_id)
+        if error and 'No such file' in error:
+            logger.error(f"Конфигурационный файл WireGuard '{wg_config_file}' не найден в контейнере '{docker_container}' на сервере {server_id}.")
+            return False
 
         return True
     except Exception as e:
-        logger.error(f"Ошибка при проверке окружения: {e}")
+        logger.error(f"Ошибка при проверке окружения сервера {server_id}: {e}")
         return False
 
 async def periodic_ensure_peer_names():
-    db.ensure_peer_names(server_id=current_server)
+    for server_id in db.get_server_list():
+        await db.ensure_peer_names(server_id=server_id)
+
+async def remove_expired_users(server_id, client_names):
+    """Удаляет пользователей с истёкшим сроком одним изменением конфигурации сервера."""
+    removed = await db.bulk_remove_clients(client_names, server_id=server_id)
+    failed = [name for name in client_names if name not in removed]
+    if failed:
+        snapshot = await db.get_server_snapshot(server_id=server_id, max_age=0)
+        if snapshot is not None:
+            existing = {client[0] for client in snapshot.clients}
+            missing = [name for name in failed if name not in existing]
+            if missing:
+                logger.info(f"Пользователи {', '.join(missing)} уже отсутствуют на сервере {server_id}, срок действия снят")
+                db.remove_users_expiration(missing, server_id=server_id)
+    return removed
+
+async def deactivate_expired_users(server_id, client_names):
+    removed = await remove_expired_users(server_id, client_names)
+    if removed:
+        logger.info(f"Истёк срок действия на сервере {server_id}, деактивированы: {', '.join(removed)}")
+        text = f"Истёк срок действия конфигураций на сервере {server_id}, деактивировано: {len(removed)}\n{', '.join(removed)}"
+        sent_message = await bot.send_message(admin, text, disable_notification=True)
+        asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
+    return removed
+
+async def deactivate_over_limit_users(server_id, client_names):
+    """Удаляет превысивших лимит трафика одним изменением конфигурации сервера."""
+    removed = await db.bulk_remove_clients(client_names, server_id=server_id)
+    failed = [name for name in client_names if name not in removed]
+    lines = []
+    if removed:
+        logger.info(f"Превышен лимит трафика на сервере {server_id}, деактивированы: {', '.join(removed)}")
+        lines.append(f"Превышен лимит трафика на сервере {server_id}, деактивировано: {len(removed)}\n{', '.join(removed)}")
+    if failed:
+        logger.error(f"Не удалось деактивировать превысивших лимит на сервере {server_id}: {', '.join(failed)}")
+        lines.append(f"Не удалось деактивировать на сервере {server_id}: {', '.join(failed)}")
+    sent_message = await bot.send_message(admin, "\n".join(lines), disable_notification=True)
+    asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
+    return removed
+
+def start_expiration_engine():
+    global expiration_engine
+    if expiration_engine is None:
+        expiration_engine = expirations.ExpirationEngine(db.get_expiration_registry(), deactivate_expired_users)
+    expiration_engine.start()
+
+async def reconcile_expired_users():
+    """
+    Снимает всех пользователей, чей срок истёк, пока бот не работал: по одному
+    изменению конфигурации на сервер и одно итоговое сообщение. После этого
+    запускается планировщик сроков, даже если синхронизация завершилась ошибкой.
+    """
+    try:
+        await _reconcile_expired_users()
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации сроков после запуска: {e}")
+    finally:
+        start_expiration_engine()
+
+async def _reconcile_expired_users():
+    registry = db.get_expiration_registry()
+    expired = {}
+    for _, server_id, client_name in registry.due(datetime.now(pytz.UTC)):
+        expired.setdefault(server_id, []).append(client_name)
+
+    if expired:
+        started = time.monotonic()
+        total = sum(len(names) for names in expired.values())
+        logger.info(f"Найдено пользователей с истёкшим сроком: {total} на серверах {', '.join(expired)}")
+        servers = list(expired)
+        results = await asyncio.gather(
+            *(remove_expired_users(server_id, expired[server_id]) for server_id in servers),
+            return_exceptions=True
+        )
+        lines = []
+        removed_total = 0
+        for server_id, result in zip(servers, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка деактивации истёкших пользователей на сервере {server_id}: {result}")
+                result = []
+            removed_total += len(result)
+            failed = [name for name in expired[server_id] if name not in result]
+            line = f"• {server_id}: деактивировано {len(result)}"
+            if failed:
+                line += f", не удалось: {', '.join(failed)}"
+            lines.append(line)
+        logger.info(f"Синхронизация сроков после запуска заняла {time.monotonic() - started:.1f} с, деактивировано {removed_total} из {total}")
+        await bot.send_message(
+            admin,
+            f"Пока бот не работал, истёк срок действия у {total} пользователей.\n" + "\n".join(lines),
+            disable_notification=True
+        )
 
 async def on_startup(dp):
     os.makedirs('files/connections', exist_ok=True)
     os.makedirs('users', exist_ok=True)
     await load_isp_cache_task()
-    
-    global current_server
-    if not current_server:
-        servers = db.get_server_list()
-        if servers:
-            current_server = servers[0]
-            if update_server_settings(current_server):
-                logger.info(f"Выбран сервер по умолчанию: {current_server}")
-            else:
-                logger.error(f"Ошибка при инициализации сервера по умолчанию: {current_server}")
-                await bot.send_message(admin, "Ошибка при инициализации сервера. Проверьте настройки в разделе 'Управление серверами'")
-                return
-        else:
-            logger.error("Не найдено ни одного сервера")
-            await bot.send_message(admin, "Не найдено ни одного сервера. Добавьте сервер через меню 'Управление серверами'")
-            return
-    
-    environment_ok = await check_environment()
-    if not environment_ok:
+    existing_clients = set(os.listdir('users'))
+    file_ids.prune(existing_clients)
+    qr_render.prune(existing_clients)
+    registry = db.get_expiration_registry()
+    if registry.unassigned:
+        await bot.send_message(
+            admin,
+            f"В expirations.json есть сроки старого формата без сервера: {', '.join(sorted(registry.unassigned))}.\n"
+            f"Они сохранены в файле, но не применяются: задайте этим пользователям срок действия на нужном сервере.",
+            disable_notification=True
+        )
+
+    servers = db.get_server_list()
+    if not servers:
+        logger.error("Не найдено ни одного сервера")
+        start_expiration_engine()
+        await bot.send_message(admin, "Не найдено ни одного сервера. Добавьте сервер через меню 'Управление серверами'")
+        return
+
+    checks = await asyncio.gather(*(check_environment(server_id) for server_id in servers))
+    ready_servers = [server_id for server_id, ok in zip(servers, checks) if ok]
+    failed_servers = [server_id for server_id, ok in zip(servers, checks) if not ok]
+    if not ready_servers:
         logger.error("Необходимо инициализировать AmneziaVPN перед запуском бота.")
         await bot.send_message(admin, "Необходимо инициализировать AmneziaVPN перед запуском бота.")
         await bot.close()
         sys.exit(1)
-    if not scheduler.running:
-        scheduler.add_job(update_all_clients_traffic, IntervalTrigger(minutes=1))
-        scheduler.add_job(periodic_ensure_peer_names, IntervalTrigger(minutes=1))
-        scheduler.start()
-        logger.info("Планировщик запущен для обновления трафика каждые 5 минут.")
-    users = db.get_users_with_expiration(server_id=current_server)
-    for user in users:
-        client_name, expiration_time, traffic_limit = user
-        if expiration_time:
-            try:
-                expiration_datetime = datetime.fromisoformat(expiration_time)
-            except ValueError:
-                logger.error(f"Некорректный формат даты для пользователя {client_name}: {expiration_time}")
-                continue
-            if expiration_datetime.tzinfo is None:
-                expiration_datetime = expiration_datetime.replace(tzinfo=pytz.UTC)
-            if expiration_datetime > datetime.now(pytz.UTC):
-                scheduler.add_job(
-                    deactivate_user,
-                    trigger=DateTrigger(run_date=expiration_datetime),
-                    args=[client_name],
-                    id=client_name
-                )
-                logger.info(f"Запланирована деактивация пользователя {client_name} на {expiration_datetime}")
-            else:
-                await deactivate_user(client_name)
+    if failed_servers:
+        await bot.send_message(admin, f"Не удалось проверить окружение серверов: {', '.join(failed_servers)}")
+    if not get_selected_server():
+        select_server(ready_servers[0])
+        logger.info(f"Выбран сервер по умолчанию: {ready_servers[0]}")
+
+    snapshots = {}
+    for server_id in ready_servers:
+        snapshot = await db.get_server_snapshot(server_id=server_id)
+        if snapshot:
+            snapshots[server_id] = snapshot
+    migrate_traffic_files(snapshots, all_servers=len(snapshots) == len(servers))
+
+    scheduler.add_job(
+        update_all_clients_traffic,
+        IntervalTrigger(minutes=TRAFFIC_POLL_INTERVAL),
+        id='update_all_clients_traffic',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    scheduler.add_job(periodic_ensure_peer_names, IntervalTrigger(minutes=1), id='periodic_ensure_peer_names', replace_existing=True)
+    logger.info("Планировщик запущен для обновления трафика каждую минуту.")
+    asyncio.create_task(reconcile_expired_users())
 
 async def on_shutdown(dp):
+    if expiration_engine is not None:
+        expiration_engine.stop()
     scheduler.shutdown()
+    db.close_ssh_pools()
+    traffic_store.close_store()
+    qr_render.shutdown()
+    db.flush_expirations()
     logger.info("Планировщик остановлен.")
 
 executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -1,16 +1,27 @@
 import os
+import re
+import shutil
 import subprocess
 import configparser
 import json
 import pytz
 import socket
 import logging
-import tempfile
 import paramiko
 import getpass
 import threading
 import time
 import bcrypt
+import asyncio
+import ipaddress
+import hashlib
+import ssh_pool
+import wgkeys
+import ipalloc
+import traffic_store
+import expirations
+import qr_render
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
 EXPIRATIONS_FILE = 'files/expirations.json'
@@ -72,6 +83,7 @@ def add_server(server_id, host, port, username, auth_type, password=None, key_pa
                 server_config['endpoint'] = output.strip()
                 servers[server_id] = server_config
                 save_servers(servers)
+        ssh.close()
     except Exception as e:
         logger.error(f"Не удалось получить endpoint для сервера {server_id}: {e}")
     
@@ -86,17 +98,12 @@ def remove_server(server_id):
 
         server_config = servers[server_id]
         
-        expirations = load_expirations()
-        for username in list(expirations.keys()):
-            if server_id in expirations[username]:
-                del expirations[username][server_id]
-                if not expirations[username]:
-                    del expirations[username]
-        save_expirations(expirations)
-
-        if server_id in SSHManager._instances:
-            SSHManager._instances[server_id].close()
-            del SSHManager._instances[server_id]
+        get_expiration_registry().remove_server(server_id)
+
+        ssh_pool.close_pool(server_id)
+        invalidate_snapshot(server_id)
+        _server_profiles.pop(server_id, None)
+        traffic_store.get_store().remove_server(server_id)
 
         del servers[server_id]
         save_servers(servers)
@@ -128,28 +135,15 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class SSHManager:
-    _instances = {}
-
-    def __new__(cls, server_id=None, *args, **kwargs):
-        if server_id not in cls._instances:
-            cls._instances[server_id] = super(SSHManager, cls).__new__(cls)
-            cls._instances[server_id].client = None
-            cls._instances[server_id].initialized = False
-        return cls._instances[server_id]
-
     def __init__(self, server_id=None, host=None, port=None, username=None, auth_type=None, password=None, key_path=None):
-        if not getattr(self, 'initialized', False):
-            self.client = None
-            self.server_id = server_id
-            self.host = host
-            self.port = port
-            self.username = username
-            self.auth_type = auth_type
-            self.key_path = key_path
-            self.password = password
-            self.initialized = True
-        if password is not None:
-            self.password = password
+        self.client = None
+        self.server_id = server_id
+        self.host = host
+        self.port = port
+        self.username = username
+        self.auth_type = auth_type
+        self.key_path = key_path
+        self.password = password
 
     def load_settings_from_config(self):
         try:
@@ -194,11 +188,6 @@ class SSHManager:
                         look_for_keys=False,
                         allow_agent=False
                     )
-                    
-                    if not hasattr(self, '_original_password'):
-                        self._original_password = self.password
-                    else:
-                        self.password = self._original_password
                 else:
                     private_key = paramiko.RSAKey.from_private_key_file(self.key_path)
                     self.client.connect(
@@ -247,40 +236,64 @@ class SSHManager:
 
 ssh_manager = SSHManager()
 
-def execute_docker_command(command, server_id=None):
+def get_ssh_pool(server_id):
+    servers = load_servers()
+    return ssh_pool.get_pool(server_id, servers.get(server_id, {}))
+
+def close_ssh_pools():
+    ssh_pool.close_all_pools()
+
+async def run_local_command(command, timeout=ssh_pool.DEFAULT_COMMAND_TIMEOUT, stdin=None):
+    if isinstance(stdin, str):
+        stdin = stdin.encode()
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(stdin), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    return stdout.decode(errors='replace'), stderr.decode(errors='replace'), process.returncode
+
+async def run_server_command(command, server_id=None, timeout=ssh_pool.DEFAULT_COMMAND_TIMEOUT, stdin=None):
     if server_id is None:
         raise Exception("Server ID is required")
     setting = get_config(server_id=server_id)
     if setting.get("is_remote") == "true":
-        try:
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            if not ssh.ensure_connection():
-                raise Exception("Не удалось установить SSH подключение")
-
-            output, error = ssh.execute_command(command)
-            if error and ('error' in error.lower() or 'command not found' in error.lower()):
-                raise Exception(error)
-            if output is None:
-                raise Exception("Failed to execute command")
-            return output
-        except Exception as e:
-            raise Exception(f"SSH command failed: {e}")
+        return await get_ssh_pool(server_id).run(command, timeout=timeout, stdin=stdin)
+    try:
+        output, error, returncode = await run_local_command(command, timeout=timeout, stdin=stdin)
+    except asyncio.TimeoutError:
+        logger.error(f"Команда не завершилась за {timeout} с: {command}")
+        return None, f"Command timed out after {timeout}s"
+    if returncode != 0 and not error:
+        error = f"Command exited with code {returncode}"
+    return output, error
+
+async def upload_to_server(data, remote_path, server_id=None):
+    setting = get_config(server_id=server_id)
+    if setting.get("is_remote") == "true":
+        await get_ssh_pool(server_id).upload(data, remote_path)
     else:
-        return subprocess.check_output(command, shell=True).decode()
+        mode = 'wb' if isinstance(data, bytes) else 'w'
+        with open(remote_path, mode) as f:
+            f.write(data)
+
+async def execute_docker_command(command, server_id=None, timeout=ssh_pool.DEFAULT_COMMAND_TIMEOUT):
+    output, error = await run_server_command(command, server_id=server_id, timeout=timeout)
+    if error and ('error' in error.lower() or 'command not found' in error.lower() or 'timed out' in error.lower()):
+        raise Exception(f"Command failed: {error}")
+    if output is None:
+        raise Exception("Failed to execute command")
+    return output
     
 def get_amnezia_container():
     try:
@@ -570,303 +583,175 @@ def get_config(path='files/setting.ini', server_id=None):
 
         return out
 
-def get_clients_from_clients_table(server_id=None):
-    if server_id is None:
-        return {}
-    setting = get_config(server_id=server_id)
-    docker_container = setting['docker_container']
-    clients_table_path = '/opt/amnezia/awg/clientsTable'
-    is_remote = setting.get('is_remote') == 'true'
-    
-    try:
-        if is_remote:
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            if not ssh.connect():
-                logger.error("Не удалось установить SSH соединение")
-                return {}
-                
-        cmd = f"docker exec -i {docker_container} cat {clients_table_path}"
-        if is_remote:
-            output, error = ssh.execute_command(cmd)
-            if error:
-                logger.error(f"Ошибка выполнения команды: {error}")
-                return {}
-            clients_table = json.loads(output or "[]")
-        else:
-            output = subprocess.check_output(cmd, shell=True).decode()
-            clients_table = json.loads(output)
-            
-        client_map = {client['clientId']: client['userData']['clientName'] for client in clients_table}
-        return client_map
-    except Exception as e:
-        logger.error(f"Ошибка при получении clientsTable: {e}")
-        return {}
+CLIENTS_TABLE_PATH = '/opt/amnezia/awg/clientsTable'
+SNAPSHOT_SEPARATOR = '----AWG-BOT-SNAPSHOT----'
 
-def parse_client_name(full_name):
-    return full_name.split('[')[0].strip()
+@dataclass
+class ServerSnapshot:
+    server_id: str
+    config: str
+    clients_table: list
+    clients: list
+    active_clients: list
+    fetched_at: float = field(default_factory=time.time)
 
-def get_client_list(server_id=None):
-    if server_id is None:
-        return []
-    setting = get_config(server_id=server_id)
-    wg_config_file = setting['wg_config_file']
-    docker_container = setting['docker_container']
-    is_remote = setting.get('is_remote') == 'true'
+    @property
+    def client_map(self):
+        return {client['clientId']: client['userData']['clientName'] for client in self.clients_table}
 
-    client_map = get_clients_from_clients_table(server_id=server_id)
+def parse_client_name(full_name):
+    return full_name.split('[')[0].strip()
 
+def parse_clients_table(content):
     try:
-        if is_remote:
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            if not ssh.connect():
-                logger.error("Не удалось установить SSH соединение")
-                return []
-        cmd = f"docker exec -i {docker_container} cat {wg_config_file}"
-        config_content = execute_docker_command(cmd, server_id=server_id)
-
-        clients = []
-        lines = config_content.splitlines()
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if line.startswith('[Peer]'):
-                client_public_key = ''
-                allowed_ips = ''
-                client_name = 'Unknown'
-                i += 1
-                while i < len(lines):
-                    peer_line = lines[i].strip()
-                    if peer_line == '':
-                        break
-                    if peer_line.startswith('#'):
-                        full_client_name = peer_line[1:].strip()
-                        client_name = parse_client_name(full_client_name)
-                    elif peer_line.startswith('PublicKey ='):
-                        client_public_key = peer_line.split('=', 1)[1].strip()
-                    elif peer_line.startswith('AllowedIPs ='):
-                        allowed_ips = peer_line.split('=', 1)[1].strip()
-                    i += 1
-                client_name = client_map.get(client_public_key, client_name if 'client_name' in locals() else 'Unknown')
-                clients.append([client_name, client_public_key, allowed_ips])
-            else:
-                i += 1
-        return clients
-    except Exception as e:
-        logger.error(f"Ошибка при получении списка клиентов: {e}")
+        clients_table = json.loads(content or "[]")
+    except json.JSONDecodeError:
+        logger.error("Ошибка при разборе clientsTable")
         return []
-
-def get_active_list(server_id=None):
-    if server_id is None:
-        return []
-    setting = get_config(server_id=server_id)
-    docker_container = setting['docker_container']
-    is_remote = setting.get('is_remote') == 'true'
-    
-    try:
-        clients = get_client_list(server_id=server_id)
-        client_key_map = {client[1]: client[0] for client in clients}
-        
-        if is_remote:
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            if not ssh.connect():
-                logger.error("Не удалось установить SSH соединение")
-                return []
-                
-        cmd = f"docker exec -i {docker_container} wg show"
-        if is_remote:
-            output, error = ssh.execute_command(cmd)
-            if error:
-                logger.error(f"Ошибка выполнения команды: {error}")
-                return []
-            wg_output = output
+    return clients_table if isinstance(clients_table, list) else []
+
+def parse_interface_section(config_content):
+    interface = {}
+    in_interface = False
+    for line in config_content.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            in_interface = line == '[Interface]'
+            continue
+        if in_interface and '=' in line and not line.startswith('#'):
+            key, value = line.split('=', 1)
+            interface[key.strip()] = value.strip()
+    return interface
+
+def parse_peers(config_content, client_map):
+    clients = []
+    lines = config_content.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if line.startswith('[Peer]'):
+            client_public_key = ''
+            allowed_ips = ''
+            client_name = 'Unknown'
+            i += 1
+            while i < len(lines):
+                peer_line = lines[i].strip()
+                if peer_line == '':
+                    break
+                if peer_line.startswith('#'):
+                    full_client_name = peer_line[1:].strip()
+                    client_name = parse_client_name(full_client_name)
+                elif peer_line.startswith('PublicKey ='):
+                    client_public_key = peer_line.split('=', 1)[1].strip()
+                elif peer_line.startswith('AllowedIPs ='):
+                    allowed_ips = peer_line.split('=', 1)[1].strip()
+                i += 1
+            client_name = client_map.get(client_public_key, client_name)
+            clients.append([client_name, client_public_key, allowed_ips])
         else:
-            wg_output = subprocess.check_output(cmd, shell=True).decode()
-        
-        active_clients = []
-        current_peer = {}
-        
-        for line in wg_output.splitlines():
-            line = line.strip()
-            if line.startswith('peer:'):
-                if current_peer and 'public_key' in current_peer and current_peer['public_key'] in client_key_map:
-                    current_peer['name'] = client_key_map[current_peer['public_key']]
-                    active_clients.append(current_peer)
-                peer_public_key = line.split('peer: ')[1].strip()
-                current_peer = {'public_key': peer_public_key}
-            elif line.startswith('endpoint:'):
-                current_peer['endpoint'] = line.split('endpoint: ')[1].strip()
-            elif line.startswith('latest handshake:'):
-                current_peer['last_handshake'] = line.split('latest handshake: ')[1].strip()
-            elif line.startswith('transfer:'):
-                current_peer['transfer'] = line.split('transfer: ')[1].strip()
-        
-        if current_peer and 'public_key' in current_peer and current_peer['public_key'] in client_key_map:
-            current_peer['name'] = client_key_map[current_peer['public_key']]
-            active_clients.append(current_peer)
-            
-        return active_clients
-    except Exception as e:
-        logger.error(f"Error getting active list: {e}")
-        return []
-
-def root_add(id_user, server_id=None, ipv6=False):
-    if server_id is None:
-        return False
+            i += 1
+    return clients
+
+def get_interface_name(wg_config_file):
+    return os.path.basename(wg_config_file).split('.')[0]
+
+APPLY_MODE_LIVE = 'live'
+APPLY_MODE_RESTART = 'restart'
+APPLY_OK_MARKER = 'awg-bot-applied'
+
+async def apply_wg_config(server_id=None):
+    """
+    Применяет уже сохранённый в контейнере wg0.conf к работающему интерфейсу.
+    В режиме live изменения пиров вносятся через wg syncconf без перезапуска
+    интерфейса, так что подключённые клиенты не отключаются; restart оставлен
+    для серверов, где syncconf недоступен.
+    """
     setting = get_config(server_id=server_id)
-    endpoint = setting['endpoint']
     wg_config_file = setting['wg_config_file']
     docker_container = setting['docker_container']
-    is_remote = setting.get('is_remote') == 'true'
-
-    clients = get_client_list(server_id=server_id)
-    client_entry = next((c for c in clients if c[0] == id_user), None)
-    if client_entry:
-        logger.info(f"Пользователь {id_user} уже существует.")
+    apply_mode = setting.get('apply_mode', APPLY_MODE_LIVE)
+
+    if apply_mode != APPLY_MODE_RESTART:
+        interface = get_interface_name(wg_config_file)
+        stripped = f"/tmp/{interface}.stripped"
+        script = (
+            f"wg-quick strip {wg_config_file} > {stripped} && "
+            f"wg syncconf {interface} {stripped} && echo {APPLY_OK_MARKER}; rm -f {stripped}"
+        )
+        output, error = await run_server_command(f"docker exec -i {docker_container} sh -c '{script}'", server_id=server_id)
+        if output is not None and APPLY_OK_MARKER in output:
+            return True
+        logger.warning(f"Не удалось применить конфигурацию сервера {server_id} без перезапуска: {error}")
+
+    await snapshot_traffic_counters(server_id)
+    output, error = await run_server_command(
+        f"docker exec -i {docker_container} sh -c 'wg-quick down {wg_config_file} && wg-quick up {wg_config_file} && echo {APPLY_OK_MARKER}'",
+        server_id=server_id
+    )
+    if not output or APPLY_OK_MARKER not in output:
+        logger.error(f"Не удалось перезапустить интерфейс сервера {server_id}: {error}")
         return False
+    return True
 
-    pwd = os.getcwd()
-    os.makedirs(f"{pwd}/users/{id_user}", exist_ok=True)
-    os.makedirs(f"{pwd}/files", exist_ok=True)
-
-    if is_remote:
+async def snapshot_traffic_counters(server_id):
+    """
+    Снимает счётчики всех пиров перед перезапуском интерфейса, чтобы трафик
+    с момента последнего опроса не потерялся при обнулении счётчиков ядра.
+    """
+    setting = get_config(server_id=server_id)
+    interface = get_interface_name(setting['wg_config_file'])
+    output, error = await run_server_command(
+        f"docker exec -i {setting['docker_container']} wg show {interface} dump",
+        server_id=server_id
+    )
+    if not output:
+        logger.error(f"Не удалось снять счётчики трафика сервера {server_id} перед перезапуском: {error}")
+        return
+    store = traffic_store.get_store()
+    client_key_map = store.get_client_names(server_id)
+    cached = _snapshot_cache.get(server_id)
+    if cached is not None:
+        client_key_map.update({client[1]: client[0] for client in cached.clients})
+    try:
+        samples = [
+            (client['public_key'], client['name'], client['rx_bytes'], client['tx_bytes'])
+            for client in parse_wg_dump(output, client_key_map)
+        ]
+        store.record_samples(server_id, samples)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения счётчиков трафика сервера {server_id}: {e}")
+
+def parse_wg_dump(dump_output, client_key_map):
+    active_clients = []
+    lines = [line for line in dump_output.splitlines() if line.strip()]
+    for line in lines[1:]:
+        fields = line.split('\t')
+        if len(fields) < 8:
+            continue
+        public_key, _, endpoint, allowed_ips, latest_handshake, rx_bytes, tx_bytes = fields[:7]
+        if public_key not in client_key_map:
+            continue
         try:
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            if not ssh.connect():
-                logger.error("Не удалось установить SSH соединение")
-                return False
-
-            output, error = ssh.execute_command(f"docker exec -i {docker_container} wg genkey")
-            if error:
-                logger.error(f"Ошибка генерации приватного ключа: {error}")
-                return False
-            private_key = output.strip()
-
-            cmd = f"echo '{private_key}' | docker exec -i {docker_container} wg pubkey"
-            output, error = ssh.execute_command(cmd)
-            if error:
-                logger.error(f"Ошибка генерации публичного ключа: {error}")
-                return False
-            client_public_key = output.strip()
-
-            output, error = ssh.execute_command(f"docker exec -i {docker_container} wg genpsk")
-            if error:
-                logger.error(f"Ошибка генерации PSK: {error}")
-                return False
-            psk = output.strip()
-
-            server_conf_path = f"{pwd}/files/server.conf"
-            output, error = ssh.execute_command(f"docker exec -i {docker_container} cat {wg_config_file}")
-            if error:
-                logger.error(f"Ошибка получения конфигурации сервера: {error}")
-                return False
-            with open(server_conf_path, 'w') as f:
-                f.write(output)
-
-            cmd = f"docker exec -i {docker_container} sh -c 'grep PrivateKey {wg_config_file} | cut -d\" \" -f 3'"
-            output, error = ssh.execute_command(cmd)
-            if error:
-                logger.error(f"Ошибка получения приватного ключа сервера: {error}")
-                return False
-            server_private_key = output.strip()
-
-            cmd = f"echo '{server_private_key}' | docker exec -i {docker_container} wg pubkey"
-            output, error = ssh.execute_command(cmd)
-            if error:
-                logger.error(f"Ошибка генерации публичного ключа сервера: {error}")
-                return False
-            server_public_key = output.strip()
-
-            if not all([private_key, client_public_key, server_public_key, psk]):
-                logger.error("Не все ключи были успешно сгенерированы")
-                return False
-
-            listen_port = None
-            additional_params = []
-            with open(server_conf_path, 'r') as f:
-                for line in f:
-                    if line.startswith('ListenPort'):
-                        listen_port = line.split('=')[1].strip()
-                    elif any(line.startswith(p) for p in ['Jc', 'Jmin', 'Jmax', 'S1', 'S2', 'H1', 'H2', 'H3', 'H4']):
-                        additional_params.append(line.strip())
-
-            if not listen_port:
-                logger.error("Не удалось получить порт сервера")
-                return False
+            active_clients.append({
+                'public_key': public_key,
+                'name': client_key_map[public_key],
+                'endpoint': endpoint if endpoint != '(none)' else None,
+                'allowed_ips': allowed_ips if allowed_ips != '(none)' else '',
+                'latest_handshake': int(latest_handshake),
+                'rx_bytes': int(rx_bytes),
+                'tx_bytes': int(tx_bytes)
+            })
+        except ValueError:
+            logger.error(f"Некорректная строка wg show dump: {line}")
+    return active_clients
 
-            octet = 2
-            client_ip = None
-            while octet <= 254:
-                ip = f"10.8.1.{octet}/32"
-                with open(server_conf_path, 'r') as f:
-                    if ip not in f.read():
-                        client_ip = ip
-                        break
-                octet += 1
-            if not client_ip:
-                logger.error("Нет свободных IP-адресов")
-                return False
+OBFUSCATION_PARAMS = ['Jc', 'Jmin', 'Jmax', 'S1', 'S2', 'H1', 'H2', 'H3', 'H4']
 
-            client_config = f"""[Interface]
-Address = {client_ip}
+CLIENT_CONFIG_TEMPLATE = """[Interface]
+Address = {address}
 DNS = 1.1.1.1, 1.0.0.1
 PrivateKey = {private_key}
-{os.linesep.join(additional_params)}
+{obfuscation}
 [Peer]
 PublicKey = {server_public_key}
 PresharedKey = {psk}
@@ -874,379 +759,611 @@ AllowedIPs = 0.0.0.0/0
 Endpoint = {endpoint}:{listen_port}
 PersistentKeepalive = 25"""
 
-            client_config_path = f"{pwd}/users/{id_user}/{id_user}.conf"
-            with open(client_config_path, 'w') as f:
-                f.write(client_config)
-
-            if not os.path.exists(client_config_path):
-                logger.error("Не удалось создать конфигурационный файл клиента")
-                return False
-
-            peer_config = f"""
-[Peer]
-# {id_user}
-PublicKey = {client_public_key}
-PresharedKey = {psk}
-AllowedIPs = {client_ip}
-"""
-            with open(server_conf_path, 'a') as f:
-                f.write(peer_config)
-
-            sftp = ssh.client.open_sftp()
-            sftp.put(server_conf_path, "/tmp/server.conf")
-            ssh.execute_command(f"docker cp /tmp/server.conf {docker_container}:{wg_config_file}")
-            ssh.execute_command(f"docker exec -i {docker_container} sh -c 'wg-quick down {wg_config_file} && wg-quick up {wg_config_file}'")
-            ssh.execute_command("rm /tmp/server.conf")
-
-            output, error = ssh.execute_command(f"docker exec -i {docker_container} cat /opt/amnezia/awg/clientsTable")
-            try:
-                clients_table = json.loads(output or "[]")
-            except json.JSONDecodeError:
-                clients_table = []
-
-            creation_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            clients_table.append({
-                "clientId": client_public_key,
-                "userData": {
-                    "clientName": id_user,
-                    "creationDate": creation_date
-                }
-            })
-
-            clients_table_path = f"{pwd}/files/clientsTable"
-            with open(clients_table_path, 'w') as f:
-                json.dump(clients_table, f)
+@dataclass
+class ServerProfile:
+    """Неизменяемые для клиентов параметры сервера, нужные для сборки .conf."""
+    server_id: str
+    interface_hash: str
+    public_key: str
+    listen_port: str
+    obfuscation: list
+    endpoint: str
+    client_subnet: str = ipalloc.DEFAULT_CLIENT_SUBNET
+    server_address: str = None
+
+    def render_client_config(self, address, private_key, psk):
+        return CLIENT_CONFIG_TEMPLATE.format(
+            address=address,
+            private_key=private_key,
+            obfuscation=os.linesep.join(f"{key} = {value}" for key, value in self.obfuscation),
+            server_public_key=self.public_key,
+            psk=psk,
+            endpoint=self.endpoint,
+            listen_port=self.listen_port
+        )
 
-            sftp.put(clients_table_path, "/tmp/clientsTable")
-            ssh.execute_command(f"docker cp /tmp/clientsTable {docker_container}:/opt/amnezia/awg/clientsTable")
-            ssh.execute_command("rm /tmp/clientsTable")
-            sftp.close()
+_server_profiles = {}
 
-            traffic_file = f"{pwd}/users/{id_user}/traffic.json"
-            with open(traffic_file, 'w') as f:
-                json.dump({
-                    "total_incoming": 0,
-                    "total_outgoing": 0,
-                    "last_incoming": 0,
-                    "last_outgoing": 0
-                }, f)
+def _interface_hash(interface, endpoint, client_subnet=None):
+    digest = hashlib.sha256(f"{endpoint}\0{client_subnet or ''}".encode())
+    for key, value in interface.items():
+        digest.update(f"\0{key}={value}".encode())
+    return digest.hexdigest()
 
-            return True
+def get_server_profile(server_id, config_content):
+    setting = get_config(server_id=server_id)
+    endpoint = setting['endpoint']
+    configured_subnet = setting.get('client_subnet')
+    interface = parse_interface_section(config_content)
+    interface_hash = _interface_hash(interface, endpoint, configured_subnet)
+    cached = _server_profiles.get(server_id)
+    if cached is not None and cached.interface_hash == interface_hash:
+        return cached
+
+    private_key = interface.get('PrivateKey')
+    listen_port = interface.get('ListenPort')
+    if not private_key:
+        logger.error(f"Не удалось получить приватный ключ сервера {server_id}")
+        return None
+    if not listen_port:
+        logger.error(f"Не удалось получить порт сервера {server_id}")
+        return None
+    try:
+        public_key = wgkeys.public_key(private_key)
+    except ValueError as e:
+        logger.error(f"Некорректный приватный ключ сервера {server_id}: {e}")
+        return None
 
-        except Exception as e:
-            logger.error(f"Ошибка при добавлении пользователя через SSH: {e}")
-            return False
-    else:
-        cmd = ["./newclient.sh", id_user, endpoint, wg_config_file, docker_container]
-        if subprocess.call(cmd) == 0:
-            return True
-        return False
+    server_address, interface_subnet = ipalloc.parse_interface_address(interface.get('Address'))
+    client_subnet = interface_subnet or ipalloc.DEFAULT_CLIENT_SUBNET
+    if configured_subnet:
+        try:
+            client_subnet = ipaddress.ip_network(configured_subnet, strict=False)
+        except ValueError:
+            logger.error(f"Некорректная подсеть клиентов {configured_subnet} для сервера {server_id}")
+            return None
+
+    profile = ServerProfile(
+        server_id=server_id,
+        interface_hash=interface_hash,
+        public_key=public_key,
+        listen_port=listen_port,
+        obfuscation=[(key, interface[key]) for key in OBFUSCATION_PARAMS if key in interface],
+        endpoint=endpoint,
+        client_subnet=str(client_subnet),
+        server_address=str(server_address) if server_address else None
+    )
+    _server_profiles[server_id] = profile
+    logger.info(f"Профиль сервера {server_id} обновлён")
+    return profile
+
+async def load_server_profile(server_id=None):
+    snapshot = await get_server_snapshot(server_id=server_id)
+    if snapshot is None:
+        return None
+    return get_server_profile(server_id, snapshot.config)
 
-def deactive_user_db(client_name, server_id=None):
+async def fetch_server_snapshot(server_id=None):
     if server_id is None:
-        return False
+        return None
     setting = get_config(server_id=server_id)
     wg_config_file = setting['wg_config_file']
     docker_container = setting['docker_container']
-    is_remote = setting.get('is_remote') == 'true'
 
-    clients = get_client_list(server_id=server_id)
-    client_entry = next((c for c in clients if c[0] == client_name), None)
-    if not client_entry:
-        logger.error(f"Пользователь {client_name} не найден в списке клиентов.")
-        return False
+    script = (
+        f"cat {wg_config_file}; echo; echo {SNAPSHOT_SEPARATOR}; "
+        f"cat {CLIENTS_TABLE_PATH} 2>/dev/null; echo; echo {SNAPSHOT_SEPARATOR}; "
+        f"wg show {get_interface_name(wg_config_file)} dump"
+    )
+    cmd = f"docker exec -i {docker_container} sh -c '{script}'"
+    try:
+        output, error = await run_server_command(cmd, server_id=server_id)
+        if output is None:
+            logger.error(f"Не удалось получить состояние сервера {server_id}: {error}")
+            return None
+        parts = output.split(f"\n{SNAPSHOT_SEPARATOR}\n")
+        if len(parts) != 3:
+            logger.error(f"Некорректный ответ сервера {server_id} при получении состояния: {error}")
+            return None
+        config_content, clients_table_content, wg_output = parts
+        if '[Interface]' not in config_content:
+            logger.error(f"Не удалось прочитать {wg_config_file} на сервере {server_id}: {error}")
+            return None
+        if error:
+            logger.warning(f"Предупреждение при получении состояния сервера {server_id}: {error.strip()}")
+        clients_table = parse_clients_table(clients_table_content.strip())
+        client_map = {client['clientId']: client['userData']['clientName'] for client in clients_table}
+        clients = parse_peers(config_content, client_map)
+        client_key_map = {client[1]: client[0] for client in clients}
+        return ServerSnapshot(
+            server_id=server_id,
+            config=config_content,
+            clients_table=clients_table,
+            clients=clients,
+            active_clients=parse_wg_dump(wg_output, client_key_map)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении состояния сервера {server_id}: {e}")
+        return None
 
-    client_public_key = client_entry[1]
+SNAPSHOT_CACHE_TTL = 10
+SNAPSHOT_CACHE_STALE_TTL = 60
+
+_snapshot_cache = {}
+_snapshot_refreshes = {}
+_snapshot_generations = {}
+_snapshot_cache_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'invalidations': 0}
+
+def configure_snapshot_cache(ttl=None, stale_ttl=None):
+    global SNAPSHOT_CACHE_TTL, SNAPSHOT_CACHE_STALE_TTL
+    if ttl is not None:
+        SNAPSHOT_CACHE_TTL = float(ttl)
+    if stale_ttl is not None:
+        SNAPSHOT_CACHE_STALE_TTL = float(stale_ttl)
+    SNAPSHOT_CACHE_STALE_TTL = max(SNAPSHOT_CACHE_STALE_TTL, SNAPSHOT_CACHE_TTL)
+
+def get_snapshot_cache_stats():
+    stats = dict(_snapshot_cache_stats)
+    stats['cached_servers'] = len(_snapshot_cache)
+    return stats
+
+def invalidate_snapshot(server_id):
+    _snapshot_generations[server_id] = _snapshot_generations.get(server_id, 0) + 1
+    _snapshot_cache.pop(server_id, None)
+    _snapshot_refreshes.pop(server_id, None)
+    _snapshot_cache_stats['invalidations'] += 1
+
+async def _load_snapshot(server_id, generation):
+    snapshot = await fetch_server_snapshot(server_id=server_id)
+    if snapshot is not None and _snapshot_generations.get(server_id, 0) == generation:
+        _snapshot_cache[server_id] = snapshot
+    return snapshot
+
+def _start_snapshot_refresh(server_id):
+    task = _snapshot_refreshes.get(server_id)
+    if task is None:
+        task = asyncio.ensure_future(_load_snapshot(server_id, _snapshot_generations.get(server_id, 0)))
+        _snapshot_refreshes[server_id] = task
+
+        def _done(finished):
+            if _snapshot_refreshes.get(server_id) is finished:
+                del _snapshot_refreshes[server_id]
+
+        task.add_done_callback(_done)
+    return task
+
+async def get_server_snapshot(server_id=None, max_age=None):
+    if server_id is None:
+        return None
+    ttl = SNAPSHOT_CACHE_TTL if max_age is None else max_age
+    cached = _snapshot_cache.get(server_id)
+    if cached is not None:
+        age = time.time() - cached.fetched_at
+        if age < ttl:
+            _snapshot_cache_stats['hits'] += 1
+            return cached
+        if max_age is None and age < SNAPSHOT_CACHE_STALE_TTL:
+            _snapshot_cache_stats['stale_hits'] += 1
+            _start_snapshot_refresh(server_id)
+            return cached
+    _snapshot_cache_stats['misses'] += 1
+    return await asyncio.shield(_start_snapshot_refresh(server_id))
+
+async def get_clients_from_clients_table(server_id=None):
+    snapshot = await get_server_snapshot(server_id=server_id)
+    return snapshot.client_map if snapshot else {}
+
+async def get_client_list(server_id=None):
+    snapshot = await get_server_snapshot(server_id=server_id)
+    return snapshot.clients if snapshot else []
+
+async def get_active_list(server_id=None):
+    snapshot = await get_server_snapshot(server_id=server_id)
+    return snapshot.active_clients if snapshot else []
+
+# Только ASCII, чтобы длина в символах совпадала с длиной в байтах: имя нового
+# клиента передаётся в callback_data (не больше 64 байт) до его создания
+MAX_SERVER_ID_LENGTH = 16
+MAX_CLIENT_NAME_LENGTH = 24
+SERVER_ID_PATTERN = re.compile(rf'^[a-zA-Z0-9_-]{{1,{MAX_SERVER_ID_LENGTH}}}$')
+CLIENT_NAME_PATTERN = re.compile(rf'^[a-zA-Z0-9_-]{{1,{MAX_CLIENT_NAME_LENGTH}}}$')
+MUTATION_COMMIT_WINDOW = 0.2
+
+def _remove_user_files(client_name):
+    user_dir = f"{os.getcwd()}/users/{client_name}"
+    if os.path.isdir(user_dir):
+        shutil.rmtree(user_dir, ignore_errors=True)
+    qr_render.remove_cached(client_name)
+
+def remove_peers(config_content, public_keys):
+    """Удаляет из wg0.conf секции [Peer] с указанными публичными ключами за один проход."""
+    result = []
+    block = []
+
+    def flush():
+        if not block:
+            return
+        if block[0].strip() == '[Peer]':
+            for line in block:
+                key, _, value = line.partition('=')
+                if key.strip() == 'PublicKey' and value.strip() in public_keys:
+                    return
+        result.extend(block)
+
+    for line in config_content.splitlines():
+        if line.strip().startswith('['):
+            flush()
+            block = []
+        block.append(line)
+    flush()
+    return '\n'.join(result).rstrip('\n') + '\n'
+
+def remove_local_client_data(client_names, server_id=None):
+    remove_users_expiration(client_names, server_id=server_id)
     pwd = os.getcwd()
-
-    if is_remote:
+    for client_name in client_names:
         try:
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            if not ssh.connect():
-                logger.error("Не удалось установить SSH соединение")
-                return False
+            _remove_user_files(client_name)
+            connections_file = f"{pwd}/files/connections/{client_name}_ip.json"
+            if os.path.exists(connections_file):
+                os.remove(connections_file)
+        except Exception as e:
+            logger.error(f"Ошибка удаления локальных файлов пользователя {client_name}: {e}")
 
-            awk_script = f"""
-            BEGIN {{in_peer=0; skip=0}}
-            /^\\[Peer\\]/ {{
-                in_peer=1
-                peer_block = $0 "\\n"
-                next
-            }}
-            in_peer == 1 {{
-                peer_block = peer_block $0 "\\n"
-                if ($0 ~ /^PublicKey =/) {{
-                    split($0, a, " = ")
-                    if (a[2] == "{client_public_key}") {{
-                        skip=1
-                    }}
-                }}
-                if ($0 ~ /^\\[Peer\\]/ || $0 ~ /^\\[Interface\\]/) {{
-                    if (skip == 1) {{
-                        skip=0
-                        in_peer=0
-                        next
-                    }} else {{
-                        printf "%s", peer_block
-                        in_peer=0
-                    }}
-                }}
-                if ($0 == "") {{
-                    if (skip == 1) {{
-                        skip=0
-                        in_peer=0
-                        next
-                    }} else {{
-                        printf "%s", peer_block
-                        in_peer=0
-                    }}
-                }}
-                next
-            }}
-            {{
-                print
-            }}
-            END {{
-                if (in_peer == 1 && skip != 1) {{
-                    printf "%s", peer_block
-                }}
-            }}
-            """
-
-            ssh.execute_command(f'echo \'{awk_script}\' > /tmp/remove_peer.awk')
-
-            commands = [
-                f'docker exec -i {docker_container} cat {wg_config_file} > /tmp/wg0.conf',
-                f'awk -f /tmp/remove_peer.awk /tmp/wg0.conf > /tmp/wg0.conf.new',
-                f'mv /tmp/wg0.conf.new /tmp/wg0.conf',
-                f'docker cp /tmp/wg0.conf {docker_container}:{wg_config_file}',
-                f'rm -f /tmp/remove_peer.awk /tmp/wg0.conf',
-                f'docker exec -i {docker_container} sh -c "wg-quick down {wg_config_file} && wg-quick up {wg_config_file}"'
-            ]
-
-            for cmd in commands:
-                output, error = ssh.execute_command(cmd)
-                if error and not ('Warning' in error or 'wireguard-go' in error):
-                    logger.error(f"Ошибка выполнения команды {cmd}: {error}")
-                    return False
-                
-            output, _ = ssh.execute_command(f"docker exec -i {docker_container} cat /opt/amnezia/awg/clientsTable")
-            try:
-                clients_table = json.loads(output or "[]")
-                clients_table = [client for client in clients_table if client['clientId'] != client_public_key]
-                clients_table_json = json.dumps(clients_table)
-                ssh.execute_command(f'echo \'{clients_table_json}\' > /tmp/clientsTable')
-                ssh.execute_command(f'docker cp /tmp/clientsTable {docker_container}:/opt/amnezia/awg/clientsTable')
-                ssh.execute_command('rm -f /tmp/clientsTable')
-            except Exception as e:
-                logger.error(f"Ошибка обновления clientsTable: {e}")
+def _write_local_client_files(client_name, client_config):
+    user_dir = f"{os.getcwd()}/users/{client_name}"
+    os.makedirs(user_dir, exist_ok=True)
+    with open(f"{user_dir}/{client_name}.conf", 'w') as f:
+        f.write(client_config)
 
+async def _write_server_file(content, container_path, server_id):
+    setting = get_config(server_id=server_id)
+    docker_container = setting['docker_container']
+    tmp_path = f"/tmp/awg-bot-{server_id}-{os.path.basename(container_path)}"
+    await upload_to_server(content, tmp_path, server_id=server_id)
+    output, error = await run_server_command(
+        f"docker cp {tmp_path} {docker_container}:{container_path} && echo {APPLY_OK_MARKER}",
+        server_id=server_id
+    )
+    await run_server_command(f"rm -f {tmp_path}", server_id=server_id)
+    if not output or APPLY_OK_MARKER not in output:
+        raise Exception(f"не удалось обновить {container_path}: {error}")
+
+async def _restore_server_files(server_id, snapshot, reapply):
+    """Возвращает wg0.conf и clientsTable к состоянию снимка после неудачного пакета."""
+    setting = get_config(server_id=server_id)
+    try:
+        await _write_server_file(snapshot.config, setting['wg_config_file'], server_id)
+        if reapply and not await apply_wg_config(server_id=server_id):
+            logger.error(f"Не удалось применить восстановленную конфигурацию сервера {server_id}")
+    except Exception as e:
+        logger.error(f"Не удалось откатить конфигурацию сервера {server_id}: {e}")
+    try:
+        await _write_server_file(json.dumps(snapshot.clients_table), CLIENTS_TABLE_PATH, server_id)
+    except Exception as e:
+        logger.error(f"Не удалось откатить clientsTable сервера {server_id}: {e}")
+
+@dataclass
+class ClientMutation:
+    action: str
+    names: list
+    future: asyncio.Future
+    expiration: datetime = None
+    traffic_limit: str = None
+
+_mutation_queues = {}
+_mutation_workers = {}
+_mutation_locks = {}
+
+def _get_mutation_lock(server_id):
+    lock = _mutation_locks.get(server_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _mutation_locks[server_id] = lock
+    return lock
+
+async def submit_client_mutation(action, names, server_id=None, expiration=None, traffic_limit=None):
+    """
+    Ставит добавление или удаление клиентов в очередь сервера. Запросы,
+    пришедшие в течение MUTATION_COMMIT_WINDOW, применяются одной перезаписью
+    wg0.conf и clientsTable; каждый вызывающий получает свой результат.
+    """
+    future = asyncio.get_running_loop().create_future()
+    _mutation_queues.setdefault(server_id, []).append(ClientMutation(
+        action=action,
+        names=list(names),
+        future=future,
+        expiration=expiration,
+        traffic_limit=traffic_limit
+    ))
+    if server_id not in _mutation_workers:
+        _mutation_workers[server_id] = asyncio.ensure_future(_mutation_worker(server_id))
+    return await future
+
+def _resolve_mutation(mutation, result):
+    if not mutation.future.done():
+        mutation.future.set_result(result)
+
+async def _mutation_worker(server_id):
+    try:
+        while _mutation_queues.get(server_id):
+            await asyncio.sleep(MUTATION_COMMIT_WINDOW)
+            batch = _mutation_queues.pop(server_id, [])
             try:
-                user_dir = f"{pwd}/users/{client_name}"
-                user_conf = f"{user_dir}/{client_name}.conf"
-                traffic_file = f"{user_dir}/traffic.json"
-                
-                for file in [user_conf, traffic_file]:
-                    if os.path.exists(file):
-                        os.remove(file)
-                
-                if os.path.exists(user_dir):
-                    os.rmdir(user_dir)
+                await _commit_client_mutations(server_id, batch)
             except Exception as e:
-                logger.error(f"Ошибка удаления локальных файлов: {e}")
+                logger.error(f"Ошибка при применении изменений на сервере {server_id}: {e}")
+            for mutation in batch:
+                _resolve_mutation(mutation, {} if mutation.action == 'add' else [])
+    finally:
+        del _mutation_workers[server_id]
+
+async def _commit_client_mutations(server_id, batch):
+    async with _get_mutation_lock(server_id):
+        try:
+            await _apply_client_mutations(server_id, batch)
+        finally:
+            invalidate_snapshot(server_id)
 
-            return True
+async def _apply_client_mutations(server_id, batch):
+    snapshot = await fetch_server_snapshot(server_id=server_id)
+    if snapshot is None:
+        return
+    profile = None
+    allocator = None
+
+    # Текущее состояние с учётом уже обработанных запросов пакета
+    peers = {client[0]: client[1] for client in snapshot.clients}
+    clients_table = list(snapshot.clients_table)
+    peer_blocks = []
+    removed_keys = set()
+    added = {}
+    removed = []
+    results = []
+    creation_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    for mutation in batch:
+        if mutation.action == 'add':
+            if profile is None:
+                profile = get_server_profile(server_id, snapshot.config)
+                if profile is None:
+                    results.append({})
+                    continue
+                allocator = ipalloc.IPAllocator.from_peers(
+                    snapshot.clients,
+                    network=profile.client_subnet,
+                    server_address=profile.server_address
+                )
+            configs = {}
+            for name in mutation.names:
+                if not CLIENT_NAME_PATTERN.match(name):
+                    logger.error(f"Недопустимое имя пользователя: {name}")
+                    continue
+                if name in peers:
+                    logger.info(f"Пользователь {name} уже существует.")
+                    continue
+                try:
+                    client_ip = allocator.allocate()
+                except ipalloc.SubnetFullError as e:
+                    logger.error(f"Нет свободных IP-адресов для {name}: {e}")
+                    break
+                private_key, client_public_key = wgkeys.generate_keypair()
+                psk = wgkeys.generate_preshared_key()
+                configs[name] = profile.render_client_config(client_ip, private_key, psk)
+                peers[name] = client_public_key
+                peer_blocks.append(f"""
+[Peer]
+# {name}
+PublicKey = {client_public_key}
+PresharedKey = {psk}
+AllowedIPs = {client_ip}
+""")
+                clients_table.append({
+                    "clientId": client_public_key,
+                    "userData": {
+                        "clientName": name,
+                        "creationDate": creation_date
+                    }
+                })
+            added.update(configs)
+            results.append(configs)
+        else:
+            names = []
+            for name in mutation.names:
+                if name not in peers:
+                    logger.error(f"Пользователь {name} не найден в списке клиентов.")
+                    continue
+                removed_keys.add(peers.pop(name))
+                added.pop(name, None)
+                names.append(name)
+            removed.extend(names)
+            results.append(names)
+
+    if not added and not removed:
+        for mutation, result in zip(batch, results):
+            _resolve_mutation(mutation, result)
+        return
 
-        except Exception as e:
-            logger.error(f"Ошибка при удалении пользователя через SSH: {e}")
-            return False
-    else:
-        if subprocess.call(["./removeclient.sh", client_name, client_public_key, wg_config_file, docker_container]) == 0:
-            return True
-        return False
+    new_config = snapshot.config.rstrip('\n') + '\n' + ''.join(peer_blocks)
+    if removed_keys:
+        new_config = remove_peers(new_config, removed_keys)
+        clients_table = [client for client in clients_table if client.get('clientId') not in removed_keys]
+    setting = get_config(server_id=server_id)
+    config_written = False
+    applying = False
+    try:
+        # Оба файла записываются до применения, чтобы wg0.conf и clientsTable не расходились
+        await _write_server_file(new_config, setting['wg_config_file'], server_id)
+        config_written = True
+        await _write_server_file(json.dumps(clients_table), CLIENTS_TABLE_PATH, server_id)
+        applying = True
+        if not await apply_wg_config(server_id=server_id):
+            raise Exception("не удалось применить новую конфигурацию")
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении клиентов на сервере {server_id}: {e}")
+        if config_written:
+            await _restore_server_files(server_id, snapshot, reapply=applying)
+        return
 
-def load_expirations():
-    if not os.path.exists(EXPIRATIONS_FILE):
-        return {}
-    with open(EXPIRATIONS_FILE, 'r') as f:
+    # Сначала данные удалённых: имя могли удалить и тут же создать заново в этом же пакете
+    if removed:
+        remove_local_client_data(removed, server_id=server_id)
+        traffic_store.get_store().remove(server_id, removed_keys)
+    for name, client_config in added.items():
         try:
-            data = json.load(f)
-            if data and not isinstance(next(iter(data.values())), dict):
-                new_data = {}
-                for user, info in data.items():
-                    if isinstance(info, dict):
-                        new_data[user] = {'default': info}
-                    else:
-                        new_data[user] = {'default': {
-                            'expiration_time': info.get('expiration_time'),
-                            'traffic_limit': info.get('traffic_limit', "Неограниченно")
-                        }}
-                data = new_data
-            
-            for user, servers in data.items():
-                for server_id, info in servers.items():
-                    if info.get('expiration_time'):
-                        data[user][server_id]['expiration_time'] = datetime.fromisoformat(info['expiration_time']).replace(tzinfo=UTC)
-                    else:
-                        data[user][server_id]['expiration_time'] = None
-            return data
-        except json.JSONDecodeError:
-            logger.error("Ошибка при загрузке expirations.json.")
-            return {}
+            _write_local_client_files(name, client_config)
+        except OSError as e:
+            logger.error(f"Ошибка записи локальных файлов пользователя {name}: {e}")
+
+    for mutation, result in zip(batch, results):
+        if mutation.action == 'add':
+            created = [name for name in result if name in added]
+            if created and (mutation.expiration is not None or mutation.traffic_limit is not None):
+                set_users_expiration(created, mutation.expiration, mutation.traffic_limit, server_id=server_id)
+            _resolve_mutation(mutation, {name: result[name] for name in created})
+        else:
+            _resolve_mutation(mutation, result)
+    logger.info(f"Сервер {server_id}: добавлено пользователей {len(added)}, удалено {len(removed)}")
+
+async def bulk_add_clients(names, server_id=None, expiration=None, traffic_limit=None):
+    """
+    Создаёт сразу несколько клиентов одной перезаписью wg0.conf и clientsTable.
+    Возвращает словарь {имя клиента: текст его .conf} для созданных клиентов.
+    """
+    if server_id is None:
+        return {}
+    return await submit_client_mutation('add', names, server_id=server_id, expiration=expiration, traffic_limit=traffic_limit)
+
+async def root_add(id_user, server_id=None, ipv6=False):
+    configs = await bulk_add_clients([id_user], server_id=server_id)
+    return id_user in configs
+
+async def bulk_remove_clients(names, server_id=None):
+    """
+    Удаляет сразу несколько клиентов одной перезаписью wg0.conf и clientsTable,
+    затем одним пакетом удаляет их локальные файлы, сроки действия и файлы
+    подключений. Возвращает список удалённых клиентов.
+    """
+    if server_id is None:
+        return []
+    return await submit_client_mutation('remove', names, server_id=server_id)
 
-def save_expirations(expirations):
-    os.makedirs(os.path.dirname(EXPIRATIONS_FILE), exist_ok=True)
-    data = {}
-    for user, servers in expirations.items():
-        data[user] = {}
-        for server_id, info in servers.items():
-            data[user][server_id] = {
-                'expiration_time': info['expiration_time'].isoformat() if info['expiration_time'] else None,
-                'traffic_limit': info.get('traffic_limit', "Неограниченно")
-            }
-    with open(EXPIRATIONS_FILE, 'w') as f:
-        json.dump(data, f)
+async def deactive_user_db(client_name, server_id=None):
+    removed = await bulk_remove_clients([client_name], server_id=server_id)
+    return client_name in removed
+
+def _legacy_expiration_server():
+    servers = get_server_list()
+    return servers[0] if len(servers) == 1 else None
+
+def get_expiration_registry():
+    return expirations.get_registry(EXPIRATIONS_FILE, legacy_server=_legacy_expiration_server)
+
+def flush_expirations():
+    get_expiration_registry().flush()
 
 def set_user_expiration(username: str, expiration: datetime, traffic_limit: str, server_id: str = None):
+    set_users_expiration([username], expiration, traffic_limit, server_id=server_id)
+
+def set_users_expiration(usernames: list, expiration: datetime, traffic_limit: str, server_id: str = None):
     if server_id is None:
         return
-    expirations = load_expirations()
-    if username not in expirations:
-        expirations[username] = {}
-    if server_id not in expirations[username]:
-        expirations[username][server_id] = {}
-    if expiration:
-        if expiration.tzinfo is None:
-            expiration = expiration.replace(tzinfo=UTC)
-        expirations[username][server_id]['expiration_time'] = expiration
-    else:
-        expirations[username][server_id]['expiration_time'] = None
-    expirations[username][server_id]['traffic_limit'] = traffic_limit
-    save_expirations(expirations)
+    get_expiration_registry().set_many(server_id, usernames, expiration or None, traffic_limit)
 
 def remove_user_expiration(username: str, server_id: str = None):
+    remove_users_expiration([username], server_id=server_id)
+
+def remove_users_expiration(usernames: list, server_id: str = None):
     if server_id is None:
         return
-    expirations = load_expirations()
-    if username in expirations and server_id in expirations[username]:
-        del expirations[username][server_id]
-        if not expirations[username]:
-            del expirations[username]
-        save_expirations(expirations)
+    get_expiration_registry().remove_many(server_id, usernames)
 
 def get_users_with_expiration(server_id: str = None):
     if server_id is None:
         return []
-    expirations = load_expirations()
     result = []
-    for user, servers in expirations.items():
-        if server_id in servers:
-            info = servers[server_id]
-            result.append((
-                user,
-                info['expiration_time'].isoformat() if info['expiration_time'] else None,
-                info.get('traffic_limit', "Неограниченно")
-            ))
+    for user, info in get_expiration_registry().server_entries(server_id):
+        result.append((
+            user,
+            info['expiration_time'].isoformat() if info['expiration_time'] else None,
+            info.get('traffic_limit', "Неограниченно")
+        ))
     return result
 
 def get_user_expiration(username: str, server_id: str = None):
     if server_id is None:
         return None
-    expirations = load_expirations()
-    return expirations.get(username, {}).get(server_id, {}).get('expiration_time', None)
+    return get_expiration_registry().get_expiration(server_id, username)
 
 def get_user_traffic_limit(username: str, server_id: str = None):
     if server_id is None:
         return "Неограниченно"
-    expirations = load_expirations()
-    return expirations.get(username, {}).get(server_id, {}).get('traffic_limit', "Неограниченно")
+    return get_expiration_registry().get_traffic_limit(server_id, username)
+
+def _named_peers_config(snapshot):
+    """wg0.conf с комментарием «# имя» перед каждым известным пиром или None, если менять нечего."""
+    client_map = {client[1]: client[0] for client in snapshot.clients}
+    lines = snapshot.config.splitlines()
+    new_config = []
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if line.startswith('[Peer]'):
+            new_config.append(line)
+            peer_lines = []
+            i += 1
+            public_key = None
+            while i < len(lines):
+                peer_line = lines[i].strip()
+                if peer_line == '':
+                    # Пустая строка после секции добавляется ниже один раз
+                    i += 1
+                    break
+                if peer_line.startswith('PublicKey ='):
+                    public_key = peer_line.split('=', 1)[1].strip()
+                if not peer_line.startswith('#'):
+                    peer_lines.append(peer_line)
+                i += 1
 
-def ensure_peer_names(server_id=None):
+            if public_key and public_key in client_map:
+                new_config.append(f"# {client_map[public_key]}")
+            new_config.extend(peer_lines)
+            new_config.append('')
+        else:
+            new_config.append(line)
+            i += 1
+
+    new_config_content = '\n'.join(new_config)
+    if new_config_content.strip() == snapshot.config.strip():
+        return None
+    return new_config_content
+
+async def ensure_peer_names(server_id=None):
+    """
+    Проставляет имена клиентов комментариями в wg0.conf. Проверка идёт по
+    кэшированному снимку; свежее состояние запрашивается и кэш сбрасывается,
+    только если файл действительно нужно переписать.
+    """
     if server_id is None:
         return False
     try:
-        clients = get_client_list(server_id=server_id)
-        client_map = {client[1]: client[0] for client in clients}
-        
-        setting = get_config(server_id=server_id)
-        wg_config_file = setting['wg_config_file']
-        docker_container = setting['docker_container']
-        
-        cmd = f"docker exec -i {docker_container} cat {wg_config_file}"
-        config_content = execute_docker_command(cmd, server_id=server_id)
-        
-        lines = config_content.splitlines()
-        new_config = []
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if line.startswith('[Peer]'):
-                new_config.append(line)
-                peer_lines = []
-                i += 1
-                public_key = None
-                while i < len(lines):
-                    peer_line = lines[i].strip()
-                    if peer_line == '':
-                        break
-                    if peer_line.startswith('PublicKey ='):
-                        public_key = peer_line.split('=', 1)[1].strip()
-                    if not peer_line.startswith('#'):
-                        peer_lines.append(peer_line)
-                    i += 1
-                
-                if public_key and public_key in client_map:
-                    new_config.append(f"# {client_map[public_key]}")
-                new_config.extend(peer_lines)
-                new_config.append('')
-            else:
-                new_config.append(line)
-                i += 1
-        
-        new_config_content = '\n'.join(new_config)
-        
-        if setting.get('is_remote') == 'true':
-            servers = load_servers()
-            server_config = servers.get(server_id, {})
-            
-            if server_id in SSHManager._instances and hasattr(SSHManager._instances[server_id], '_original_password'):
-                ssh = SSHManager._instances[server_id]
-            else:
-                ssh = SSHManager(
-                    server_id=server_id,
-                    host=server_config.get('host'),
-                    port=int(server_config.get('port', 22)),
-                    username=server_config.get('username'),
-                    auth_type=server_config.get('auth_type'),
-                    key_path=server_config.get('key_path'),
-                    password=server_config.get('_original_password')
-                )
-            
-            ssh.execute_command(f'echo \'{new_config_content}\' > /tmp/wg0.conf')
-            ssh.execute_command(f'docker cp /tmp/wg0.conf {docker_container}:{wg_config_file}')
-            ssh.execute_command('rm -f /tmp/wg0.conf')
-        else:
-            with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
-                temp_file.write(new_config_content)
-                temp_path = temp_file.name
-            
-            subprocess.run(['docker', 'cp', temp_path, f"{docker_container}:{wg_config_file}"])
-            os.unlink(temp_path)
-        
+        snapshot = await get_server_snapshot(server_id=server_id)
+        if snapshot is None:
+            return False
+        if _named_peers_config(snapshot) is None:
+            return True
+        async with _get_mutation_lock(server_id):
+            snapshot = await fetch_server_snapshot(server_id=server_id)
+            if snapshot is None:
+                return False
+            new_config_content = _named_peers_config(snapshot)
+            if new_config_content is None:
+                return True
+            setting = get_config(server_id=server_id)
+            try:
+                await _write_server_file(new_config_content, setting['wg_config_file'], server_id)
+            finally:
+                invalidate_snapshot(server_id)
         return True
     except Exception as e:
         logger.error(f"Ошибка при обновлении имен пиров: {e}")
@@ -0,0 +1,110 @@
+import time
+import socket
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+NEGATIVE_TTL = 30
+STALE_TTL = 24 * 3600
+
+def system_lookup(name):
+    """Блокирующий поиск A-записи через системный резолвер. Возвращает (ip, ttl или None)."""
+    infos = socket.getaddrinfo(name, None, socket.AF_INET, socket.SOCK_DGRAM)
+    if not infos:
+        raise socket.gaierror(f"No address for {name}")
+    return infos[0][4][0], None
+
+def static_lookup(mapping, ttl=DEFAULT_TTL):
+    """Локальная подмена резолвера (для тестов и серверов без DNS): {имя: ip}."""
+    def lookup(name):
+        if name not in mapping:
+            raise socket.gaierror(f"Unknown host {name}")
+        return mapping[name], ttl
+    return lookup
+
+class CachedResolver:
+    """
+    Кэш разрешения имён Endpoint. Запись живёт TTL из ответа резолвера, а если
+    резолвер его не сообщает (системный getaddrinfo) - default_ttl. Неудачи
+    кэшируются на negative_ttl. Если имя перестало разрешаться, до stale_ttl
+    отдаётся последний известный адрес. Одновременные асинхронные запросы одного
+    имени объединяются в один поиск в пуле потоков.
+    """
+
+    def __init__(self, lookup=system_lookup, default_ttl=DEFAULT_TTL, negative_ttl=NEGATIVE_TTL, stale_ttl=STALE_TTL):
+        self.lookup = lookup
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'failures': 0}
+
+    def _cached(self, name, now):
+        entry = self._cache.get(name)
+        if entry is not None and entry['expires'] > now:
+            self.stats['hits'] += 1
+            return True, entry['ip']
+        return False, None
+
+    def _store(self, name, ip, ttl, now):
+        with self._lock:
+            self._cache[name] = {
+                'ip': ip,
+                'expires': now + (ttl if ttl is not None else self.default_ttl),
+                'resolved_at': now
+            }
+
+    def _fail(self, name, error, now):
+        self.stats['failures'] += 1
+        with self._lock:
+            entry = self._cache.get(name)
+            if entry is not None and entry['ip'] and now - entry['resolved_at'] < self.stale_ttl:
+                self.stats['stale'] += 1
+                logger.warning(f"Не удалось разрешить {name} ({error}), используется прежний адрес {entry['ip']}")
+                entry['expires'] = now + self.negative_ttl
+                return entry['ip']
+            self._cache[name] = {'ip': None, 'expires': now + self.negative_ttl, 'resolved_at': now}
+        logger.error(f"Не удалось разрешить имя {name}: {error}")
+        return None
+
+    def _resolve_blocking(self, name):
+        now = time.time()
+        try:
+            ip, ttl = self.lookup(name)
+        except (OSError, UnicodeError) as e:
+            return self._fail(name, e, now)
+        self._store(name, ip, ttl, now)
+        return ip
+
+    def resolve(self, name):
+        """Синхронное разрешение имени; None, если адрес неизвестен."""
+        found, ip = self._cached(name, time.time())
+        if found:
+            return ip
+        self.stats['misses'] += 1
+        return self._resolve_blocking(name)
+
+    async def resolve_async(self, name):
+        found, ip = self._cached(name, time.time())
+        if found:
+            return ip
+        future = self._inflight.get(name)
+        if future is None:
+            self.stats['misses'] += 1
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(loop.run_in_executor(None, self._resolve_blocking, name))
+            self._inflight[name] = future
+            future.add_done_callback(lambda _: self._inflight.pop(name, None))
+        return await asyncio.shield(future)
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
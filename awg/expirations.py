@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import heapq
+import bisect
+import asyncio
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+UNLIMITED = "Неограниченно"
+FLUSH_DELAY = 1.0
+BATCH_WINDOW = 2.0
+RETRY_DELAY = 60
+MAX_SLEEP = 3600
+
+def _parse_time(value):
+    if not value:
+        return None
+    expiration = datetime.fromisoformat(value)
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=timezone.utc)
+    return expiration
+
+def parse_expirations(data, legacy_server=None):
+    """
+    Разбирает содержимое expirations.json в {(сервер, пользователь): запись}.
+    Записи старого формата без серверов ({пользователь: запись}) относятся к
+    legacy_server. Если он не задан, такие записи не применяются, а возвращаются
+    как есть, чтобы сохранить их в файле. Возвращает (записи, число отнесённых
+    к legacy_server, {пользователь: неразобранная запись старого формата}).
+    """
+    entries = {}
+    assigned = 0
+    unassigned = {}
+    for user, servers in (data or {}).items():
+        if not isinstance(servers, dict):
+            continue
+        if 'expiration_time' in servers or 'traffic_limit' in servers:
+            if legacy_server is None:
+                unassigned[user] = servers
+                continue
+            assigned += 1
+            servers = {legacy_server: servers}
+        for server_id, info in servers.items():
+            if not isinstance(info, dict):
+                continue
+            try:
+                expiration = _parse_time(info.get('expiration_time'))
+            except (TypeError, ValueError):
+                logger.error(f"Некорректная дата окончания пользователя {user} на сервере {server_id}: {info.get('expiration_time')}")
+                expiration = None
+            entries[(server_id, user)] = {
+                'expiration_time': expiration,
+                'traffic_limit': info.get('traffic_limit', UNLIMITED)
+            }
+    if unassigned:
+        logger.warning(
+            f"Записи старого формата без сервера не применяются (сервер не определён однозначно) "
+            f"и сохраняются в файле без изменений: {', '.join(sorted(unassigned))}"
+        )
+    if assigned:
+        logger.info(f"Записи старого формата ({assigned}) отнесены к серверу {legacy_server}")
+    return entries, assigned, unassigned
+
+class ExpirationRegistry:
+    """
+    Сроки действия и лимиты трафика клиентов в памяти с индексами по
+    (сервер, пользователь), по серверу и по времени окончания.
+    Изменения сбрасываются в JSON отложенно одной атомарной записью.
+    """
+
+    def __init__(self, path, legacy_server=None):
+        self.path = path
+        self.legacy_server = legacy_server
+        self._entries = {}
+        self._by_server = {}
+        self._by_time = []
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._flush_handle = None
+        self._listeners = []
+        self.unassigned = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        legacy_server = self.legacy_server() if self.legacy_server else None
+        try:
+            with open(self.path, 'r') as f:
+                entries, assigned, unassigned = parse_expirations(json.load(f), legacy_server)
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Ошибка при загрузке {self.path}: {e}")
+            return
+        with self._lock:
+            self._entries = {}
+            self._by_server = {}
+            self._by_time = []
+            self.unassigned = unassigned
+            for (server_id, user), entry in entries.items():
+                self._insert(server_id, user, entry)
+            if assigned:
+                # Файл перезаписывается в новом формате
+                self._mark_dirty()
+        logger.info(f"Загружено сроков действия клиентов: {len(entries)}")
+
+    def add_listener(self, callback):
+        """callback(server_id, user, expiration_time или None) вызывается при каждом изменении срока."""
+        self._listeners.append(callback)
+
+    def _notify(self, server_id, user, expiration):
+        for callback in self._listeners:
+            try:
+                callback(server_id, user, expiration)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика изменения срока {server_id}/{user}: {e}")
+
+    def _insert(self, server_id, user, entry):
+        self._entries[(server_id, user)] = entry
+        self._by_server.setdefault(server_id, set()).add(user)
+        if entry['expiration_time'] is not None:
+            bisect.insort(self._by_time, (entry['expiration_time'], server_id, user))
+
+    def _delete(self, server_id, user):
+        entry = self._entries.pop((server_id, user), None)
+        if entry is None:
+            return None
+        users = self._by_server.get(server_id)
+        if users is not None:
+            users.discard(user)
+            if not users:
+                del self._by_server[server_id]
+        if entry['expiration_time'] is not None:
+            key = (entry['expiration_time'], server_id, user)
+            index = bisect.bisect_left(self._by_time, key)
+            if index < len(self._by_time) and self._by_time[index] == key:
+                del self._by_time[index]
+        return entry
+
+    def set_many(self, server_id, users, expiration, traffic_limit):
+        if expiration is not None and expiration.tzinfo is None:
+            expiration = expiration.replace(tzinfo=timezone.utc)
+        with self._lock:
+            for user in users:
+                self._delete(server_id, user)
+                self._insert(server_id, user, {'expiration_time': expiration, 'traffic_limit': traffic_limit})
+                if self.unassigned.pop(user, None) is not None:
+                    logger.warning(f"Запись старого формата пользователя {user} заменена сроком на сервере {server_id}")
+            self._mark_dirty()
+        for user in users:
+            self._notify(server_id, user, expiration)
+
+    def remove_many(self, server_id, users):
+        removed = []
+        with self._lock:
+            for user in users:
+                if self._delete(server_id, user) is not None:
+                    removed.append(user)
+            if removed:
+                self._mark_dirty()
+        for user in removed:
+            self._notify(server_id, user, None)
+        return removed
+
+    def remove_server(self, server_id):
+        with self._lock:
+            users = list(self._by_server.get(server_id, ()))
+        return self.remove_many(server_id, users)
+
+    def get(self, server_id, user):
+        return self._entries.get((server_id, user))
+
+    def get_expiration(self, server_id, user):
+        entry = self._entries.get((server_id, user))
+        return entry['expiration_time'] if entry else None
+
+    def get_traffic_limit(self, server_id, user):
+        entry = self._entries.get((server_id, user))
+        return entry.get('traffic_limit', UNLIMITED) if entry else UNLIMITED
+
+    def server_entries(self, server_id):
+        with self._lock:
+            return [(user, self._entries[(server_id, user)]) for user in sorted(self._by_server.get(server_id, ()))]
+
+    def due(self, now):
+        """[(время, сервер, пользователь)] для всех сроков, наступивших к now."""
+        result = []
+        with self._lock:
+            for item in self._by_time:
+                if item[0] > now:
+                    break
+                result.append(item)
+        return result
+
+    def upcoming(self):
+        with self._lock:
+            return list(self._by_time)
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(FLUSH_DELAY, self.flush)
+
+    def _serialize(self):
+        data = {}
+        for (server_id, user), entry in self._entries.items():
+            expiration = entry['expiration_time']
+            data.setdefault(user, {})[server_id] = {
+                'expiration_time': expiration.isoformat() if expiration else None,
+                'traffic_limit': entry.get('traffic_limit', UNLIMITED)
+            }
+        for user, info in self.unassigned.items():
+            data.setdefault(user, info)
+        return data
+
+    def flush(self):
+        with self._lock:
+            self._flush_handle = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._serialize(), f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.error(f"Ошибка записи {self.path}: {e}")
+                self._dirty = True
+
+class ExpirationEngine:
+    """
+    Мин-куча сроков (время срабатывания, сервер, пользователь) поверх реестра.
+    Изменения сроков приходят через слушатель реестра, устаревшие записи кучи
+    отбрасываются при извлечении. Сроки, наступившие в пределах batch_window,
+    собираются в один вызов on_expired(server_id, users) на сервер; on_expired
+    возвращает список действительно деактивированных пользователей, остальные
+    повторяются через RETRY_DELAY, пока их срок остаётся в реестре.
+    """
+
+    def __init__(self, registry, on_expired, batch_window=BATCH_WINDOW):
+        self.registry = registry
+        self.on_expired = on_expired
+        self.batch_window = batch_window
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+        registry.add_listener(self._on_change)
+
+    def _push(self, due, server_id, user, expiration):
+        item = (due, server_id, user, expiration)
+        heapq.heappush(self._heap, item)
+        if self._wakeup is not None and self._heap[0] is item:
+            self._wakeup.set()
+
+    def _on_change(self, server_id, user, expiration):
+        if expiration is not None:
+            self._push(expiration.timestamp(), server_id, user, expiration)
+
+    def _is_current(self, server_id, user, expiration):
+        return self.registry.get_expiration(server_id, user) == expiration
+
+    def rebuild(self):
+        self._heap = [(expiration.timestamp(), server_id, user, expiration) for expiration, server_id, user in self.registry.upcoming()]
+        heapq.heapify(self._heap)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pop_due(self, now):
+        batches = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, server_id, user, expiration = heapq.heappop(self._heap)
+            if self._is_current(server_id, user, expiration):
+                batches.setdefault(server_id, []).append((user, expiration))
+        return batches
+
+    async def process_due(self, now=None):
+        """Деактивирует все наступившие сроки; возвращает {сервер: деактивированные пользователи}."""
+        batches = self.pop_due(time.time() if now is None else now)
+        processed = {}
+        for server_id, items in batches.items():
+            users = sorted({user for user, _ in items})
+            try:
+                done = set(await self.on_expired(server_id, users) or [])
+            except Exception as e:
+                logger.error(f"Ошибка деактивации истёкших пользователей на сервере {server_id}: {e}")
+                done = set()
+            processed[server_id] = sorted(done)
+            retry_at = time.time() + RETRY_DELAY
+            for user, expiration in items:
+                if user not in done and self._is_current(server_id, user, expiration):
+                    self._push(retry_at, server_id, user, expiration)
+        return processed
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    async def _run(self):
+        while True:
+            await self.process_due()
+            self._wakeup.clear()
+            next_due = self.next_due()
+            delay = MAX_SLEEP if next_due is None else min(max(next_due - time.time(), 0) + self.batch_window, MAX_SLEEP)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self.rebuild()
+        self._task = asyncio.ensure_future(self._run())
+        logger.info(f"Планировщик сроков действия запущен, сроков в очереди: {len(self._heap)}")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+_registry = None
+
+def get_registry(path, legacy_server=None):
+    """legacy_server - функция, возвращающая сервер для записей старого формата или None."""
+    global _registry
+    if _registry is None:
+        _registry = ExpirationRegistry(path, legacy_server)
+        _registry.load()
+        atexit.register(_registry.flush)
+    return _registry
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+FILE_IDS_FILE = 'files/file_ids.json'
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+class FileIdCache:
+    """
+    file_id, которые Telegram вернул при загрузке файлов клиента:
+    {клиент: {вид файла: [хэш содержимого, file_id]}}. На каждый вид файла
+    хранится только последняя версия, так что изменённая или пересозданная
+    конфигурация просто не совпадёт по хэшу и будет загружена заново.
+    """
+
+    def __init__(self, path=FILE_IDS_FILE):
+        self.path = path
+        self._data = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self._data = data if isinstance(data, dict) else {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка при загрузке {self.path}: {e}")
+            self._data = {}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Ошибка записи {self.path}: {e}")
+
+    def get(self, client, kind, digest):
+        entry = self._data.get(client, {}).get(kind)
+        if entry and entry[0] == digest:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, client, kind, digest, file_id):
+        self._data.setdefault(client, {})[kind] = [digest, file_id]
+        self.save()
+
+    def invalidate(self, client, kind=None):
+        if client not in self._data:
+            return
+        if kind is None:
+            del self._data[client]
+        else:
+            self._data[client].pop(kind, None)
+            if not self._data[client]:
+                del self._data[client]
+        self.save()
+
+    def prune(self, existing_clients):
+        """Удаляет записи клиентов, которых больше нет."""
+        stale = [client for client in self._data if client not in existing_clients]
+        for client in stale:
+            del self._data[client]
+        if stale:
+            self.save()
+        return len(stale)
@@ -0,0 +1,160 @@
+import ipaddress
+import logging
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLIENT_SUBNET = '10.8.1.0/24'
+
+class SubnetFullError(Exception):
+    pass
+
+def parse_interface_address(address):
+    """
+    Возвращает (адрес сервера, подсеть клиентов) для первого IPv4-адреса
+    из строки Address секции [Interface], например "10.8.0.1/16, fd00::1/64".
+    """
+    for item in (address or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            interface = ipaddress.ip_interface(item)
+        except ValueError:
+            logger.warning(f"Некорректный адрес интерфейса: {item}")
+            continue
+        if interface.version == 4:
+            return interface.ip, interface.network
+    return None, None
+
+class IPAllocator:
+    """
+    Битовая карта занятых адресов подсети клиентов (один байт на адрес).
+    Поиск свободного адреса идёт от курсора через bytearray.find, поэтому
+    последовательные выделения обходятся амортизированно за O(1).
+    """
+
+    FREE = 0
+    USED = 1
+
+    def __init__(self, network=DEFAULT_CLIENT_SUBNET, server_address=None):
+        self.network = ipaddress.ip_network(network, strict=False)
+        self._base = int(self.network.network_address)
+        self._bitmap = bytearray(self.network.num_addresses)
+        self._cursor = 0
+        self._reserved = {0, 1, self.network.num_addresses - 1}
+        if server_address is not None:
+            offset = self._offset(ipaddress.ip_address(server_address))
+            if offset is not None:
+                self._reserved.add(offset)
+        self._reserve_service_addresses()
+
+    def _reserve_service_addresses(self):
+        # Адрес сети, первый хост, широковещательный адрес и адрес самого сервера
+        for offset in self._reserved:
+            if 0 <= offset < len(self._bitmap):
+                self._bitmap[offset] = self.USED
+
+    def _offset(self, address):
+        offset = int(address) - self._base
+        if 0 <= offset < len(self._bitmap):
+            return offset
+        return None
+
+    def _host_offset(self, cidr):
+        # Быстрый путь для типичного AllowedIPs клиента вида a.b.c.d/32
+        address, _, prefix = cidr.partition('/')
+        if self.network.version != 4 or prefix not in ('', '32'):
+            return None
+        try:
+            value = int.from_bytes(socket.inet_aton(address), 'big')
+        except OSError:
+            return None
+        return value - self._base
+
+    def mark_used(self, cidr):
+        """Помечает занятыми все адреса подсети, попадающие в cidr."""
+        cidr = cidr.strip()
+        offset = self._host_offset(cidr)
+        if offset is not None:
+            if 0 <= offset < len(self._bitmap):
+                self._bitmap[offset] = self.USED
+            return
+        try:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+        except ValueError:
+            logger.warning(f"Некорректный адрес в AllowedIPs: {cidr}")
+            return
+        if network.version != self.network.version or not network.overlaps(self.network):
+            return
+        start = self._offset(max(network.network_address, self.network.network_address))
+        end = self._offset(min(network.broadcast_address, self.network.broadcast_address))
+        self._bitmap[start:end + 1] = bytes([self.USED]) * (end - start + 1)
+
+    def mark_allowed_ips(self, allowed_ips):
+        for cidr in allowed_ips.split(','):
+            if cidr.strip():
+                self.mark_used(cidr)
+
+    def release(self, cidr):
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        offset = self._offset(network.network_address)
+        if offset is None or network.num_addresses != 1:
+            return
+        if offset in self._reserved:
+            return
+        self._bitmap[offset] = self.FREE
+        self._cursor = min(self._cursor, offset)
+
+    def is_used(self, cidr):
+        offset = self._offset(ipaddress.ip_network(cidr.strip(), strict=False).network_address)
+        return offset is not None and self._bitmap[offset] == self.USED
+
+    def allocate(self):
+        offset = self._bitmap.find(self.FREE, self._cursor)
+        if offset == -1 and self._cursor:
+            offset = self._bitmap.find(self.FREE, 0, self._cursor)
+        if offset == -1:
+            raise SubnetFullError(f"Подсеть {self.network} заполнена")
+        self._bitmap[offset] = self.USED
+        self._cursor = offset + 1
+        prefix = self.network.max_prefixlen
+        return f"{ipaddress.ip_address(self._base + offset)}/{prefix}"
+
+    def free_count(self):
+        return self._bitmap.count(self.FREE)
+
+    @classmethod
+    def from_peers(cls, peers, network=DEFAULT_CLIENT_SUBNET, server_address=None):
+        """peers - список [имя, публичный ключ, AllowedIPs] из parse_peers."""
+        allocator = cls(network, server_address=server_address)
+        for peer in peers:
+            allocator.mark_allowed_ips(peer[2])
+        return allocator
+
+def benchmark(peer_count=50000, network='10.8.0.0/16', rounds=5):
+    """Замер построения карты по существующим пирам и выделения новых адресов."""
+    allocator = IPAllocator(network)
+    peers = [[f"client{i}", '', allocator.allocate()] for i in range(peer_count)]
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        allocator = IPAllocator.from_peers(peers, network)
+    build_time = (time.perf_counter() - started) / rounds
+
+    allocator.release(peers[peer_count // 2][2])
+    free_count = allocator.free_count()
+    started = time.perf_counter()
+    for _ in range(free_count):
+        allocator.allocate()
+    allocate_time = time.perf_counter() - started
+
+    print(f"Подсеть {network}, пиров: {peer_count}")
+    print(f"Построение карты: {build_time * 1000:.1f} мс")
+    print(f"Выделение {free_count} адресов: {allocate_time * 1000:.1f} мс "
+          f"({allocate_time / max(free_count, 1) * 1e6:.2f} мкс на адрес)")
+
+if __name__ == '__main__':
+    import sys
+    benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -86,17 +86,65 @@ fi
 LISTEN_PORT=$(awk '/ListenPort\s*=/ {print $3}' "$SERVER_CONF_PATH")
 ADDITIONAL_PARAMS=$(awk '/^Jc\s*=|^Jmin\s*=|^Jmax\s*=|^S1\s*=|^S2\s*=|^H[1-4]\s*=/' "$SERVER_CONF_PATH")
 
-octet=2
-while grep -E "AllowedIPs\s*=\s*10\.8\.1\.$octet/32" "$SERVER_CONF_PATH" > /dev/null; do
-    (( octet++ ))
-done
+CLIENT_IP=$(awk -v configured_subnet="${CLIENT_SUBNET:-}" '
+function ip2int(ip,    p) {
+    split(ip, p, ".")
+    return ((p[1] * 256 + p[2]) * 256 + p[3]) * 256 + p[4]
+}
+function int2ip(n) {
+    return int(n / 16777216) "." int(n / 65536) % 256 "." int(n / 256) % 256 "." n % 256
+}
+function set_subnet(cidr,    parts, size) {
+    split(cidr, parts, "/")
+    if (parts[2] == "") parts[2] = 24
+    size = 2 ^ (32 - parts[2])
+    base = int(ip2int(parts[1]) / size) * size
+    last = base + size - 1
+    server_ip = ip2int(parts[1])
+}
+/^\[Interface\]/ { in_interface = 1; next }
+/^\[/ { in_interface = 0 }
+in_interface && /^Address[ \t]*=/ && subnet == "" {
+    value = $0
+    sub(/^Address[ \t]*=[ \t]*/, "", value)
+    n = split(value, addrs, /[ \t]*,[ \t]*/)
+    for (i = 1; i <= n; i++) {
+        if (addrs[i] ~ /^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+(\/[0-9]+)?$/) {
+            subnet = addrs[i]
+            break
+        }
+    }
+}
+/^AllowedIPs[ \t]*=/ {
+    value = $0
+    sub(/^AllowedIPs[ \t]*=[ \t]*/, "", value)
+    n = split(value, ips, /[ \t]*,[ \t]*/)
+    for (i = 1; i <= n; i++) {
+        if (ips[i] ~ /^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+\/32$/) {
+            sub(/\/32$/, "", ips[i])
+            used[ip2int(ips[i])] = 1
+        }
+    }
+}
+END {
+    if (configured_subnet != "") subnet = configured_subnet
+    if (subnet == "") subnet = "10.8.1.0/24"
+    set_subnet(subnet)
+    used[server_ip] = 1
+    for (n = base + 2; n < last; n++) {
+        if (!(n in used)) {
+            print int2ip(n) "/32"
+            exit
+        }
+    }
+}
+' "$SERVER_CONF_PATH")
 
-if [ "$octet" -gt 254 ]; then
-    echo "Error: WireGuard internal subnet 10.8.1.0/24 is full"
+if [ -z "$CLIENT_IP" ]; then
+    echo "Error: WireGuard internal client subnet is full"
     exit 1
 fi
 
-CLIENT_IP="10.8.1.$octet/32"
 ALLOWED_IPS="$CLIENT_IP"
 
 if [ "$IS_REMOTE" = "true" ]; then
@@ -114,14 +162,22 @@ AllowedIPs = $ALLOWED_IPS
 
 EOF
 
+WG_INTERFACE=$(basename "$WG_CONFIG_FILE" .conf)
+LIVE_APPLY_CMD="wg-quick strip $WG_CONFIG_FILE > /tmp/$WG_INTERFACE.stripped && wg syncconf $WG_INTERFACE /tmp/$WG_INTERFACE.stripped; status=\$?; rm -f /tmp/$WG_INTERFACE.stripped; exit \$status"
+RESTART_CMD="wg-quick down $WG_CONFIG_FILE && wg-quick up $WG_CONFIG_FILE"
+
 if [ "$IS_REMOTE" = "true" ]; then
     scp -P "$REMOTE_PORT" "$SERVER_CONF_PATH" "$REMOTE_USER@$REMOTE_HOST:/tmp/server.conf"
     remote_cmd "docker cp /tmp/server.conf $DOCKER_CONTAINER:$WG_CONFIG_FILE"
     remote_cmd "rm /tmp/server.conf"
-    docker_cmd "exec -i $DOCKER_CONTAINER sh -c \"wg-quick down $WG_CONFIG_FILE && wg-quick up $WG_CONFIG_FILE\""
+    if [ "${APPLY_MODE:-live}" = "restart" ] || ! docker_cmd "exec -i $DOCKER_CONTAINER sh -c \"$LIVE_APPLY_CMD\""; then
+        docker_cmd "exec -i $DOCKER_CONTAINER sh -c \"$RESTART_CMD\""
+    fi
 else
     docker cp "$SERVER_CONF_PATH" $DOCKER_CONTAINER:$WG_CONFIG_FILE
-    docker exec -i $DOCKER_CONTAINER sh -c "wg-quick down $WG_CONFIG_FILE && wg-quick up $WG_CONFIG_FILE"
+    if [ "${APPLY_MODE:-live}" = "restart" ] || ! docker exec -i $DOCKER_CONTAINER sh -c "$LIVE_APPLY_CMD"; then
+        docker exec -i $DOCKER_CONTAINER sh -c "$RESTART_CMD"
+    fi
 fi
 
 cat << EOF > "$pwd/users/$CLIENT_NAME/$CLIENT_NAME.conf"
@@ -0,0 +1,102 @@
+import io
+import os
+import glob
+import shutil
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import qrcode
+from qrcode.image.pure import PyPNGImage
+
+logger = logging.getLogger(__name__)
+
+QR_WORKERS = 2
+QR_BOX_SIZE = 6
+QR_BORDER = 2
+QR_FILE_PREFIX = 'qr'
+QR_CACHE_DIR = 'files/qr'
+
+_executor = None
+
+def render_qr_png(text):
+    """Текст -> PNG с QR-кодом. Выполняется в отдельном процессе пула."""
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER,
+        image_factory=PyPNGImage
+    )
+    qr.add_data(text)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image().save(buffer)
+    return buffer.getvalue()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=QR_WORKERS)
+    return _executor
+
+def qr_cache_dir(client_name):
+    return os.path.join(QR_CACHE_DIR, client_name)
+
+def qr_cache_path(cache_dir, kind, text):
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{QR_FILE_PREFIX}_{kind}_{digest}.png")
+
+def _replace_cached(cache_dir, kind, path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    for old_path in glob.glob(os.path.join(cache_dir, f"{QR_FILE_PREFIX}_{kind}_*.png")):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+async def get_qr_png(client_name, kind, text):
+    """
+    Путь к PNG с QR-кодом text в files/qr/<клиент>. Картинка кэшируется по хэшу
+    содержимого и пересоздаётся только при изменении конфигурации. Кэш не
+    попадает в резервные копии и удаляется вместе с клиентом (remove_cached).
+    """
+    cache_dir = qr_cache_dir(client_name)
+    path = qr_cache_path(cache_dir, kind, text)
+    if os.path.exists(path):
+        return path
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(_get_executor(), render_qr_png, text)
+    os.makedirs(cache_dir, exist_ok=True)
+    _replace_cached(cache_dir, kind, path, data)
+    return path
+
+def remove_cached(client_name):
+    shutil.rmtree(qr_cache_dir(client_name), ignore_errors=True)
+
+def prune(existing_clients, users_dir='users'):
+    """
+    Удаляет кэш QR-кодов клиентов, которых больше нет, и PNG, оставшиеся
+    в каталогах клиентов от прежнего расположения кэша.
+    """
+    removed = 0
+    if os.path.isdir(QR_CACHE_DIR):
+        for client_name in os.listdir(QR_CACHE_DIR):
+            if client_name not in existing_clients:
+                remove_cached(client_name)
+                removed += 1
+    for old_path in glob.glob(os.path.join(users_dir, '*', f"{QR_FILE_PREFIX}_*.png")):
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    return removed
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
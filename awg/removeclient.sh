@@ -72,7 +72,10 @@ docker exec -i "$DOCKER_CONTAINER" wg-quick strip "$WG_CONFIG_FILE" > /dev/null
 
 docker cp "$SERVER_CONF_PATH" "$DOCKER_CONTAINER":"$WG_CONFIG_FILE"
 
-docker exec -i "$DOCKER_CONTAINER" sh -c "wg-quick down '$WG_CONFIG_FILE' && wg-quick up '$WG_CONFIG_FILE'"
+WG_INTERFACE=$(basename "$WG_CONFIG_FILE" .conf)
+if [ "${APPLY_MODE:-live}" = "restart" ] || ! docker exec -i "$DOCKER_CONTAINER" sh -c "wg-quick strip '$WG_CONFIG_FILE' > '/tmp/$WG_INTERFACE.stripped' && wg syncconf '$WG_INTERFACE' '/tmp/$WG_INTERFACE.stripped'; status=\$?; rm -f '/tmp/$WG_INTERFACE.stripped'; exit \$status"; then
+    docker exec -i "$DOCKER_CONTAINER" sh -c "wg-quick down '$WG_CONFIG_FILE' && wg-quick up '$WG_CONFIG_FILE'"
+fi
 
 rm -f "users/$CLIENT_NAME/$CLIENT_NAME.conf"
 rmdir "users/$CLIENT_NAME" 2>/dev/null || true
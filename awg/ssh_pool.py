@@ -0,0 +1,163 @@
+import io
+import asyncio
+import logging
+import paramiko
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_COMMAND_TIMEOUT = 30
+CONNECT_TIMEOUT = 10
+
+class SSHPool:
+    """
+    Одно SSH-соединение на сервер и ограниченный пул exec-каналов поверх него.
+    Блокирующие вызовы paramiko выполняются в собственном пуле потоков,
+    поэтому цикл событий бота не блокируется ожиданием ответа сервера.
+    """
+
+    def __init__(self, server_id, host, port, username, auth_type, password=None, key_path=None, size=DEFAULT_POOL_SIZE):
+        self.server_id = server_id
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.auth_type = auth_type
+        self.password = password
+        self.key_path = key_path
+        self.size = size
+        self._client = None
+        self._connect_lock = asyncio.Lock()
+        self._channels = asyncio.Semaphore(size)
+        self._executor = ThreadPoolExecutor(max_workers=size + 1, thread_name_prefix=f"ssh-{server_id}")
+
+    def _connect_blocking(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if self.auth_type == "password":
+            client.connect(
+                self.host,
+                self.port,
+                self.username,
+                self.password,
+                timeout=CONNECT_TIMEOUT,
+                look_for_keys=False,
+                allow_agent=False
+            )
+        else:
+            private_key = paramiko.RSAKey.from_private_key_file(self.key_path)
+            client.connect(
+                self.host,
+                self.port,
+                self.username,
+                pkey=private_key,
+                timeout=CONNECT_TIMEOUT,
+                look_for_keys=False,
+                allow_agent=False
+            )
+        return client
+
+    def _is_active(self):
+        return self._client is not None and self._client.get_transport() is not None and self._client.get_transport().is_active()
+
+    async def _get_transport(self):
+        async with self._connect_lock:
+            if not self._is_active():
+                self._drop_client()
+                loop = asyncio.get_running_loop()
+                self._client = await loop.run_in_executor(self._executor, self._connect_blocking)
+                logger.info(f"SSH соединение с сервером {self.server_id} установлено")
+            return self._client.get_transport()
+
+    def _drop_client(self):
+        if self._client:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+            self._client = None
+
+    @staticmethod
+    def _exec_blocking(channel, command, stdin_data):
+        channel.exec_command(command)
+        if stdin_data is not None:
+            channel.sendall(stdin_data)
+        channel.shutdown_write()
+        output = channel.makefile('rb').read()
+        error = channel.makefile_stderr('rb').read()
+        return output.decode(errors='replace'), error.decode(errors='replace')
+
+    async def _run(self, command, stdin_data):
+        loop = asyncio.get_running_loop()
+        async with self._channels:
+            transport = await self._get_transport()
+            channel = await loop.run_in_executor(self._executor, transport.open_session, CONNECT_TIMEOUT)
+            try:
+                return await loop.run_in_executor(self._executor, self._exec_blocking, channel, command, stdin_data)
+            finally:
+                channel.close()
+
+    async def run(self, command, timeout=DEFAULT_COMMAND_TIMEOUT, stdin=None):
+        if isinstance(stdin, str):
+            stdin = stdin.encode()
+        try:
+            return await asyncio.wait_for(self._run(command, stdin), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Команда на сервере {self.server_id} не завершилась за {timeout} с: {command}")
+            return None, f"Command timed out after {timeout}s"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка выполнения команды на сервере {self.server_id}: {e}")
+            self._drop_client()
+            return None, str(e)
+
+    def _upload_blocking(self, transport, data, remote_path):
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            sftp.putfo(io.BytesIO(data), remote_path)
+        finally:
+            sftp.close()
+
+    async def upload(self, data, remote_path, timeout=DEFAULT_COMMAND_TIMEOUT):
+        if isinstance(data, str):
+            data = data.encode()
+        loop = asyncio.get_running_loop()
+
+        async def _upload():
+            async with self._channels:
+                transport = await self._get_transport()
+                await loop.run_in_executor(self._executor, self._upload_blocking, transport, data, remote_path)
+
+        await asyncio.wait_for(_upload(), timeout)
+
+    def close(self):
+        self._drop_client()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+_pools = {}
+
+def get_pool(server_id, server_config):
+    pool = _pools.get(server_id)
+    if pool is None:
+        pool = SSHPool(
+            server_id=server_id,
+            host=server_config.get('host'),
+            port=server_config.get('port', 22),
+            username=server_config.get('username'),
+            auth_type=server_config.get('auth_type'),
+            password=server_config.get('_original_password'),
+            key_path=server_config.get('key_path'),
+            size=int(server_config.get('ssh_pool_size', DEFAULT_POOL_SIZE))
+        )
+        _pools[server_id] = pool
+    return pool
+
+def close_pool(server_id):
+    pool = _pools.pop(server_id, None)
+    if pool:
+        pool.close()
+
+def close_all_pools():
+    for server_id in list(_pools.keys()):
+        close_pool(server_id)
@@ -0,0 +1,371 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = 'files/traffic.db'
+MIGRATED_SUFFIX = '.migrated'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traffic (
+    server_id TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    client_name TEXT NOT NULL,
+    total_incoming INTEGER NOT NULL DEFAULT 0,
+    total_outgoing INTEGER NOT NULL DEFAULT 0,
+    last_incoming INTEGER NOT NULL DEFAULT 0,
+    last_outgoing INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    needs_baseline INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (server_id, public_key)
+);
+CREATE INDEX IF NOT EXISTS traffic_client_name ON traffic (server_id, client_name);
+CREATE TABLE IF NOT EXISTS traffic_history (
+    server_id TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    incoming INTEGER NOT NULL DEFAULT 0,
+    outgoing INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (server_id, resolution, bucket, public_key)
+) WITHOUT ROWID;
+"""
+
+UPSERT = """
+INSERT INTO traffic (server_id, public_key, client_name, total_incoming, total_outgoing, last_incoming, last_outgoing, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (server_id, public_key) DO UPDATE SET
+    client_name = excluded.client_name,
+    total_incoming = excluded.total_incoming,
+    total_outgoing = excluded.total_outgoing,
+    last_incoming = excluded.last_incoming,
+    last_outgoing = excluded.last_outgoing,
+    updated_at = excluded.updated_at,
+    needs_baseline = 0
+"""
+
+HISTORY_UPSERT = """
+INSERT INTO traffic_history (server_id, public_key, resolution, bucket, incoming, outgoing)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (server_id, resolution, bucket, public_key) DO UPDATE SET
+    incoming = incoming + excluded.incoming,
+    outgoing = outgoing + excluded.outgoing
+"""
+
+# Перенесённые из JSON строки: прошлые счётчики там округлены, поэтому первый
+# точный образец только задаёт новую точку отсчёта
+INSERT_IGNORE = """
+INSERT OR IGNORE INTO traffic (server_id, public_key, client_name, total_incoming, total_outgoing, last_incoming, last_outgoing, updated_at, needs_baseline)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+"""
+
+# До этого числа ключей строки читаются выборкой по ключам, иначе - целиком по серверу
+KEY_LOOKUP_LIMIT = 500
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+
+# Размер корзины истории (с) -> сколько секунд её хранить
+HISTORY_RETENTION = {
+    MINUTE: 2 * DAY,
+    HOUR: 90 * DAY,
+    DAY: 3 * 365 * DAY
+}
+PRUNE_INTERVAL = HOUR
+MAX_SERIES_POINTS = 500
+
+COLUMNS = ('total_incoming', 'total_outgoing', 'last_incoming', 'last_outgoing')
+
+def empty_counters():
+    return {column: 0 for column in COLUMNS}
+
+class TrafficStore:
+    """
+    Счётчики трафика клиентов в SQLite (режим WAL), ключ - (сервер, публичный ключ).
+    Все образцы одного цикла опроса сервера записываются одной транзакцией.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, retention=None):
+        self.path = path
+        self.retention = dict(retention or HISTORY_RETENTION)
+        self._last_prune = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(traffic)")}
+        if 'needs_baseline' not in columns:
+            self._conn.execute("ALTER TABLE traffic ADD COLUMN needs_baseline INTEGER NOT NULL DEFAULT 0")
+
+    def _load_rows(self, server_id, public_keys=None):
+        if public_keys is None:
+            cursor = self._conn.execute("SELECT * FROM traffic WHERE server_id = ?", (server_id,))
+        else:
+            placeholders = ','.join('?' * len(public_keys))
+            cursor = self._conn.execute(
+                f"SELECT * FROM traffic WHERE server_id = ? AND public_key IN ({placeholders})",
+                (server_id, *public_keys)
+            )
+        return {row['public_key']: dict(row) for row in cursor}
+
+    def record_samples(self, server_id, samples, sampled_at=None):
+        """
+        samples - список (публичный ключ, имя клиента, rx_bytes, tx_bytes) из дампа wg,
+        sampled_at - время снятия дампа. Накапливает прирост счётчиков и возвращает
+        {публичный ключ: счётчики}. Образцы старше уже записанных не учитываются.
+        Счётчики ядра уменьшаются только при сбросе (перезапуск интерфейса или пира),
+        поэтому любое уменьшение rx или tx считается сбросом обоих направлений:
+        весь текущий счётчик засчитывается приростом.
+        """
+        samples = list(samples)
+        if not samples:
+            return {}
+        now = time.time()
+        sampled_at = now if sampled_at is None else sampled_at
+        result = {}
+        rows = []
+        history = []
+        resets = 0
+        with self._lock:
+            if len(samples) <= KEY_LOOKUP_LIMIT:
+                current = self._load_rows(server_id, [sample[0] for sample in samples])
+            else:
+                current = self._load_rows(server_id)
+            for public_key, client_name, incoming_bytes, outgoing_bytes in samples:
+                row = current.get(public_key)
+                counters = row or empty_counters()
+                if row is not None and sampled_at < row['updated_at']:
+                    result[public_key] = {column: row[column] for column in COLUMNS}
+                    continue
+                if row is not None and row['needs_baseline']:
+                    delta_incoming, delta_outgoing = 0, 0
+                else:
+                    if incoming_bytes < counters['last_incoming'] or outgoing_bytes < counters['last_outgoing']:
+                        delta_incoming, delta_outgoing = incoming_bytes, outgoing_bytes
+                        resets += 1
+                    else:
+                        delta_incoming = incoming_bytes - counters['last_incoming']
+                        delta_outgoing = outgoing_bytes - counters['last_outgoing']
+                updated = {
+                    'total_incoming': counters['total_incoming'] + delta_incoming,
+                    'total_outgoing': counters['total_outgoing'] + delta_outgoing,
+                    'last_incoming': incoming_bytes,
+                    'last_outgoing': outgoing_bytes
+                }
+                result[public_key] = updated
+                if delta_incoming or delta_outgoing:
+                    for resolution in self.retention:
+                        history.append((
+                            server_id, public_key, resolution, int(sampled_at // resolution * resolution),
+                            delta_incoming, delta_outgoing
+                        ))
+                rows.append((
+                    server_id, public_key, client_name,
+                    updated['total_incoming'], updated['total_outgoing'],
+                    updated['last_incoming'], updated['last_outgoing'], sampled_at
+                ))
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(UPSERT, rows)
+                self._conn.executemany(HISTORY_UPSERT, history)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if now - self._last_prune >= PRUNE_INTERVAL:
+                self._prune(now)
+        if resets:
+            logger.info(f"Сервер {server_id}: обнаружен сброс счётчиков у {resets} пиров, трафик после сброса учтён")
+        return result
+
+    def _prune(self, now):
+        for resolution, keep in self.retention.items():
+            self._conn.execute(
+                "DELETE FROM traffic_history WHERE resolution = ? AND bucket < ?",
+                (resolution, int(now - keep))
+            )
+        self._last_prune = now
+
+    def _plan_range(self, start, end, now, resolutions=None):
+        """
+        Разбивает [start, end) на отрезки, покрываемые корзинами: середина - самыми
+        крупными, края - более мелкими, пока те ещё хранятся. Возвращает [(размер, от, до)].
+        """
+        if resolutions is None:
+            resolutions = sorted(self.retention, reverse=True)
+        if start >= end:
+            return []
+        resolution = resolutions[0]
+        finer = [r for r in resolutions[1:] if start >= now - self.retention[r]]
+        if not finer:
+            return [(resolution, start // resolution * resolution, -(-end // resolution) * resolution)]
+        aligned_start = -(-start // resolution) * resolution
+        aligned_end = end // resolution * resolution
+        if aligned_start >= aligned_end:
+            return self._plan_range(start, end, now, finer)
+        return (
+            self._plan_range(start, aligned_start, now, finer)
+            + [(resolution, aligned_start, aligned_end)]
+            + self._plan_range(aligned_end, end, now, finer)
+        )
+
+    def get_usage(self, server_id, start, end, public_key=None):
+        """
+        Трафик за период [start, end) (unix-время) по каждому клиенту сервера:
+        {публичный ключ: {'name', 'incoming', 'outgoing'}}.
+        """
+        start, end = int(start), int(end)
+        usage = {}
+        query = (
+            "SELECT public_key, SUM(incoming), SUM(outgoing) FROM traffic_history "
+            "WHERE server_id = ? AND resolution = ? AND bucket >= ? AND bucket < ?"
+        )
+        if public_key is not None:
+            query += " AND public_key = ?"
+        query += " GROUP BY public_key"
+        with self._lock:
+            for resolution, range_start, range_end in self._plan_range(start, end, time.time()):
+                params = [server_id, resolution, range_start, range_end]
+                if public_key is not None:
+                    params.append(public_key)
+                for key, incoming, outgoing in self._conn.execute(query, params):
+                    entry = usage.setdefault(key, {'name': None, 'incoming': 0, 'outgoing': 0})
+                    entry['incoming'] += incoming
+                    entry['outgoing'] += outgoing
+            if usage:
+                names = self._load_rows(server_id, list(usage)) if len(usage) <= KEY_LOOKUP_LIMIT else self._load_rows(server_id)
+                for key, entry in usage.items():
+                    if key in names:
+                        entry['name'] = names[key]['client_name']
+        return usage
+
+    def choose_resolution(self, start, end, max_points=MAX_SERIES_POINTS, now=None):
+        """Самые мелкие корзины, которые ещё хранятся для start и дают не больше max_points точек."""
+        now = time.time() if now is None else now
+        resolutions = sorted(self.retention)
+        for resolution in resolutions:
+            if start >= now - self.retention[resolution] and (end - start) / resolution <= max_points:
+                return resolution
+        return resolutions[-1]
+
+    def get_series(self, server_id, public_key, start, end, max_points=MAX_SERIES_POINTS):
+        """Ряд [(начало корзины, incoming, outgoing)] и размер корзины для графика."""
+        resolution = self.choose_resolution(start, end, max_points)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT bucket, incoming, outgoing FROM traffic_history "
+                "WHERE server_id = ? AND resolution = ? AND public_key = ? AND bucket >= ? AND bucket < ? "
+                "ORDER BY bucket",
+                (server_id, resolution, public_key, int(start) // resolution * resolution, int(end))
+            ).fetchall()
+        return resolution, [tuple(row) for row in rows]
+
+    def get_traffic(self, server_id, public_key):
+        with self._lock:
+            row = self._load_rows(server_id, [public_key]).get(public_key)
+        if row is None:
+            return empty_counters()
+        return {column: row[column] for column in COLUMNS}
+
+    def get_client_names(self, server_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT public_key, client_name FROM traffic WHERE server_id = ?", (server_id,)
+            ).fetchall()
+        return {public_key: client_name for public_key, client_name in rows}
+
+    def get_server_traffic(self, server_id):
+        with self._lock:
+            rows = self._load_rows(server_id)
+        return {public_key: {column: row[column] for column in COLUMNS} for public_key, row in rows.items()}
+
+    def remove(self, server_id, public_keys):
+        public_keys = list(public_keys)
+        if not public_keys:
+            return
+        params = [(server_id, public_key) for public_key in public_keys]
+        with self._lock:
+            self._conn.executemany("DELETE FROM traffic WHERE server_id = ? AND public_key = ?", params)
+            self._conn.executemany("DELETE FROM traffic_history WHERE server_id = ? AND public_key = ?", params)
+
+    def remove_server(self, server_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM traffic WHERE server_id = ?", (server_id,))
+            self._conn.execute("DELETE FROM traffic_history WHERE server_id = ?", (server_id,))
+
+    def import_json_files(self, server_id, clients, users_dir='users', legacy_names=()):
+        """
+        Переносит счётчики из users/<имя>/traffic_<сервер>.json для клиентов
+        {имя: публичный ключ}, а для имён из legacy_names - и из старого общего
+        traffic.json. Уже существующие записи в базе не перезаписываются;
+        перенесённые файлы переименовываются.
+        """
+        rows = []
+        migrated_files = []
+        for client_name, public_key in clients.items():
+            file_names = [f"traffic_{server_id}.json"]
+            if client_name in legacy_names:
+                file_names.append("traffic.json")
+            for file_name in file_names:
+                path = os.path.join(users_dir, client_name, file_name)
+                if not os.path.exists(path):
+                    continue
+                try:
+                    with open(path, 'r') as f:
+                        data = json.load(f)
+                    counters = {column: int(float(data.get(column, 0) or 0)) for column in COLUMNS}
+                except (OSError, ValueError, TypeError, AttributeError) as e:
+                    logger.error(f"Не удалось прочитать {path}: {e}")
+                    continue
+                rows.append((
+                    server_id, public_key, client_name,
+                    counters['total_incoming'], counters['total_outgoing'],
+                    counters['last_incoming'], counters['last_outgoing'], 0
+                ))
+                migrated_files.append(path)
+                break
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(INSERT_IGNORE, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        for path in migrated_files:
+            try:
+                os.replace(path, path + MIGRATED_SUFFIX)
+            except OSError as e:
+                logger.error(f"Не удалось переименовать {path}: {e}")
+        logger.info(f"Сервер {server_id}: перенесено счётчиков трафика из JSON: {len(rows)}")
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = TrafficStore(DEFAULT_DB_PATH)
+    return _store
+
+def close_store():
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
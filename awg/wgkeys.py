@@ -0,0 +1,46 @@
+import os
+import base64
+import binascii
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+KEY_LENGTH = 32
+
+def encode_key(raw: bytes) -> str:
+    return base64.b64encode(raw).decode('ascii')
+
+def decode_key(key: str) -> bytes:
+    try:
+        raw = base64.b64decode(key.strip(), validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Ключ не является корректной строкой base64")
+    if len(raw) != KEY_LENGTH:
+        raise ValueError(f"Длина ключа должна быть {KEY_LENGTH} байта")
+    return raw
+
+def clamp_private_key(raw: bytes) -> bytes:
+    key = bytearray(raw)
+    key[0] &= 248
+    key[31] = (key[31] & 127) | 64
+    return bytes(key)
+
+def generate_private_key() -> str:
+    """Аналог `wg genkey`: случайный скаляр Curve25519 с маскированием битов."""
+    return encode_key(clamp_private_key(os.urandom(KEY_LENGTH)))
+
+def public_key(private_key: str) -> str:
+    """Аналог `wg pubkey`."""
+    key = X25519PrivateKey.from_private_bytes(decode_key(private_key))
+    raw = key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )
+    return encode_key(raw)
+
+def generate_preshared_key() -> str:
+    """Аналог `wg genpsk`."""
+    return encode_key(os.urandom(KEY_LENGTH))
+
+def generate_keypair():
+    private_key = generate_private_key()
+    return private_key, public_key(private_key)
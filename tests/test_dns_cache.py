@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'awg'))
+
+import dns_cache
+import awg_decode
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dns_cache.time, 'time', clock)
+    return clock
+
+def counting(lookup):
+    calls = []
+    def wrapper(name):
+        calls.append(name)
+        return lookup(name)
+    return wrapper, calls
+
+def test_hit_within_ttl(clock):
+    lookup, calls = counting(dns_cache.static_lookup({'vpn.example': '192.0.2.1'}, ttl=60))
+    resolver = dns_cache.CachedResolver(lookup)
+    assert resolver.resolve('vpn.example') == '192.0.2.1'
+    clock.now += 59
+    assert resolver.resolve('vpn.example') == '192.0.2.1'
+    assert len(calls) == 1
+    assert resolver.stats['hits'] == 1
+    # TTL истёк - повторный поиск
+    clock.now += 2
+    assert resolver.resolve('vpn.example') == '192.0.2.1'
+    assert len(calls) == 2
+
+def test_negative_entry(clock):
+    lookup, calls = counting(dns_cache.static_lookup({}))
+    resolver = dns_cache.CachedResolver(lookup, negative_ttl=30)
+    assert resolver.resolve('missing.example') is None
+    clock.now += 29
+    assert resolver.resolve('missing.example') is None
+    assert len(calls) == 1
+    clock.now += 2
+    assert resolver.resolve('missing.example') is None
+    assert len(calls) == 2
+    assert resolver.stats['failures'] == 2
+
+def test_stale_fallback_after_failure(clock):
+    mapping = {'vpn.example': '192.0.2.1'}
+    resolver = dns_cache.CachedResolver(dns_cache.static_lookup(mapping, ttl=60), negative_ttl=30, stale_ttl=3600)
+    assert resolver.resolve('vpn.example') == '192.0.2.1'
+    # Имя перестало разрешаться: отдаётся прежний адрес
+    del mapping['vpn.example']
+    clock.now += 61
+    assert resolver.resolve('vpn.example') == '192.0.2.1'
+    assert resolver.stats['stale'] == 1
+    # После stale_ttl прежний адрес больше не используется
+    clock.now += 3600
+    assert resolver.resolve('vpn.example') is None
+
+def test_concurrent_resolve_async_share_lookup():
+    calls = []
+    def slow_lookup(name):
+        calls.append(name)
+        time.sleep(0.05)
+        return '192.0.2.1', 60
+    resolver = dns_cache.CachedResolver(slow_lookup)
+
+    async def main():
+        return await asyncio.gather(*(resolver.resolve_async('vpn.example') for _ in range(5)))
+
+    assert asyncio.run(main()) == ['192.0.2.1'] * 5
+    assert calls == ['vpn.example']
+    assert resolver.stats['misses'] == 1
+
+def test_process_conf_data_not_strict_keeps_endpoint():
+    resolver = dns_cache.CachedResolver(dns_cache.static_lookup({'vpn.example': '192.0.2.1'}))
+    data = (
+        "[Peer]\nEndpoint = vpn.example:51820\n"
+        "[Peer]\nEndpoint = missing.example:51820\n"
+    )
+    processed = awg_decode.process_conf_data(data, resolver.resolve, strict=False)
+    assert "Endpoint = 192.0.2.1:51820" in processed
+    assert "Endpoint = missing.example:51820" in processed
+    with pytest.raises(ValueError):
+        awg_decode.process_conf_data(data, resolver.resolve, strict=True)
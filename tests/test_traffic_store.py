@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'awg'))
+
+import traffic_store
+
+@pytest.fixture
+def store(tmp_path):
+    store = traffic_store.TrafficStore(str(tmp_path / 'traffic.db'))
+    yield store
+    store.close()
+
+def record(store, rx, tx, sampled_at):
+    return store.record_samples('srv', [('KEY', 'alice', rx, tx)], sampled_at=sampled_at)['KEY']
+
+def test_reset_partial_recovery_next_sample(store):
+    record(store, 100000, 100000, 100)
+    # Сброс: ядро начало с нуля и уже насчитало 80 000 до опроса
+    counters = record(store, 80000, 80000, 200)
+    assert counters['total_incoming'] == 180000
+    counters = record(store, 90000, 90000, 300)
+    assert counters['total_incoming'] == 190000
+    assert counters['total_outgoing'] == 190000
+
+def test_reset_applies_to_both_directions(store):
+    record(store, 1000, 1000, 100)
+    counters = record(store, 500, 1500, 200)
+    assert counters['total_incoming'] == 1500
+    assert counters['total_outgoing'] == 2500
+
+def test_stale_sample_is_ignored(store):
+    record(store, 1000, 1000, 200)
+    counters = record(store, 500, 500, 100)
+    assert counters['total_incoming'] == 1000
+    counters = record(store, 1200, 1200, 300)
+    assert counters['total_incoming'] == 1200
+
+def test_migrated_row_is_rebaselined(store, tmp_path):
+    user_dir = tmp_path / 'users' / 'alice'
+    user_dir.mkdir(parents=True)
+    (user_dir / 'traffic_srv.json').write_text(json.dumps({
+        'total_incoming': 5000, 'total_outgoing': 5000,
+        'last_incoming': 1000.0, 'last_outgoing': 1000.0
+    }))
+    assert store.import_json_files('srv', {'alice': 'KEY'}, users_dir=str(tmp_path / 'users')) == 1
+    counters = record(store, 1024, 990, 100)
+    assert counters['total_incoming'] == 5000
+    assert counters['total_outgoing'] == 5000
+    counters = record(store, 2024, 1990, 200)
+    assert counters['total_incoming'] == 6000
+    assert counters['total_outgoing'] == 6000
@@ -0,0 +1,49 @@
+import os
+import sys
+import base64
+import shutil
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'awg'))
+
+import wgkeys
+
+def b64(hex_value):
+    return base64.b64encode(bytes.fromhex(hex_value)).decode('ascii')
+
+# RFC 7748, раздел 6.1
+RFC7748_VECTORS = [
+    (
+        '77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a',
+        '8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a'
+    ),
+    (
+        '5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb',
+        'de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f'
+    ),
+]
+
+@pytest.mark.parametrize('private_hex, public_hex', RFC7748_VECTORS)
+def test_public_key_rfc7748(private_hex, public_hex):
+    assert wgkeys.public_key(b64(private_hex)) == b64(public_hex)
+
+def test_public_key_ignores_clamped_bits():
+    private_key = b64(RFC7748_VECTORS[0][0])
+    clamped = wgkeys.encode_key(wgkeys.clamp_private_key(wgkeys.decode_key(private_key)))
+    assert wgkeys.public_key(clamped) == wgkeys.public_key(private_key)
+
+def test_generated_private_key_is_clamped():
+    raw = wgkeys.decode_key(wgkeys.generate_private_key())
+    assert raw == wgkeys.clamp_private_key(raw)
+
+@pytest.mark.parametrize('key', ['', 'не base64', base64.b64encode(b'short').decode('ascii')])
+def test_decode_key_rejects_invalid(key):
+    with pytest.raises(ValueError):
+        wgkeys.decode_key(key)
+
+@pytest.mark.skipif(shutil.which('wg') is None, reason='wg не установлен')
+def test_public_key_matches_wg_pubkey():
+    private_key, public_key = wgkeys.generate_keypair()
+    output = subprocess.run(['wg', 'pubkey'], input=private_key + '\n', capture_output=True, text=True, check=True).stdout
+    assert output.strip() == public_key